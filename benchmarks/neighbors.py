@@ -0,0 +1,129 @@
+# ----------------------------------------------------------------------------------------------------------------------
+#
+#      Thread scaling benchmark of the batch neighbors op
+#
+# ----------------------------------------------------------------------------------------------------------------------
+#
+#           Imports and global variables
+#       \**********************************/
+#
+
+# Common libs
+import argparse
+import json
+import os
+import platform
+import time
+import numpy as np
+import tensorflow as tf
+
+# Custom libs
+from datasets.common import tf_batch_neighbors, batch_neighbors
+from benchmarks.synthetic import synthetic_pair
+from benchmarks.train_step import time_op, summarize, git_revision
+
+
+# ----------------------------------------------------------------------------------------------------------------------
+#
+#           Utility functions
+#       \***********************/
+#
+
+def thread_counts(max_threads):
+    """
+    1, 2, 4, ... up to max_threads (included)
+    """
+    counts = [1]
+    while counts[-1] * 2 < max_threads:
+        counts.append(counts[-1] * 2)
+    if max_threads > 1:
+        counts.append(max_threads)
+    return counts
+
+
+# ----------------------------------------------------------------------------------------------------------------------
+#
+#           Main Call
+#       \***************/
+#
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(formatter_class=argparse.RawTextHelpFormatter,
+                                     description="Measure the speedup of the batch neighbors op from 1 to N threads", )
+    parser.add_argument('--output', default='benchmark_neighbors.json', help="path of the json report")
+    parser.add_argument('--batch_num', type=int, default=16)
+    parser.add_argument('--num_points', type=int, default=2048, help="points of each cloud of the batch")
+    parser.add_argument('--radius', type=float, default=0.05, help="radius of the neighborhoods")
+    parser.add_argument('--max_neighbors', type=int, default=0, help="neighbors limit of the op (0 for no limit)")
+    parser.add_argument('--max_threads', type=int, default=os.cpu_count())
+    parser.add_argument('--steps', type=int, default=50, help="timed runs of each thread count")
+    parser.add_argument('--warmup', type=int, default=5, help="untimed runs before each thread count")
+    args = parser.parse_args()
+
+    os.environ['CUDA_VISIBLE_DEVICES'] = ''
+    os.environ['TF_CPP_MIN_LOG_LEVEL'] = '3'
+
+    # Stacked batch of synthetic clouds, queried against itself like the convolution neighbors of the first layer
+    rng = np.random.RandomState(42)
+    points = np.vstack([synthetic_pair(args.num_points, args.num_points, rng)[1] for _ in range(args.batch_num)])
+    lengths = np.full((args.batch_num,), args.num_points, dtype=np.int32)
+
+    counts = thread_counts(args.max_threads)
+    stacked_points = tf.constant(points)
+    stacks_lengths = tf.constant(lengths)
+    ops = {n: tf_batch_neighbors(stacked_points, stacked_points, stacks_lengths, stacks_lengths, args.radius,
+                                 max_neighbors=args.max_neighbors, num_threads=n) for n in counts}
+
+    cProto = tf.ConfigProto(intra_op_parallelism_threads=args.max_threads, inter_op_parallelism_threads=1)
+    with tf.Session(config=cProto) as sess:
+
+        # Every thread count must give exactly the same neighbors
+        reference = sess.run(ops[1])
+        for n in counts:
+            if not np.array_equal(sess.run(ops[n]), reference):
+                raise ValueError('Neighbors computed with {:d} threads differ from 1 thread'.format(n))
+
+        # The numpy binding runs the same kernel outside of the graph
+        if not np.array_equal(batch_neighbors(points, points, lengths, lengths, args.radius,
+                                              max_neighbors=args.max_neighbors, num_threads=args.max_threads),
+                              reference):
+            raise ValueError('Neighbors computed by the numpy binding differ from the op')
+
+        stages = {}
+        for n in counts:
+            print('Timing {:d} threads'.format(n))
+            stages[n] = time_op(sess, ops[n], args.steps, args.warmup)
+
+    ########
+    # Report
+    ########
+
+    base = np.median(stages[1])
+    report = {'date': time.strftime('%Y-%m-%d %H:%M:%S'),
+              'git_revision': git_revision(),
+              'tensorflow_version': tf.__version__,
+              'python_version': platform.python_version(),
+              'machine': platform.node(),
+              'cpu_count': os.cpu_count(),
+              'batch_num': args.batch_num,
+              'num_points': args.num_points,
+              'radius': args.radius,
+              'max_neighbors_limit': args.max_neighbors,
+              'max_neighbors': int(reference.shape[1]),
+              'threads': {}}
+    for n in counts:
+        stats = summarize(stages[n], args.batch_num)
+        stats['speedup'] = float(base / np.median(stages[n]))
+        stats['efficiency'] = stats['speedup'] / n
+        report['threads'][str(n)] = stats
+
+    with open(args.output, 'w') as f:
+        json.dump(report, f, indent=2)
+
+    print()
+    for n, stats in report['threads'].items():
+        print('{:>3s} threads  p50 {:8.2f} ms  speedup {:5.2f}  efficiency {:4.2f}'.format(n,
+                                                                                      stats['p50_ms'],
+                                                                                      stats['speedup'],
+                                                                                      stats['efficiency']))
+    print('\nReport saved in ' + args.output)
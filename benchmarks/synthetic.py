@@ -0,0 +1,101 @@
+# ----------------------------------------------------------------------------------------------------------------------
+#
+#      Synthetic completion dataset used for benchmarks (no download needed)
+#
+# ----------------------------------------------------------------------------------------------------------------------
+#
+#           Imports and global variables
+#       \**********************************/
+#
+
+
+# Basic libs
+import numpy as np
+
+# Dataset classes
+from datasets.common import Dataset
+from datasets.ShapeNetBenchmark2048 import ShapeNetBenchmark2048Dataset
+
+
+# ----------------------------------------------------------------------------------------------------------------------
+#
+#           Utility functions
+#       \***********************/
+#
+
+def synthetic_pair(num_input_points, num_gt_points, rng):
+    """
+    Random ellipsoid surface as complete cloud and the part of it above a random plane as partial cloud
+    :param num_input_points: number of points of the partial cloud
+    :param num_gt_points: number of points of the complete cloud
+    :param rng: numpy RandomState
+    :return: partial (num_input_points, 3), complete (num_gt_points, 3)
+    """
+
+    # Complete cloud on an ellipsoid of random axes, inside the unit cube like normalized ShapeNet models
+    axes = rng.uniform(0.15, 0.5, size=(1, 3))
+    directions = rng.normal(size=(num_gt_points, 3))
+    directions /= np.linalg.norm(directions, axis=1, keepdims=True)
+    complete = directions * axes
+
+    # Partial cloud keeps one side of a random plane through the center, resampled to the wanted size
+    normal = rng.normal(size=3)
+    visible = np.where(np.dot(complete, normal) > 0)[0]
+    if visible.shape[0] == 0:
+        visible = np.arange(num_gt_points)
+    partial = complete[rng.choice(visible, size=num_input_points, replace=True)]
+    partial += rng.normal(scale=0.002, size=partial.shape)
+
+    return partial.astype(np.float32), complete.astype(np.float32)
+
+
+# ----------------------------------------------------------------------------------------------------------------------
+#
+#           Class Definition
+#       \**********************/
+#
+
+class SyntheticCompletionDataset(ShapeNetBenchmark2048Dataset):
+    """
+    Random partial/complete cloud pairs with the batch generators and mapping of ShapeNetBenchmark2048, so that
+    benchmarks measure the same input pipeline and network as the real training.
+    """
+
+    def __init__(self, batch_num, num_input_points, num_gt_points, num_clouds=256, input_threads=8, seed=42):
+        """
+        Initiation method.
+        :param batch_num: number of clouds per batch
+        :param num_input_points: number of points of partial clouds
+        :param num_gt_points: number of points of complete clouds
+        :param num_clouds: number of generated clouds in each split
+        :param input_threads: number of threads of the input pipeline
+        :param seed: random seed of the generated clouds
+        """
+        Dataset.__init__(self, 'synthetic_completion')
+
+        self.synset_to_category = {'00000000': 'Ellipsoid'}
+        self.init_synsets()
+
+        self.ignored_labels = np.array([])
+        self.network_model = 'completion'
+
+        self.batch_num = batch_num
+        self.num_threads = input_threads
+        self.input_pts = num_input_points
+
+        # Same split sizes, multiple of batch_num
+        num_clouds = max(1, num_clouds // batch_num) * batch_num
+        self.num_train = num_clouds
+        self.num_valid = num_clouds
+        self.num_test = num_clouds
+
+        # Generate clouds
+        rng = np.random.RandomState(seed)
+        self.partial_points = {}
+        self.complete_points = {}
+        self.ids = {}
+        for split in ['train', 'valid', 'test']:
+            pairs = [synthetic_pair(num_input_points, num_gt_points, rng) for _ in range(num_clouds)]
+            self.partial_points[split] = [p for p, _ in pairs]
+            self.complete_points[split] = [c for _, c in pairs]
+            self.ids[split] = [['{:s}/{:06d}.0'.format(split, i)] for i in range(num_clouds)]
@@ -0,0 +1,261 @@
+# ----------------------------------------------------------------------------------------------------------------------
+#
+#      Throughput benchmark of the KPCN training step on synthetic clouds
+#
+# ----------------------------------------------------------------------------------------------------------------------
+#
+#           Imports and global variables
+#       \**********************************/
+#
+
+# Common libs
+import argparse
+import json
+import os
+import platform
+import subprocess
+import time
+import numpy as np
+import psutil
+import tensorflow as tf
+
+# Custom libs
+from utils.trainer import ModelTrainer
+from models.KPCN_model import KernelPointCompletionNetwork
+from train_ShapeNetBenchmark2048 import ShapeNetBenchmark2048Config
+
+# Dataset
+from benchmarks.synthetic import SyntheticCompletionDataset
+
+
+# ----------------------------------------------------------------------------------------------------------------------
+#
+#           Utility functions
+#       \***********************/
+#
+
+def time_op(sess, fetches, steps, warmup, feed_dict=None, init_op=None):
+    """
+    Run fetches repeatedly and return the duration of each run. When an input iterator is exhausted it is initialized
+    again with init_op, outside of the timed part.
+    :param sess: tensorflow session
+    :param fetches: ops or tensors to run
+    :param steps: number of timed runs
+    :param warmup: number of untimed runs done first
+    :param feed_dict: optional feed dictionary
+    :param init_op: iterator initializer (None if fetches do not read an iterator)
+    :return: numpy array of durations in seconds
+    """
+
+    durations = []
+    while len(durations) < steps:
+        try:
+            t0 = time.time()
+            sess.run(fetches, feed_dict)
+            t1 = time.time()
+            if warmup > 0:
+                warmup -= 1
+            else:
+                durations.append(t1 - t0)
+        except tf.errors.OutOfRangeError:
+            sess.run(init_op)
+
+    return np.array(durations)
+
+
+def summarize(durations, batch_num):
+    """
+    Statistics of a timed stage
+    :param durations: numpy array of durations in seconds
+    :param batch_num: number of clouds in each run
+    :return: dictionary of statistics (times in ms)
+    """
+
+    ms = 1000 * durations
+    return {'steps': int(durations.shape[0]),
+            'mean_ms': float(np.mean(ms)),
+            'std_ms': float(np.std(ms)),
+            'min_ms': float(np.min(ms)),
+            'p50_ms': float(np.percentile(ms, 50)),
+            'p90_ms': float(np.percentile(ms, 90)),
+            'p99_ms': float(np.percentile(ms, 99)),
+            'max_ms': float(np.max(ms)),
+            'clouds_per_s': float(batch_num / np.mean(durations))}
+
+
+def git_revision():
+    """
+    Commit of the benchmarked code (None outside of a git repository)
+    """
+
+    try:
+        return subprocess.check_output(['git', 'rev-parse', 'HEAD'],
+                                       cwd=os.path.dirname(os.path.abspath(__file__)),
+                                       stderr=subprocess.DEVNULL).decode().strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+# ----------------------------------------------------------------------------------------------------------------------
+#
+#           Main Call
+#       \***************/
+#
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(formatter_class=argparse.RawTextHelpFormatter,
+                                     description="Measure the throughput of KPCN training on synthetic clouds", )
+    parser.add_argument('--output', default='benchmark_train_step.json', help="path of the json report")
+    parser.add_argument('--batch_num', type=int, default=16)
+    parser.add_argument('--num_input_points', type=int, default=2048)
+    parser.add_argument('--num_gt_points', type=int, default=2048)
+    parser.add_argument('--num_clouds', type=int, default=256, help="number of synthetic clouds per split")
+    parser.add_argument('--steps', type=int, default=50, help="timed runs of each stage")
+    parser.add_argument('--warmup', type=int, default=5, help="untimed runs before each stage")
+    parser.add_argument('--input_threads', type=int, default=8, help="threads of the input pipeline map")
+    parser.add_argument('--intra_op_threads', type=int, default=0)
+    parser.add_argument('--inter_op_threads', type=int, default=0)
+    parser.add_argument('--mixed_precision', choices=['none', 'float16', 'bfloat16'], default='none')
+    parser.add_argument('--double_fold', action='store_true')
+    parser.add_argument('--seed', type=int, default=42,
+                        help="seed of the weights and the input pipeline, reports of the same seed can be compared")
+    parser.add_argument('--gpu', default='0', help="visible gpu (empty string to run on CPU)")
+    args = parser.parse_args()
+
+    ##########################
+    # Initiate the environment
+    ##########################
+
+    os.environ['CUDA_VISIBLE_DEVICES'] = args.gpu
+    os.environ['TF_CPP_MIN_LOG_LEVEL'] = '3'
+
+    config = ShapeNetBenchmark2048Config()
+    config.saving = False
+    config.batch_num = args.batch_num
+    config.num_input_points = args.num_input_points
+    config.num_gt_points = args.num_gt_points
+    config.num_coarse = args.num_gt_points // config.grid_size ** 2
+    config.num_fine = config.grid_size ** 2 * config.num_coarse
+    config.input_threads = args.input_threads
+    config.intra_op_threads = args.intra_op_threads
+    config.inter_op_threads = args.inter_op_threads
+    config.mixed_precision = args.mixed_precision
+
+    # Augmentation ops are shared by the parallel calls of the input map, their random values depend on the order in
+    # which threads run even with a seed. They are disabled so that batches only depend on --seed
+    config.augment_symmetries = [False, False, False]
+    config.augment_rotation = 'none'
+    config.augment_scale_min = 1.0
+    config.augment_scale_max = 1.0
+    config.augment_noise = 0.0
+
+    ##################
+    # Build everything
+    ##################
+
+    dataset = SyntheticCompletionDataset(config.batch_num,
+                                         config.num_input_points,
+                                         config.num_gt_points,
+                                         num_clouds=args.num_clouds,
+                                         input_threads=config.input_threads,
+                                         seed=args.seed)
+
+    # Same weights and batches for every precision, so that the losses of two reports can be compared. Seeds are set
+    # when the pipeline creates its graph, before any random op exists
+    dataset.random_seed = args.seed
+    dataset.init_input_pipeline(config)
+
+    model = KernelPointCompletionNetwork(dataset.flat_inputs, config, args.double_fold)
+    trainer = ModelTrainer(model)
+    sess = trainer.sess
+
+    # Gradients without update, to time the backward pass alone
+    gradients = [g for g in tf.gradients(model.loss, tf.trainable_variables()) if g is not None]
+
+    # Peak memory of the gpu allocator (no op on CPU)
+    if args.gpu:
+        peak_memory_op = tf.contrib.memory_stats.MaxBytesInUse()
+    else:
+        peak_memory_op = tf.constant(0, dtype=tf.int64)
+
+    ###########
+    # Benchmark
+    ###########
+
+    stages = {}
+    sess.run(dataset.train_init_op)
+
+    # Generator and map function (neighbors, pools, upsamples) of the input pipeline
+    print('\nTiming input map')
+    stages['input_map'] = time_op(sess, dataset.flat_inputs, args.steps, args.warmup,
+                                  init_op=dataset.train_init_op)
+
+    # Network stages are timed on one fixed batch fed to the iterator outputs, without input pipeline cost
+    sess.run(dataset.train_init_op)
+    np_inputs = sess.run(dataset.flat_inputs)
+    feed_dict = {t: v for t, v in zip(dataset.flat_inputs, np_inputs)}
+    feed_dict[model.dropout_prob] = 0.5
+
+    # Losses of the fixed batch with the initial weights (float32 parity of the reduced precision forward pass)
+    distance_ops = {'coarse_EM': trainer.coarse_earth_mover, 'fine_CD': trainer.fine_chamfer, 'loss': model.loss}
+    eval_dict = dict(feed_dict)
+    eval_dict[model.dropout_prob] = 1.0
+    distances = {'initial': {k: float(v) for k, v in sess.run(distance_ops, eval_dict).items()}}
+
+    print('Timing forward pass')
+    stages['forward'] = time_op(sess, [model.coarse, model.fine, model.loss], args.steps, args.warmup, feed_dict)
+
+    print('Timing forward and backward passes')
+    stages['forward_backward'] = time_op(sess, gradients, args.steps, args.warmup, feed_dict)
+
+    # Full trainer step reads the input pipeline like ModelTrainer.train does
+    print('Timing full training step')
+    sess.run(dataset.train_init_op)
+    stages['train_step'] = time_op(sess, [trainer.train_op, model.loss], args.steps, args.warmup,
+                                   feed_dict={model.dropout_prob: 0.5},
+                                   init_op=dataset.train_init_op)
+
+    # Losses of the same batch after the timed training steps (parity of the reduced precision training)
+    distances['trained'] = {k: float(v) for k, v in sess.run(distance_ops, eval_dict).items()}
+
+    ########
+    # Report
+    ########
+
+    report = {'date': time.strftime('%Y-%m-%d %H:%M:%S'),
+              'git_revision': git_revision(),
+              'tensorflow_version': tf.__version__,
+              'python_version': platform.python_version(),
+              'machine': platform.node(),
+              'cpu_count': os.cpu_count(),
+              'gpu': args.gpu,
+              'architecture': config.architecture,
+              'batch_num': config.batch_num,
+              'num_input_points': config.num_input_points,
+              'num_gt_points': config.num_gt_points,
+              'double_fold': args.double_fold,
+              'mixed_precision': config.mixed_precision,
+              'threads': {'input_threads': config.input_threads,
+                          'intra_op_threads': config.intra_op_threads,
+                          'inter_op_threads': config.inter_op_threads},
+              'seed': args.seed,
+              'memory_rss_MB': psutil.Process(os.getpid()).memory_info().rss * 1e-6,
+              'gpu_peak_MB': float(sess.run(peak_memory_op)) * 1e-6,
+              'distances': distances,
+              'stages': {name: summarize(durations, config.batch_num) for name, durations in stages.items()},
+              'config': config.parameters()}
+
+    with open(args.output, 'w') as f:
+        json.dump(report, f, indent=2, default=str)
+
+    print()
+    for name, stats in report['stages'].items():
+        print('{:<18s} p50 {:8.1f} ms  p90 {:8.1f} ms  p99 {:8.1f} ms  {:7.1f} clouds/s'.format(name,
+                                                                                          stats['p50_ms'],
+                                                                                          stats['p90_ms'],
+                                                                                          stats['p99_ms'],
+                                                                                          stats['clouds_per_s']))
+    for name, values in distances.items():
+        print('{:<18s} '.format(name + ' losses') + '  '.join('{:s} {:.6f}'.format(k, v) for k, v in values.items()))
+    print('GPU peak memory    {:.1f} MB'.format(report['gpu_peak_MB']))
+    print('\nReport saved in ' + args.output)
@@ -0,0 +1,172 @@
+# ----------------------------------------------------------------------------------------------------------------------
+#
+#      Callable script to complete any partial clouds with a trained model
+#
+# ----------------------------------------------------------------------------------------------------------------------
+#
+#           Imports and global variables
+#       \**********************************/
+#
+
+# Common libs
+import time
+import os
+import glob
+import numpy as np
+import argparse
+
+# My libs
+from utils.config import Config
+from utils.tester import ModelTester
+from models.KPCN_model import KernelPointCompletionNetwork
+
+# Datasets
+from datasets.partial_clouds import PartialCloudsDataset, cloud_extensions
+
+
+# ----------------------------------------------------------------------------------------------------------------------
+#
+#           Utility functions
+#       \***********************/
+#
+
+def list_clouds(inputs):
+    """
+    Partial clouds found in directories (recursively) and glob patterns, in a stable order
+    """
+    files = []
+    for pattern in inputs:
+        if os.path.isdir(pattern):
+            pattern = os.path.join(pattern, '**', '*')
+        files += [f for f in glob.glob(pattern, recursive=True)
+                  if os.path.isfile(f) and os.path.splitext(f)[1].lower() in cloud_extensions]
+    return sorted(set(files))
+
+
+def complete_caller(path, step_ind, files, output_path):
+    ##########################
+    # Initiate the environment
+    ##########################
+
+    # Choose which gpu to use
+    GPU_ID = '0'
+
+    # Set GPU visible device
+    os.environ['CUDA_VISIBLE_DEVICES'] = GPU_ID
+
+    # Disable warnings
+    os.environ['TF_CPP_MIN_LOG_LEVEL'] = '0'
+
+    ###########################
+    # Load the model parameters
+    ###########################
+
+    # Load model parameters
+    config = Config()
+    config.load(path)
+
+    # No augmentation of the clouds to complete
+    config.augment_scale_anisotropic = True
+    config.augment_symmetries = [False, False, False]
+    config.augment_rotation = 'none'
+    config.augment_scale_min = 1.0
+    config.augment_scale_max = 1.0
+    config.augment_noise = 0.0
+    config.augment_occlusion = 'none'
+    if args.batch_num > 0:
+        config.batch_num = args.batch_num
+
+    ##############
+    # Prepare Data
+    ##############
+
+    print()
+    print('Dataset Preparation')
+    print('*******************')
+
+    # Clouds are read while the model runs, processes are started before any tensorflow session
+    dl0 = 0  # config.first_subsampling_dl
+    dataset = PartialCloudsDataset(files, config.batch_num, config.num_input_points,
+                                   normalize=args.normalize,
+                                   subsampling_parameter=dl0,
+                                   num_workers=args.num_workers)
+    print('{:d} partial clouds to complete'.format(dataset.num_clouds))
+
+    # Initialize test input pipeline
+    dataset.init_test_input_pipeline(config)
+
+    ##############
+    # Define Model
+    ##############
+
+    print('Creating Model')
+    print('**************\n')
+    t1 = time.time()
+
+    model = KernelPointCompletionNetwork(dataset.flat_inputs, config, args.double_fold)
+
+    # Find all snapshot in the chosen training folder
+    snap_path = os.path.join(path, 'snapshots')
+    snap_steps = [int(f[:-5].split('-')[-1]) for f in os.listdir(snap_path) if f[-5:] == '.meta']
+
+    # Find which snapshot to restore
+    if step_ind == -1:
+        chosen_step = np.sort(snap_steps)[step_ind]
+    else:
+        chosen_step = step_ind + 1
+    chosen_snap = os.path.join(path, 'snapshots', 'snap-{:d}'.format(chosen_step))
+
+    # Create a tester class
+    tester = ModelTester(model, restore_snap=chosen_snap)
+    t2 = time.time()
+
+    print('\n----------------')
+    print('Done in {:.1f} s'.format(t2 - t1))
+    print('----------------\n')
+
+    ################
+    # Start complete
+    ################
+
+    print('Start Completion')
+    print('****************\n')
+    tester.complete_clouds(model, dataset, output_path, dtype=np.float16 if args.float16 else np.float32)
+    dataset.close()
+
+
+# ----------------------------------------------------------------------------------------------------------------------
+#
+#           Main Call
+#       \***************/
+#
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(formatter_class=argparse.RawTextHelpFormatter,
+                                     description="Complete PLY, PCD or H5 partial clouds with a trained model", )
+    parser.add_argument('inputs', nargs='+', help="directories (searched recursively) or glob patterns of clouds")
+    parser.add_argument('--saving_path', help="model_log_file_path")
+    parser.add_argument('--snap', type=int, default=-1, help="snapshot to restore (-1 for latest snapshot)")
+    parser.add_argument('--output', default='completions',
+                        help="folder of completions.npy, completions_ids.txt and failed.txt")
+    parser.add_argument('--double_fold', action='store_true')
+    parser.add_argument('--batch_num', type=int, default=0, help="clouds per batch (0 for the batch_num of the log)")
+    parser.add_argument('--num_workers', type=int, default=os.cpu_count(),
+                        help="number of processes reading and preparing the clouds")
+    parser.add_argument('--normalize', action='store_true',
+                        help="center and scale each cloud to a unit bounding box before its completion\n"
+                             "(for clouds that are not in the frame of the training data)")
+    parser.add_argument('--float16', action='store_true', help="store the completions as float16")
+    args = parser.parse_args()
+
+    chosen_log = args.saving_path
+    chosen_snapshot = args.snap
+
+    # Check if log exists
+    if chosen_log is None or not os.path.exists(chosen_log):
+        raise ValueError('The given log does not exists: ' + str(chosen_log))
+
+    cloud_files = list_clouds(args.inputs)
+    if not cloud_files:
+        raise ValueError('No PLY, PCD or H5 cloud found in ' + ', '.join(args.inputs))
+
+    complete_caller(chosen_log, chosen_snapshot, cloud_files, args.output)
@@ -5,3 +5,8 @@ cd cpp_subsampling
 python3 setup.py build_ext --inplace
 cd ..
 
+
+# Compile cpp batch neighbors and subsampling
+cd cpp_batch_ops
+python3 setup.py build_ext --inplace
+cd ..
@@ -0,0 +1,24 @@
+from distutils.core import setup, Extension
+import numpy.distutils.misc_util
+
+# Adding sources of the project
+# *****************************
+
+# The kernels are the ones of the tensorflow custom ops, compiled without tensorflow
+
+m_name = "batch_ops"
+
+SOURCES = ["../../tf_custom_ops/cpp_utils/cloud/cloud.cpp",
+           "../../tf_custom_ops/tf_neighbors/neighbors/neighbors.cpp",
+           "../../tf_custom_ops/tf_subsampling/grid_subsampling/grid_subsampling.cpp",
+           "wrapper.cpp"]
+
+module = Extension(m_name,
+                   sources=SOURCES,
+                   extra_compile_args=['-std=c++11',
+                                       '-O2',
+                                       '-pthread',
+                                       '-D_GLIBCXX_USE_CXX11_ABI=0'],
+                   extra_link_args=['-pthread'])
+
+setup(ext_modules=[module], include_dirs=numpy.distutils.misc_util.get_numpy_include_dirs())
@@ -0,0 +1,325 @@
+#define NPY_NO_DEPRECATED_API NPY_1_7_API_VERSION
+#include <Python.h>
+#include <numpy/arrayobject.h>
+#include "../../tf_custom_ops/tf_neighbors/neighbors/neighbors.h"
+#include "../../tf_custom_ops/tf_subsampling/grid_subsampling/grid_subsampling.h"
+#include <string>
+
+
+
+// docstrings for our module
+// *************************
+
+static char module_docstring[] = "This module provides the batch neighbors and subsampling kernels of the tensorflow "
+                                 "custom ops on numpy arrays";
+
+static char neighbors_docstring[] = "radius neighbors of stacked batch queries among the supports of the same batch "
+                                    "element, sorted by distance and padded with the number of supports";
+
+static char knn_docstring[] = "k nearest neighbors of stacked batch queries among the supports of the same batch "
+                              "element, sorted by distance and padded with the number of supports";
+
+static char subsampling_docstring[] = "grid subsampling of each element of a stacked batch, returns the subsampled "
+                                      "points, their batch lengths and the subsampled point of each input point";
+
+
+// Declare the functions
+// *********************
+
+static PyObject *batch_neighbors(PyObject *self, PyObject *args, PyObject *keywds);
+static PyObject *batch_knn(PyObject *self, PyObject *args, PyObject *keywds);
+static PyObject *batch_subsampling(PyObject *self, PyObject *args, PyObject *keywds);
+
+
+// Specify the members of the module
+// *********************************
+
+static PyMethodDef module_methods[] =
+{
+	{ "batch_neighbors", (PyCFunction)batch_neighbors, METH_VARARGS | METH_KEYWORDS, neighbors_docstring },
+	{ "batch_knn", (PyCFunction)batch_knn, METH_VARARGS | METH_KEYWORDS, knn_docstring },
+	{ "batch_subsampling", (PyCFunction)batch_subsampling, METH_VARARGS | METH_KEYWORDS, subsampling_docstring },
+    {NULL, NULL, 0, NULL}
+};
+
+
+// Initialize the module
+// *********************
+
+static struct PyModuleDef moduledef =
+{
+    PyModuleDef_HEAD_INIT,
+    "batch_ops",            // m_name
+    module_docstring,       // m_doc
+    -1,                     // m_size
+    module_methods,         // m_methods
+    NULL,                   // m_reload
+    NULL,                   // m_traverse
+    NULL,                   // m_clear
+    NULL,                   // m_free
+};
+
+PyMODINIT_FUNC PyInit_batch_ops(void)
+{
+    import_array();
+	return PyModule_Create(&moduledef);
+}
+
+
+// Input utilities
+// ***************
+
+// Convert a (N, 3) array of points, returns NULL with a python error if it is not possible
+static PyArrayObject *points_from_object(PyObject *obj, const char *name)
+{
+	PyArrayObject *array = (PyArrayObject*)PyArray_FROM_OTF(obj, NPY_FLOAT, NPY_ARRAY_IN_ARRAY);
+	if (array == NULL)
+	{
+		PyErr_Format(PyExc_RuntimeError, "Error converting %s to numpy arrays of type float32", name);
+		return NULL;
+	}
+	if ((int)PyArray_NDIM(array) != 2 || (int)PyArray_DIM(array, 1) != 3)
+	{
+		Py_DECREF(array);
+		PyErr_Format(PyExc_RuntimeError, "Wrong dimensions : %s.shape is not (N, 3)", name);
+		return NULL;
+	}
+	return array;
+}
+
+// Convert a (B,) array of batch lengths summing to N, returns NULL with a python error if it is not possible
+static PyArrayObject *batches_from_object(PyObject *obj, const char *name, npy_intp N)
+{
+	PyArrayObject *array = (PyArrayObject*)PyArray_FROM_OTF(obj, NPY_INT, NPY_ARRAY_IN_ARRAY);
+	if (array == NULL)
+	{
+		PyErr_Format(PyExc_RuntimeError, "Error converting %s to numpy arrays of type int32", name);
+		return NULL;
+	}
+	if ((int)PyArray_NDIM(array) != 1)
+	{
+		Py_DECREF(array);
+		PyErr_Format(PyExc_RuntimeError, "Wrong dimensions : %s.shape is not (B,)", name);
+		return NULL;
+	}
+	npy_intp total = 0;
+	int* lengths = (int*)PyArray_DATA(array);
+	for (npy_intp b = 0; b < PyArray_DIM(array, 0); b++)
+		total += lengths[b];
+	if (total != N)
+	{
+		Py_DECREF(array);
+		PyErr_Format(PyExc_RuntimeError, "Wrong lengths : the sum of %s is not the number of points", name);
+		return NULL;
+	}
+	return array;
+}
+
+static vector<PointXYZ> points_vector(PyArrayObject *array)
+{
+	PointXYZ* data = (PointXYZ*)PyArray_DATA(array);
+	return vector<PointXYZ>(data, data + PyArray_DIM(array, 0));
+}
+
+static vector<int> batches_vector(PyArrayObject *array)
+{
+	int* data = (int*)PyArray_DATA(array);
+	return vector<int>(data, data + PyArray_DIM(array, 0));
+}
+
+// Convert the queries, supports and their batch lengths of a neighbors search, returns false with a python error if
+// it is not possible
+static bool neighbors_inputs(PyObject *q_obj, PyObject *s_obj, PyObject *qb_obj, PyObject *sb_obj,
+                             vector<PointXYZ>& queries, vector<PointXYZ>& supports,
+                             vector<int>& q_batches, vector<int>& s_batches)
+{
+	PyArrayObject *q_array = points_from_object(q_obj, "queries");
+	PyArrayObject *s_array = q_array == NULL ? NULL : points_from_object(s_obj, "supports");
+	PyArrayObject *qb_array = s_array == NULL ? NULL : batches_from_object(qb_obj, "q_batches", PyArray_DIM(q_array, 0));
+	PyArrayObject *sb_array = qb_array == NULL ? NULL : batches_from_object(sb_obj, "s_batches", PyArray_DIM(s_array, 0));
+
+	bool valid = sb_array != NULL;
+	if (valid && PyArray_DIM(qb_array, 0) != PyArray_DIM(sb_array, 0))
+	{
+		PyErr_SetString(PyExc_RuntimeError, "Wrong dimensions : q_batches and s_batches have different lengths");
+		valid = false;
+	}
+	if (valid)
+	{
+		queries = points_vector(q_array);
+		supports = points_vector(s_array);
+		q_batches = batches_vector(qb_array);
+		s_batches = batches_vector(sb_array);
+	}
+
+	Py_XDECREF(q_array);
+	Py_XDECREF(s_array);
+	Py_XDECREF(qb_array);
+	Py_XDECREF(sb_array);
+	return valid;
+}
+
+// (Nq, n) int32 array with the content of a vector
+static PyObject *indices_array(vector<int>& indices, size_t Nq)
+{
+	npy_intp dims[2];
+	dims[0] = Nq;
+	dims[1] = Nq > 0 ? indices.size() / Nq : 0;
+	PyObject *res_obj = PyArray_SimpleNew(2, dims, NPY_INT);
+	memcpy(PyArray_DATA((PyArrayObject*)res_obj), indices.data(), indices.size() * sizeof(int));
+	return res_obj;
+}
+
+
+// Actual wrappers
+// ***************
+
+static PyObject *batch_neighbors(PyObject *self, PyObject *args, PyObject *keywds)
+{
+	// Args containers
+	PyObject *queries_obj = NULL;
+	PyObject *supports_obj = NULL;
+	PyObject *q_batches_obj = NULL;
+	PyObject *s_batches_obj = NULL;
+
+	// Keywords containers
+	static char *kwlist[] = {"queries", "supports", "q_batches", "s_batches", "radius", "max_neighbors",
+	                         "num_threads", NULL };
+	float radius = 0.1;
+	int max_neighbors = 0;
+	int num_threads = 1;
+
+	// Parse the input
+	if (!PyArg_ParseTupleAndKeywords(args, keywds, "OOOOf|ii", kwlist, &queries_obj, &supports_obj, &q_batches_obj,
+	                                 &s_batches_obj, &radius, &max_neighbors, &num_threads))
+	{
+		PyErr_SetString(PyExc_RuntimeError, "Error parsing arguments");
+		return NULL;
+	}
+
+	vector<PointXYZ> queries, supports;
+	vector<int> q_batches, s_batches;
+	if (!neighbors_inputs(queries_obj, supports_obj, q_batches_obj, s_batches_obj,
+	                      queries, supports, q_batches, s_batches))
+		return NULL;
+
+	// Search without the GIL, so that other python threads keep running
+	vector<int> neighbors_indices;
+	Py_BEGIN_ALLOW_THREADS
+	batch_nanoflann_neighbors(queries, supports, q_batches, s_batches, neighbors_indices, radius, max_neighbors,
+	                          num_threads);
+	Py_END_ALLOW_THREADS
+
+	return indices_array(neighbors_indices, queries.size());
+}
+
+
+static PyObject *batch_knn(PyObject *self, PyObject *args, PyObject *keywds)
+{
+	// Args containers
+	PyObject *queries_obj = NULL;
+	PyObject *supports_obj = NULL;
+	PyObject *q_batches_obj = NULL;
+	PyObject *s_batches_obj = NULL;
+
+	// Keywords containers
+	static char *kwlist[] = {"queries", "supports", "q_batches", "s_batches", "k", "num_threads", NULL };
+	int k = 1;
+	int num_threads = 1;
+
+	// Parse the input
+	if (!PyArg_ParseTupleAndKeywords(args, keywds, "OOOOi|i", kwlist, &queries_obj, &supports_obj, &q_batches_obj,
+	                                 &s_batches_obj, &k, &num_threads))
+	{
+		PyErr_SetString(PyExc_RuntimeError, "Error parsing arguments");
+		return NULL;
+	}
+	if (k < 1)
+	{
+		PyErr_SetString(PyExc_RuntimeError, "Wrong value : k must be at least 1");
+		return NULL;
+	}
+
+	vector<PointXYZ> queries, supports;
+	vector<int> q_batches, s_batches;
+	if (!neighbors_inputs(queries_obj, supports_obj, q_batches_obj, s_batches_obj,
+	                      queries, supports, q_batches, s_batches))
+		return NULL;
+
+	// Search without the GIL, so that other python threads keep running
+	vector<int> neighbors_indices;
+	Py_BEGIN_ALLOW_THREADS
+	batch_nanoflann_knn(queries, supports, q_batches, s_batches, neighbors_indices, k, num_threads);
+	Py_END_ALLOW_THREADS
+
+	return indices_array(neighbors_indices, queries.size());
+}
+
+
+static PyObject *batch_subsampling(PyObject *self, PyObject *args, PyObject *keywds)
+{
+	// Args containers
+	PyObject *points_obj = NULL;
+	PyObject *batches_obj = NULL;
+
+	// Keywords containers
+	static char *kwlist[] = {"points", "batches", "sampleDl", "num_threads", NULL };
+	float sampleDl = 0.1;
+	int num_threads = 1;
+
+	// Parse the input
+	if (!PyArg_ParseTupleAndKeywords(args, keywds, "OOf|i", kwlist, &points_obj, &batches_obj, &sampleDl,
+	                                 &num_threads))
+	{
+		PyErr_SetString(PyExc_RuntimeError, "Error parsing arguments");
+		return NULL;
+	}
+
+	PyArrayObject *points_array = points_from_object(points_obj, "points");
+	if (points_array == NULL)
+		return NULL;
+	PyArrayObject *batches_array = batches_from_object(batches_obj, "batches", PyArray_DIM(points_array, 0));
+	if (batches_array == NULL)
+	{
+		Py_DECREF(points_array);
+		return NULL;
+	}
+
+	vector<PointXYZ> original_points = points_vector(points_array);
+	vector<int> original_batches = batches_vector(batches_array);
+	Py_DECREF(points_array);
+	Py_DECREF(batches_array);
+
+	// Subsample without the GIL, so that other python threads keep running
+	vector<PointXYZ> subsampled_points;
+	vector<int> subsampled_batches;
+	vector<int> voxel_indices;
+	Py_BEGIN_ALLOW_THREADS
+	batch_grid_subsampling(original_points,
+	                       subsampled_points,
+	                       original_batches,
+	                       subsampled_batches,
+	                       voxel_indices,
+	                       sampleDl,
+	                       num_threads);
+	Py_END_ALLOW_THREADS
+
+	// Manage outputs
+	// **************
+
+	npy_intp point_dims[2] = {(npy_intp)subsampled_points.size(), 3};
+	npy_intp batch_dims[1] = {(npy_intp)subsampled_batches.size()};
+	npy_intp voxel_dims[1] = {(npy_intp)voxel_indices.size()};
+
+	PyObject *res_points_obj = PyArray_SimpleNew(2, point_dims, NPY_FLOAT);
+	PyObject *res_batches_obj = PyArray_SimpleNew(1, batch_dims, NPY_INT);
+	PyObject *res_voxels_obj = PyArray_SimpleNew(1, voxel_dims, NPY_INT);
+
+	memcpy(PyArray_DATA((PyArrayObject*)res_points_obj), subsampled_points.data(),
+	       subsampled_points.size() * 3 * sizeof(float));
+	memcpy(PyArray_DATA((PyArrayObject*)res_batches_obj), subsampled_batches.data(),
+	       subsampled_batches.size() * sizeof(int));
+	memcpy(PyArray_DATA((PyArrayObject*)res_voxels_obj), voxel_indices.data(), voxel_indices.size() * sizeof(int));
+
+	return Py_BuildValue("NNN", res_points_obj, res_batches_obj, res_voxels_obj);
+}
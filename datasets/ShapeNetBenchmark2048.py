@@ -14,7 +14,7 @@ except ImportError:
 from utils.ply import read_ply, write_ply
 
 # OS functions
-from os import makedirs, listdir
+from os import makedirs, listdir, replace, getpid
 from os.path import exists, join, isfile, isdir, realpath, dirname
 
 # Dataset parent class
@@ -24,6 +24,7 @@ from datasets.common import Dataset
 import cpp_wrappers.cpp_subsampling.grid_subsampling as cpp_subsampling
 
 from utils.data import load_csv, load_h5, pad_cloudN
+from utils.manifest import BuildManifest
 
 from matplotlib import pyplot as plt
 import matplotlib
@@ -185,53 +186,128 @@ class ShapeNetBenchmark2048Dataset(Dataset):
             # Load wanted points if possible
             print('\nLoading %s points' % split_type)
             filename = join(self.dataset_path, '{0:s}_{1:.3f}_record.pkl'.format(split_type, subsampling_parameter))
+            manifest = BuildManifest(filename[:-4] + '_manifest.json', {'subsampling_dl': subsampling_parameter})
 
+            cached = {}
             if exists(filename):
                 with open(filename, 'rb') as file:
-                    self.partial_points[split_type], \
-                    self.complete_points[split_type], \
-                    self.ids[split_type] = pickle.load(file)
+                    cached_data = pickle.load(file)
+                cached = {meta[0]: (partial, complete, meta) for partial, complete, meta in zip(*cached_data)}
 
-            # Else compute them from original points
+            if split_type == 'train':
+                paths = self.train_data_paths
+            elif split_type == 'valid':
+                paths = self.val_data_paths
             else:
-                if split_type == 'train':
-                    paths = self.train_data_paths
-                elif split_type == 'valid':
-                    paths = self.val_data_paths
+                paths = self.test_data_paths
+
+            # Only models that are missing from the pickle or whose files changed are computed from original points
+            n_updated = 0
+            for file_iter, file_path in enumerate(paths):
+                cloud_id = '{}.{:d}'.format('/'.join(file_path.split('/')[-2:]), 0)
+                sources = [file_path] if split_type == 'test' else [file_path, file_path.replace('partial', 'gt')]
+
+                # Pickles saved before manifests existed are trusted like before
+                if cloud_id in cached and not manifest.exists:
+                    manifest.record(cloud_id, sources)
+
+                if cloud_id in cached and manifest.is_current(cloud_id, sources):
+                    partial, complete, meta = cached[cloud_id]
+                    self.partial_points[split_type] += [partial]
+                    self.complete_points[split_type] += [complete]
+                    self.ids[split_type] += [meta]
+                    continue
+
+                # Call loading functions
+                data = self.load_data(file_path, split_type)
+                n_updated += 1
+
+                if subsampling_parameter > 0:
+                    sub_partial_points = grid_subsampling(data[2].astype(np.float32),
+                                                          sampleDl=subsampling_parameter)
+                    # padded_sub_partial = pad_cloudN(sub_partial_points, self.input_pts)
+                    self.partial_points[split_type] += [sub_partial_points]
+                    self.complete_points[split_type] += [data[0]]
+                    self.ids[split_type] += [data[1]]
+                    # plot_pcds(None, [data[2], sub_partial_points], ['partial', 'gt'], use_color=[0, 0], color=[None, None])
+
                 else:
-                    paths = self.test_data_paths
-
-                for file_iter, file_path in enumerate(paths):
-                    # Call loading functions
-                    data = self.load_data(file_path, split_type)
-
-                    if subsampling_parameter > 0:
-                        sub_partial_points = grid_subsampling(data[2].astype(np.float32),
-                                                              sampleDl=subsampling_parameter)
-                        # padded_sub_partial = pad_cloudN(sub_partial_points, self.input_pts)
-                        self.partial_points[split_type] += [sub_partial_points]
-                        self.complete_points[split_type] += [data[0]]
-                        self.ids[split_type] += [data[1]]
-                        # plot_pcds(None, [data[2], sub_partial_points], ['partial', 'gt'], use_color=[0, 0], color=[None, None])
-
-                    else:
-                        # padded_partial = pad_cloudN(data[2], self.input_pts)
-                        self.partial_points[split_type] += [data[2]]
-                        self.complete_points[split_type] += [data[0]]
-                        self.ids[split_type] += [data[1]]
-                        # plot_pcds(None, [data[2], data[0]], ['partial', 'gt'], use_color=[0, 0], color=[None, None])
-
-                # Save split pickle for later use
-                with open(filename, 'wb') as file:
+                    # padded_partial = pad_cloudN(data[2], self.input_pts)
+                    self.partial_points[split_type] += [data[2]]
+                    self.complete_points[split_type] += [data[0]]
+                    self.ids[split_type] += [data[1]]
+                    # plot_pcds(None, [data[2], data[0]], ['partial', 'gt'], use_color=[0, 0], color=[None, None])
+
+                manifest.record(cloud_id, sources)
+
+            # Models that left the split are forgotten
+            current_ids = set([meta[0] for meta in self.ids[split_type]])
+            n_removed = len([cloud_id for cloud_id in cached if cloud_id not in current_ids])
+            for cloud_id in [k for k in manifest.entries if k not in current_ids]:
+                manifest.remove(cloud_id)
+
+            # Save split pickle for later use. Workers of a cluster load the clouds at the same time, each one writes its
+            # own temporary file and renames it, so that no process reads a partial pickle
+            if n_updated > 0 or n_removed > 0 or not exists(filename) or not manifest.exists:
+                tmp_filename = '{:s}.{:d}.tmp'.format(filename, getpid())
+                with open(tmp_filename, 'wb') as file:
                     pickle.dump((self.partial_points[split_type],
                                  self.complete_points[split_type],
                                  self.ids[split_type]), file)
+                replace(tmp_filename, filename)
+                manifest.save()
+                if cached:
+                    print('{:d} models updated, {:d} removed'.format(n_updated, n_removed))
+
+            # Files were only touched (e.g. copied), their new modification times spare hashing them at the next load
+            elif manifest.refreshed:
+                manifest.save()
 
             lengths = [p.shape[0] for p in self.partial_points[split_type]]
             lengths.extend([p.shape[0] for p in self.complete_points[split_type]])
             sizes = [l * 4 * 3 for l in lengths]
             print('{:.1f} MB loaded in {:.1f}s'.format(np.sum(sizes) * 1e-6, time.time() - t0))
 
+    def load_reference_clouds(self, split='valid', synsets=None):
+        """
+        Complete clouds of a split used as reference database by the minimal matching distance (MMD). Only the ground
+        truth files of the chosen categories are read, the database is saved in the dataset folder at the first call.
+        :param split: 'train' or 'valid' (test clouds have no ground truth)
+        :param synsets: list of synsets to keep (None for all categories), e.g. ['02958343'] for cars
+        :return: (M, num_points, 3) float32 array and list of the M cloud ids
+        """
+
+        if split == 'test':
+            raise ValueError('The test split has no ground truth to use as reference')
+
+        name = '_'.join(sorted(synsets)) if synsets else 'all'
+        points_file = join(self.dataset_path, 'reference_{:s}_{:s}_points.npy'.format(split, name))
+        ids_file = join(self.dataset_path, 'reference_{:s}_{:s}_ids.txt'.format(split, name))
+
+        if exists(points_file) and exists(ids_file):
+            with open(ids_file, 'r') as f:
+                ids = f.read().splitlines()
+            return np.load(points_file), ids
+
+        t0 = time.time()
+        print('\nBuilding {:s} reference database of {:s} clouds'.format(split, name))
+        paths = self.train_data_paths if split == 'train' else self.val_data_paths
+        if synsets:
+            paths = [p for p in paths if p.split('/')[-2] in synsets]
+        if not paths:
+            raise ValueError('No {:s} cloud of synsets {:s}'.format(split, str(synsets)))
+
+        points = np.stack([load_h5(p.replace('partial', 'gt')) for p in paths]).astype(np.float32)
+        ids = ['{}.{:d}'.format('/'.join(p.split('/')[-2:]), 0) for p in paths]
+
+        np.save(points_file, points)
+        with open(ids_file, 'w') as f:
+            f.write('\n'.join(ids) + '\n')
+        print('{:d} clouds ({:.1f} MB) saved in {:.1f}s'.format(points.shape[0], points.nbytes * 1e-6,
+                                                                time.time() - t0))
+
+        return points, ids
+
     # Utility methods
     # ------------------------------------------------------------------------------------------------------------------
     def get_batch_gen(self, split, config):
@@ -268,20 +344,20 @@ class ShapeNetBenchmark2048Dataset(Dataset):
             # Initiate parameters depending on the chosen split
             if split == 'train':
                 if balanced:
-                    pick_n = int(np.ceil(self.num_train / self.num_classes))
+                    pick_n = int(np.ceil(self.num_train / self.num_shards / self.num_classes))
                     gen_indices = []
                     for l in self.label_values:
-                        label_inds = np.where(np.equal(self.input_labels[split], l))[0]
+                        label_inds = self.shard_indices(np.where(np.equal(self.input_labels[split], l))[0])
                         rand_inds = np.random.choice(label_inds, size=pick_n, replace=True)
                         gen_indices += [rand_inds]
                     gen_indices = np.random.permutation(np.hstack(gen_indices))
                 else:
-                    gen_indices = np.random.permutation(self.num_train)
+                    gen_indices = np.random.permutation(self.shard_indices(np.arange(self.num_train)))
 
             elif split == 'valid':
 
                 # Get indices with the minimum potential
-                val_num = min(self.num_test, config.validation_size * config.batch_num)
+                val_num = min(self.num_test, config.validation_size * config.batch_num // config.num_votes)
                 if val_num < self.potentials[split].shape[0]:
                     gen_indices = np.argpartition(self.potentials[split], val_num)[:val_num]
                 else:
@@ -293,7 +369,7 @@ class ShapeNetBenchmark2048Dataset(Dataset):
             elif split == 'test':
 
                 # Get indices with the minimum potential
-                val_num = min(self.num_test, config.validation_size * config.batch_num)
+                val_num = min(self.num_test, config.validation_size * config.batch_num // config.num_votes)
                 if val_num < self.potentials[split].shape[0]:
                     gen_indices = np.argpartition(self.potentials[split], val_num)[:val_num]
                 else:
@@ -305,6 +381,10 @@ class ShapeNetBenchmark2048Dataset(Dataset):
             else:
                 raise ValueError('Wrong split argument in data generator: ' + split)
 
+            # Test time votes, consecutive copies of each cloud that tf_map augments independently
+            if split != 'train' and config.num_votes > 1:
+                gen_indices = np.repeat(gen_indices, config.num_votes)
+
             # Generator loop
             for p_i in gen_indices:
 
@@ -358,20 +438,20 @@ class ShapeNetBenchmark2048Dataset(Dataset):
             # Initiate parameters depending on the chosen split
             if split == 'train':
                 if balanced:
-                    pick_n = int(np.ceil(self.num_train / self.num_classes))
+                    pick_n = int(np.ceil(self.num_train / self.num_shards / self.num_classes))
                     gen_indices = []
                     for l in self.label_values:
-                        label_inds = np.where(np.equal(self.input_labels[split], l))[0]
+                        label_inds = self.shard_indices(np.where(np.equal(self.input_labels[split], l))[0])
                         rand_inds = np.random.choice(label_inds, size=pick_n, replace=True)
                         gen_indices += [rand_inds]
                     gen_indices = np.random.permutation(np.hstack(gen_indices))
                 else:
-                    gen_indices = np.random.permutation(self.num_train)
+                    gen_indices = np.random.permutation(self.shard_indices(np.arange(self.num_train)))
 
             elif split == 'valid':
 
                 # Get indices with the minimum potential
-                val_num = min(self.num_test, config.validation_size * config.batch_num)
+                val_num = min(self.num_test, config.validation_size * config.batch_num // config.num_votes)
                 if val_num < self.potentials[split].shape[0]:
                     gen_indices = np.argpartition(self.potentials[split], val_num)[:val_num]
                 else:
@@ -383,7 +463,7 @@ class ShapeNetBenchmark2048Dataset(Dataset):
             elif split == 'test':
 
                 # Get indices with the minimum potential
-                val_num = min(self.num_test, config.validation_size * config.batch_num)
+                val_num = min(self.num_test, config.validation_size * config.batch_num // config.num_votes)
                 if val_num < self.potentials[split].shape[0]:
                     gen_indices = np.argpartition(self.potentials[split], val_num)[:val_num]
                 else:
@@ -395,6 +475,10 @@ class ShapeNetBenchmark2048Dataset(Dataset):
             else:
                 raise ValueError('Wrong split argument in data generator: ' + split)
 
+            # Test time votes, consecutive copies of each cloud that tf_map augments independently
+            if split != 'train' and config.num_votes > 1:
+                gen_indices = np.repeat(gen_indices, config.num_votes)
+
             # Generator loop
             for p_i in gen_indices:
 
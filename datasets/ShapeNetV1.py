@@ -11,7 +11,7 @@ except ImportError:
     from urllib import urlretrieve
 
 # PLY IO
-from utils.ply import read_ply, write_ply
+from utils.ply import read_ply, read_ply_batch, write_ply
 
 # OS functions
 from os import makedirs, listdir
@@ -203,11 +203,19 @@ class ShapeNetV1Dataset(Dataset):
                     model_list = file.read().splitlines()
                     file.close()
 
+                # Read all the ply files of the split concurrently
+                complete_files = [join(self.data_path, split_type, 'complete', cat_id, "%s.ply" % model_id)
+                                  for cat_id, model_id in [m.split('/') for m in model_list]]
+                partial_files = [join(self.data_path, split_type, 'partial', cat_model_id, "%s.ply" % s)
+                                 for cat_model_id in model_list for s in range(self.num_scans)]
+                complete_datas = read_ply_batch(complete_files, num_threads=self.num_threads)
+                partial_datas = read_ply_batch(partial_files, num_threads=self.num_threads)
+
                 for i, cat_model_id in enumerate(model_list):
                     cat_id, model_id = cat_model_id.split('/')
 
                     # Read complete ply data, if subsample param exists, save subsampled complete pc, else save original
-                    complete_data = read_ply(join(self.data_path, split_type, 'complete', cat_id, "%s.ply" % model_id))
+                    complete_data = complete_datas[i]
                     complete_points = np.vstack((complete_data['x'], complete_data['y'], complete_data['z'])).astype(
                         np.float32).T
 
@@ -217,8 +225,7 @@ class ShapeNetV1Dataset(Dataset):
 
                     # For each scan, read partial ply data, if subsample param exists, save subsampled partial pc
                     for s in range(self.num_scans):
-                        partial_data = read_ply(
-                            join(self.data_path, split_type, 'partial', cat_id, model_id, "%s.ply" % s))
+                        partial_data = partial_datas[i * self.num_scans + s]
                         partial_points = np.vstack((partial_data['x'], partial_data['y'], partial_data['z'])).astype(
                             np.float32).T
 
@@ -297,7 +304,7 @@ class ShapeNetV1Dataset(Dataset):
             elif split == 'valid':
 
                 # Get indices with the minimum potential
-                val_num = min(self.num_test, config.validation_size * config.batch_num)
+                val_num = min(self.num_test, config.validation_size * config.batch_num // config.num_votes)
                 if val_num < self.potentials[split].shape[0]:
                     gen_indices = np.argpartition(self.potentials[split], val_num)[:val_num]
                 else:
@@ -309,7 +316,7 @@ class ShapeNetV1Dataset(Dataset):
             elif split == 'test':
 
                 # Get indices with the minimum potential
-                val_num = min(self.num_test, config.validation_size * config.batch_num)
+                val_num = min(self.num_test, config.validation_size * config.batch_num // config.num_votes)
                 if val_num < self.potentials[split].shape[0]:
                     gen_indices = np.argpartition(self.potentials[split], val_num)[:val_num]
                 else:
@@ -321,6 +328,10 @@ class ShapeNetV1Dataset(Dataset):
             else:
                 raise ValueError('Wrong split argument in data generator: ' + split)
 
+            # Test time votes, consecutive copies of each cloud that tf_map augments independently
+            if split != 'train' and config.num_votes > 1:
+                gen_indices = np.repeat(gen_indices, config.num_votes)
+
             # Generator loop
             for p_i in gen_indices:
 
@@ -387,7 +398,7 @@ class ShapeNetV1Dataset(Dataset):
             elif split == 'valid':
 
                 # Get indices with the minimum potential
-                val_num = min(self.num_test, config.validation_size * config.batch_num)
+                val_num = min(self.num_test, config.validation_size * config.batch_num // config.num_votes)
                 if val_num < self.potentials[split].shape[0]:
                     gen_indices = np.argpartition(self.potentials[split], val_num)[:val_num]
                 else:
@@ -399,7 +410,7 @@ class ShapeNetV1Dataset(Dataset):
             elif split == 'test':
 
                 # Get indices with the minimum potential
-                val_num = min(self.num_test, config.validation_size * config.batch_num)
+                val_num = min(self.num_test, config.validation_size * config.batch_num // config.num_votes)
                 if val_num < self.potentials[split].shape[0]:
                     gen_indices = np.argpartition(self.potentials[split], val_num)[:val_num]
                 else:
@@ -411,6 +422,10 @@ class ShapeNetV1Dataset(Dataset):
             else:
                 raise ValueError('Wrong split argument in data generator: ' + split)
 
+            # Test time votes, consecutive copies of each cloud that tf_map augments independently
+            if split != 'train' and config.num_votes > 1:
+                gen_indices = np.repeat(gen_indices, config.num_votes)
+
             # Generator loop
             for p_i in gen_indices:
 
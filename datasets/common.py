@@ -48,12 +48,100 @@ def grid_subsampling(points, features=None, labels=None, sampleDl=0.1, verbose=0
         return cpp_subsampling.compute(points, features=features, classes=labels, sampleDl=sampleDl, verbose=verbose)
 
 
-def tf_batch_subsampling(points, batches_len, sampleDl):
-    return tf_batch_subsampling_module.batch_grid_subsampling(points, batches_len, sampleDl)
+def batch_grid_subsampling(points, batches_len, sampleDl=0.1, num_threads=1):
+    """
+    CPP wrapper for the grid subsampling of each element of a stacked batch (same kernel as tf_batch_subsampling)
+    :param points: (N, 3) matrix of stacked points
+    :param batches_len: (B,) number of points of each batch element
+    :param sampleDl: parameter defining the size of grid voxels
+    :param num_threads: number of threads subsampling the batch elements
+    :return: (M, 3) subsampled points, (B,) their batch lengths and (N,) index of the subsampled point of each point
+    """
+    # Imported on use, datasets that do not call the batch wrappers do not need the extension to be compiled
+    import cpp_wrappers.cpp_batch_ops.batch_ops as cpp_batch_ops
+    return cpp_batch_ops.batch_subsampling(points, batches_len, sampleDl=sampleDl, num_threads=num_threads)
+
+
+def batch_neighbors(queries, supports, q_batches, s_batches, radius, max_neighbors=0, num_threads=1):
+    """
+    CPP wrapper for the radius neighbors of a stacked batch (same kernel as tf_batch_neighbors)
+    :param queries: (N1, 3) matrix of stacked query points
+    :param supports: (N2, 3) matrix of stacked support points
+    :param q_batches: (B,) number of queries of each batch element
+    :param s_batches: (B,) number of supports of each batch element
+    :param radius: radius of the neighborhoods
+    :param max_neighbors: only keep the closest neighbors (0 for no limit)
+    :param num_threads: number of threads of the search
+    :return: (N1, max_count) neighbors indices sorted by distance, padded with N2
+    """
+    import cpp_wrappers.cpp_batch_ops.batch_ops as cpp_batch_ops
+    return cpp_batch_ops.batch_neighbors(queries, supports, q_batches, s_batches, radius,
+                                         max_neighbors=int(max_neighbors), num_threads=num_threads)
+
+
+def batch_knn(queries, supports, q_batches, s_batches, k, num_threads=1):
+    """
+    CPP wrapper for the k nearest neighbors of a stacked batch
+    :param k: number of neighbors
+    :return: (N1, k) neighbors indices sorted by distance, padded with N2 for elements with less than k supports
+    """
+    import cpp_wrappers.cpp_batch_ops.batch_ops as cpp_batch_ops
+    return cpp_batch_ops.batch_knn(queries, supports, q_batches, s_batches, int(k), num_threads=num_threads)
+
+
+def tf_batch_subsampling(points, batches_len, sampleDl, return_voxels=False, num_threads=0):
+    """
+    Grid subsampling of each batch element (barycenters of the points of each voxel)
+    :param return_voxels: also return the (N,) index of the subsampled point of each original point
+    :param num_threads: threads of the subsampling (0 to run on the intra op thread pool)
+    """
+    pool_p, pool_b, voxels = tf_batch_subsampling_module.batch_grid_subsampling(points, batches_len, sampleDl,
+                                                                               num_threads=num_threads)
+    if return_voxels:
+        return pool_p, pool_b, voxels
+    return pool_p, pool_b
+
+
+def tf_voxel_pools(voxels, num_voxels, max_neighbors=0):
+    """
+    Pooling indices given by a grid subsampling: the original points of each voxel, in their original order, padded
+    with the shadow index N (number of original points)
+    :param voxels: (N,) index of the subsampled point of each original point
+    :param num_voxels: number of subsampled points
+    :param max_neighbors: only keep the first points of each voxel (0 for no limit)
+    :return: (num_voxels, max_count) matrix of indices
+    """
+    N = tf.shape(voxels)[0]
+
+    # Points grouped by voxel (top_k keeps the lower index first for equal values)
+    _, order = tf.nn.top_k(-voxels, k=N)
+    sorted_voxels = tf.gather(voxels, order)
+
+    # Column of each point in the row of its voxel
+    counts = tf.unsorted_segment_sum(tf.ones_like(voxels), voxels, num_voxels)
+    starts = tf.cumsum(counts, exclusive=True)
+    columns = tf.range(N) - tf.gather(starts, sorted_voxels)
 
+    width = tf.maximum(tf.reduce_max(counts), 1)
+    if max_neighbors > 0:
+        width = tf.minimum(width, int(max_neighbors))
+    kept = columns < width
 
-def tf_batch_neighbors(queries, supports, q_batches, s_batches, radius):
-    return tf_batch_neighbors_module.batch_ordered_neighbors(queries, supports, q_batches, s_batches, radius)
+    # Scatter shifted indices so that empty cells end up with the shadow index
+    indices = tf.stack([tf.boolean_mask(sorted_voxels, kept), tf.boolean_mask(columns, kept)], axis=1)
+    shifted = tf.boolean_mask(order, kept) - N
+    return tf.scatter_nd(indices, shifted, tf.stack([num_voxels, width])) + N
+
+
+def tf_batch_neighbors(queries, supports, q_batches, s_batches, radius, max_neighbors=0, num_threads=0):
+    """
+    Radius neighbors of the queries among the supports of the same batch element, sorted by distance
+    :param max_neighbors: only keep the closest neighbors, the matrix has at most max_neighbors columns (0 for no limit)
+    :param num_threads: threads of the search (0 to run on the intra op thread pool)
+    """
+    return tf_batch_neighbors_module.batch_ordered_neighbors(queries, supports, q_batches, s_batches, radius,
+                                                             max_neighbors=int(max_neighbors),
+                                                             num_threads=num_threads)
 
 
 # ----------------------------------------------------------------------------------------------------------------------
@@ -117,6 +205,13 @@ class Dataset:
         # Number of threads used in input pipeline
         self.num_threads = 1
 
+        # Shard of the training split used by this process in data parallel training
+        self.num_shards = 1
+        self.shard_index = 0
+
+        # Seed of numpy and of the tensorflow graph built by the input pipelines (None for random runs)
+        self.random_seed = None
+
     def init_synsets(self):
         # Initiate all synset parameters given the synset_to_category dict
         self.num_categories = len(self.synset_to_category)
@@ -125,6 +220,14 @@ class Dataset:
         self.synset_to_idx = {l: i for i, l in enumerate(self.synset_values)}
         self.category_to_synset = {v: k for k, v in self.synset_to_category.items()}
 
+    def shard_indices(self, indices):
+        """
+        Training indices of this process in data parallel training. Shards are truncated to the same length, so that
+        every worker gets the same number of clouds
+        """
+        shard_n = len(indices) // self.num_shards
+        return indices[self.shard_index:shard_n * self.num_shards:self.num_shards]
+
     # Data augmentation methods
     # ------------------------------------------------------------------------------------------------------------------
 
@@ -203,7 +306,8 @@ class Dataset:
     def big_neighborhood_filter(self, neighbors, layer):
         """
         Filter neighborhoods with max number of neighbors. Limit is set to keep XX% of the neighborhoods untouched.
-        Limit is computed at initialization
+        Limit is computed at initialization. Neighbors computed by tf_batch_neighbors with max_neighbors are already
+        limited, this crop is only needed for other neighbor matrices.
         """
 
         # crop neighbors matrix
@@ -326,20 +430,8 @@ class Dataset:
         # Update network model in config from ds
         config.network_model = self.network_model
 
-        # Calibrate generators to batch_num or use static batch limit
-        if config.per_cloud_batch:
-            self.batch_limit = config.batch_num
-        else:
-            self.batch_limit = self.calibrate_batches(config)
-
-        # From config parameter, compute higher bound of neighbors number in a neighborhood
-        hist_n = int(np.ceil(4 / 3 * np.pi * (config.density_parameter + 1) ** 3))
-
-        # Initiate neighbors limit with higher bound
-        self.neighborhood_limits = np.full(config.num_layers, hist_n, dtype=np.int32)
-
-        # Calibrate max neighbors number for each layer
-        self.calibrate_neighbors(config)
+        # Calibrate batch and neighbors limits (or reuse the calibration of the config)
+        self.calibrate_pipeline(config)
 
         ################################
         # Initiate tensorflow parameters
@@ -348,9 +440,10 @@ class Dataset:
         # Reset graph
         tf.reset_default_graph()
 
-        # Set random seed (You also have to set it in network_architectures.weight_variable)
-        # np.random.seed(42)
-        # tf.set_random_seed(42)
+        # Set random seed, the graph seed also fixes the initial weights of a model built on this graph
+        if self.random_seed is not None:
+            np.random.seed(self.random_seed)
+            tf.set_random_seed(self.random_seed)
 
         # Get generator and mapping function
         gen_function, gen_types, gen_shapes = self.get_batch_gen('train', config)
@@ -383,6 +476,10 @@ class Dataset:
         # Transform inputs
         self.val_data = self.val_data.map(map_func=map_func, num_parallel_calls=self.num_threads)
 
+        # Keep mapped inputs in memory, next validations do not run the generator and neighbor searches again
+        if config.cache_validation:
+            self.val_data = self.val_data.cache()
+
         # Prefetch data
         self.val_data = self.val_data.prefetch(10)
 
@@ -416,20 +513,8 @@ class Dataset:
         # Update network model in config
         config.network_model = self.network_model
 
-        # Calibrate generators to batch_num or use static batch limit
-        if config.per_cloud_batch:
-            self.batch_limit = config.batch_num
-        else:
-            self.batch_limit = self.calibrate_batches(config)
-
-        # From config parameter, compute higher bound of neighbors number in a neighborhood
-        hist_n = int(np.ceil(4 / 3 * np.pi * (config.density_parameter + 1) ** 3))
-
-        # Initiate neighbors limit with higher bound
-        self.neighborhood_limits = np.full(config.num_layers, hist_n, dtype=np.int32)
-
-        # Calibrate max neighbors number
-        self.calibrate_neighbors(config)
+        # Calibrate batch and neighbors limits (or reuse the calibration of the config)
+        self.calibrate_pipeline(config)
 
         ################################
         # Initiate tensorflow parameters
@@ -438,9 +523,10 @@ class Dataset:
         # Reset graph
         tf.reset_default_graph()
 
-        # Set random seed (You also have to set it in network_architectures.weight_variable)
-        # np.random.seed(42)
-        # tf.set_random_seed(42)
+        # Set random seed, the graph seed also fixes the initial weights of a model built on this graph
+        if self.random_seed is not None:
+            np.random.seed(self.random_seed)
+            tf.set_random_seed(self.random_seed)
 
         # Get generator and mapping function
         gen_function, gen_types, gen_shapes = self.get_batch_gen('test', config)
@@ -471,6 +557,53 @@ class Dataset:
         # create the initialisation operations
         self.test_init_op = iter.make_initializer(self.test_data)
 
+    def calibration_key(self, config):
+        """
+        Parameters a calibration depends on, it is only reused when they are all the same
+        """
+        return {'dataset': type(self).__name__,
+                'batch_num': config.batch_num,
+                'per_cloud_batch': config.per_cloud_batch,
+                'num_input_points': config.num_input_points,
+                'architecture': list(config.architecture),
+                'first_subsampling_dl': config.first_subsampling_dl,
+                'density_parameter': config.density_parameter,
+                'KP_extent': config.KP_extent,
+                'voxel_pooling': config.voxel_pooling}
+
+    def calibrate_pipeline(self, config):
+        """
+        Batch limit and neighborhood limits of the input pipeline. They are taken from the config if it was calibrated
+        with the same parameters (e.g. loaded from the log of a previous run), else calibrated and stored in the config
+        """
+
+        key = self.calibration_key(config)
+        if config.calibration_key == key and config.neighborhood_limits is not None:
+            self.batch_limit = config.batch_limit
+            self.neighborhood_limits = np.array(config.neighborhood_limits, dtype=np.int32)
+            print('Batch and neighbors limits loaded from the config')
+            return
+
+        # Calibrate generators to batch_num or use static batch limit
+        if config.per_cloud_batch:
+            self.batch_limit = config.batch_num
+        else:
+            self.batch_limit = self.calibrate_batches(config)
+
+        # From config parameter, compute higher bound of neighbors number in a neighborhood
+        hist_n = int(np.ceil(4 / 3 * np.pi * (config.density_parameter + 1) ** 3))
+
+        # Initiate neighbors limit with higher bound
+        self.neighborhood_limits = np.full(config.num_layers, hist_n, dtype=np.int32)
+
+        # Calibrate max neighbors number for each layer
+        self.calibrate_neighbors(config)
+
+        # Saved with the parameters of the run
+        config.batch_limit = self.batch_limit
+        config.neighborhood_limits = self.neighborhood_limits
+        config.calibration_key = key
+
     def calibrate_batches(self, config):
         if 'cloud' in self.network_model:
             if len(self.input_trees['train']) > 0:
@@ -689,7 +822,9 @@ class Dataset:
                     r = r_normal * config.density_parameter / (config.KP_extent * 2.5)
                 else:
                     r = r_normal
-                conv_i = tf_batch_neighbors(stacked_points, stacked_points, stacks_lengths, stacks_lengths, r)
+                conv_i = tf_batch_neighbors(stacked_points, stacked_points, stacks_lengths, stacks_lengths, r,
+                                            max_neighbors=self.neighborhood_limits[len(input_points)],
+                                            num_threads=config.neighbors_threads)
             else:
                 # This layer only perform pooling, no neighbors required
                 conv_i = tf.zeros((0, 1), dtype=tf.int32)
@@ -702,7 +837,9 @@ class Dataset:
                 dl = 2 * r_normal / (config.KP_extent * 2.5)
 
                 # Subsampled points
-                pool_p, pool_b = tf_batch_subsampling(stacked_points, stacks_lengths, sampleDl=dl)
+                pool_p, pool_b, voxels = tf_batch_subsampling(stacked_points, stacks_lengths, sampleDl=dl,
+                                                              return_voxels=True,
+                                                              num_threads=config.neighbors_threads)
 
                 # Radius of pooled neighbors
                 if 'deformable' in block:
@@ -710,11 +847,25 @@ class Dataset:
                 else:
                     r = r_normal
 
-                # Subsample indices (get closest un-pooled neighbors indices for each pooled point)
-                pool_i = tf_batch_neighbors(pool_p, stacked_points, pool_b, stacks_lengths, r)
-
-                # Upsample indices (with the radius of the next layer to keep wanted density)
-                up_i = tf_batch_neighbors(stacked_points, pool_p, stacks_lengths, pool_b, 2 * r)
+                if config.voxel_pooling and 'strided' not in block:
+                    # Max pooling over the points of each voxel, this avoids a radius search
+                    pool_i = tf_voxel_pools(voxels, tf.shape(pool_p)[0],
+                                            max_neighbors=self.neighborhood_limits[len(input_points)])
+                else:
+                    # Subsample indices (get closest un-pooled neighbors indices for each pooled point). Strided
+                    # convolutions use them as the neighborhood of their kernel, so they always come from a radius
+                    pool_i = tf_batch_neighbors(pool_p, stacked_points, pool_b, stacks_lengths, r,
+                                                max_neighbors=self.neighborhood_limits[len(input_points)],
+                                                num_threads=config.neighbors_threads)
+
+                if config.voxel_pooling:
+                    # Upsample from the voxel of each point, this avoids a radius search
+                    up_i = tf.expand_dims(voxels, 1)
+                else:
+                    # Upsample indices (with the radius of the next layer to keep wanted density)
+                    up_i = tf_batch_neighbors(stacked_points, pool_p, stacks_lengths, pool_b, 2 * r,
+                                              max_neighbors=self.neighborhood_limits[len(input_points)],
+                                              num_threads=config.neighbors_threads)
             else:
                 # No pooling in the end of this layer, no pooling indices required
                 pool_i = tf.zeros((0, 1), dtype=tf.int32)
@@ -722,11 +873,6 @@ class Dataset:
                 pool_b = tf.zeros((0,), dtype=tf.int32)
                 up_i = tf.zeros((0, 1), dtype=tf.int32)
 
-            # Reduce size of neighbors matrices by eliminating furthest point
-            conv_i = self.big_neighborhood_filter(conv_i, len(input_points))
-            pool_i = self.big_neighborhood_filter(pool_i, len(input_points))
-            up_i = self.big_neighborhood_filter(up_i, len(input_points))
-
             # Updating input lists
             input_points += [stacked_points]
             input_neighbors += [conv_i]
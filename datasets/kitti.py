@@ -3,6 +3,7 @@ import numpy as np
 import time
 import json
 import pickle
+import multiprocessing
 from sklearn.neighbors import KDTree
 import open3d as o3d
 
@@ -15,7 +16,7 @@ except ImportError:
 from utils.ply import read_ply, write_ply
 
 # OS functions
-from os import makedirs, listdir
+from os import makedirs, listdir, replace
 from os.path import exists, join, isfile, isdir, realpath, dirname
 
 # Dataset parent class
@@ -25,6 +26,7 @@ from datasets.common import Dataset
 import cpp_wrappers.cpp_subsampling.grid_subsampling as cpp_subsampling
 
 from utils.data import load_csv, load_h5, pad_cloudN
+from utils.bboxes import BboxTable, normalize_points
 
 from matplotlib import pyplot as plt
 import matplotlib
@@ -59,6 +61,24 @@ def grid_subsampling(points, features=None, labels=None, sampleDl=0.1, verbose=0
         return cpp_subsampling.compute(points, features=features, classes=labels, sampleDl=sampleDl, verbose=verbose)
 
 
+def ingest_car(job):
+    """
+    Read, normalize, subsample and pad one car (run by the processes of KittiDataset.load_subsampled_clouds)
+    :param job: (car index, pcd path, (center, rotation, scale) of its bbox, subsampling_parameter, input_pts)
+    :return: car index, (input_pts, 3) float32 normalized points
+    """
+    car_i, pcd_path, transform, subsampling_parameter, input_pts = job
+
+    # Padding picks random points, seed with the car index so that rebuilds are identical
+    np.random.seed(car_i)
+
+    partial = normalize_points(np.array(o3d.io.read_point_cloud(pcd_path).points), *transform)
+    if subsampling_parameter > 0:
+        partial = grid_subsampling(partial.astype(np.float32), sampleDl=subsampling_parameter)
+
+    return car_i, pad_cloudN(partial, input_pts)
+
+
 # ----------------------------------------------------------------------------------------------------------------------
 #
 #           Class Definition
@@ -122,7 +142,12 @@ class KittiDataset(Dataset):
         self.bbox_dir = join(self.dataset_path, 'bboxes')
         self.tracklets_dir = join(self.dataset_path, 'tracklets')
 
-        self.num_cars = 2401  # TODO: fix hardcoded value
+        # Center, yaw and scale of every car (computed once and cached in the dataset folder)
+        self.bboxes = BboxTable(self.bbox_dir)
+
+        # Cars of the dataset
+        self.car_files = sorted([f for f in listdir(self.pcd_dir) if f.endswith('.pcd')])
+        self.num_cars = len(self.car_files)
 
     def load_cloud(self, fname):
         pcd = o3d.io.read_point_cloud(join(self.pcd_dir, fname))
@@ -132,7 +157,8 @@ class KittiDataset(Dataset):
 
     def load_subsampled_clouds(self, subsampling_parameter):
         """
-        Presubsample point clouds and load into memory
+        Presubsample point clouds and load into memory. Normalized clouds are stored in a [num_cars, input_pts, 3]
+        array file which is memory mapped, with the car ids in a text file next to it.
         """
 
         if 0 < subsampling_parameter <= 0.01:
@@ -148,57 +174,60 @@ class KittiDataset(Dataset):
 
         # Load wanted points if possible
         print('\nLoading %s points' % split_type)
-        filename = join(self.pickle_path, '{0:s}_{1:.3f}_record.pkl'.format('test_kitti', subsampling_parameter))
-
-        if exists(filename):
-            with open(filename, 'rb') as file:
-                self.partial_points[split_type], \
-                self.ids[split_type] = pickle.load(file)
+        points_file = join(self.pickle_path, '{0:s}_{1:.3f}_points.npy'.format('test_kitti', subsampling_parameter))
+        ids_file = join(self.pickle_path, '{0:s}_{1:.3f}_ids.txt'.format('test_kitti', subsampling_parameter))
 
         # Else compute them from original points
-        else:
-            print('Recomputing test_kitti pkl file')
-            for file_iter, file_path in enumerate([f for f in listdir(self.pcd_dir) if f.endswith('.pcd')]):
-                print('Car {}/{}'.format(file_iter, self.num_cars))
-                # Call loading functions
-                data = self.load_cloud(file_path)
-                bbox = np.loadtxt(join(self.bbox_dir, '%s.txt' % file_path.split('.')[0]))
-
-                # Normalize clouds, calculate center, rotation and scale
-                center = (bbox.min(0) + bbox.max(0)) / 2
-                bbox -= center
-                yaw = np.arctan2(bbox[3, 1] - bbox[0, 1], bbox[3, 0] - bbox[0, 0])
-                rotation = np.array([[np.cos(yaw), -np.sin(yaw), 0],
-                                     [np.sin(yaw), np.cos(yaw), 0],
-                                     [0, 0, 1]])
-                bbox = np.dot(bbox, rotation)
-                scale = bbox[3, 0] - bbox[0, 0]
-                bbox /= scale
-
-                partial = np.dot(data[0] - center, rotation) / scale
-                partial = np.dot(partial, [[1, 0, 0], [0, 0, 1], [0, 1, 0]])
-
-                if subsampling_parameter > 0:
-                    sub_partial_points = grid_subsampling(partial.astype(np.float32),
-                                                          sampleDl=subsampling_parameter)
-                    padded_sub_partial = pad_cloudN(sub_partial_points, self.input_pts)
-                    self.partial_points[split_type] += [padded_sub_partial]
-                    self.ids[split_type] += [data[1]]
-                    # plot_pcds(None, [partial], ['partial'], use_color=[0], color=[None])
-                else:
-                    padded_partial = pad_cloudN(partial, self.input_pts)
-                    self.partial_points[split_type] += [padded_partial]
-                    self.ids[split_type] += [data[1]]
-                    # plot_pcds(None, [partial, padded_partial], ['partial', 'padded'], use_color=[0, 0], color=[None, None])
-
-            # Save split pickle for later use
-            with open(filename, 'wb') as file:
-                pickle.dump((self.partial_points[split_type],
-                             self.ids[split_type]), file)
-
-            lengths = [p.shape[0] for p in self.partial_points[split_type]]
-            sizes = [l * 4 * 3 for l in lengths]
-            print('{:.1f} MB loaded in {:.1f}s'.format(np.sum(sizes) * 1e-6, time.time() - t0))
+        if not (exists(points_file) and exists(ids_file)):
+            print('Recomputing test_kitti clouds')
+            self.ingest_clouds(subsampling_parameter, points_file, ids_file)
+
+        self.partial_points[split_type] = np.load(points_file, mmap_mode='r')
+        with open(ids_file, 'r') as f:
+            self.ids[split_type] = f.read().splitlines()
+
+        if len(self.ids[split_type]) != self.num_cars:
+            raise ValueError('{:s} contains {:d} cars but {:s} contains {:d}, delete the outdated files'.format(
+                points_file, len(self.ids[split_type]), self.pcd_dir, self.num_cars))
+
+        size = self.partial_points[split_type].nbytes
+        print('{:.1f} MB loaded in {:.1f}s'.format(size * 1e-6, time.time() - t0))
+
+    def ingest_clouds(self, subsampling_parameter, points_file, ids_file):
+        """
+        Normalize, subsample and pad all cars with a pool of processes and write them in points_file and ids_file
+        """
+
+        # Write in temporary files so that an interrupted ingestion does not leave a partial cache
+        tmp_points_file = points_file[:-4] + '_tmp.npy'
+        all_points = np.lib.format.open_memmap(tmp_points_file,
+                                               mode='w+',
+                                               dtype=np.float32,
+                                               shape=(self.num_cars, self.input_pts, 3))
+
+        jobs = []
+        for car_i, file_path in enumerate(self.car_files):
+            car_id = file_path.split('.')[0]
+            jobs.append((car_i,
+                         join(self.pcd_dir, file_path),
+                         self.bboxes.transform(car_id),
+                         subsampling_parameter,
+                         self.input_pts))
+
+        last_display = time.time()
+        with multiprocessing.Pool(self.num_threads) as pool:
+            for done, (car_i, points) in enumerate(pool.imap_unordered(ingest_car, jobs, chunksize=16)):
+                all_points[car_i] = points
+                if time.time() - last_display > 1.0:
+                    last_display = time.time()
+                    print('Car {:d}/{:d}'.format(done + 1, self.num_cars))
+
+        all_points.flush()
+        del all_points
+        replace(tmp_points_file, points_file)
+
+        with open(ids_file, 'w') as f:
+            f.write('\n'.join(self.car_files) + '\n')
 
     # Utility methods
     # ------------------------------------------------------------------------------------------------------------------
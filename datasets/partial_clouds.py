@@ -0,0 +1,275 @@
+import tensorflow as tf
+import numpy as np
+import multiprocessing
+import open3d as o3d
+
+# PLY IO
+from utils.ply import read_ply
+
+# OS functions
+from os.path import splitext
+
+# Dataset parent class
+from datasets.common import Dataset, grid_subsampling
+
+from utils.data import load_h5, pad_cloudN
+
+
+# ----------------------------------------------------------------------------------------------------------------------
+#
+#           Utility functions
+#       \***********************/
+#
+
+# Formats of the partial clouds
+cloud_extensions = ['.ply', '.pcd', '.h5']
+
+
+def read_partial(path):
+    """
+    (N, 3) points of a PLY, PCD or H5 partial cloud
+    """
+    extension = splitext(path)[1].lower()
+    if extension == '.ply':
+        data = read_ply(path)
+        return np.vstack((data['x'], data['y'], data['z'])).T
+    elif extension == '.pcd':
+        return np.asarray(o3d.io.read_point_cloud(path).points)
+    elif extension == '.h5':
+        return load_h5(path)[:, :3]
+    else:
+        raise ValueError('Unsupported cloud format : ' + path)
+
+
+def ingest_partial(job):
+    """
+    Read, normalize, subsample and pad one cloud (run by the processes of PartialCloudsDataset)
+    :param job: (cloud index, path, normalize, subsampling_parameter, input_pts)
+    :return: cloud index, (input_pts, 3) float32 points, center and scale of the normalization, error message or None
+    """
+    cloud_i, path, normalize, subsampling_parameter, input_pts = job
+
+    # Padding picks random points, seed with the cloud index so that runs are identical
+    np.random.seed(cloud_i)
+
+    try:
+        points = read_partial(path).astype(np.float64)
+        if points.shape[0] == 0:
+            raise ValueError('empty cloud')
+
+        # Bounding box centered at the origin with a unit longest side
+        center = np.zeros(3)
+        scale = 1.0
+        if normalize:
+            mins = np.min(points, axis=0)
+            maxs = np.max(points, axis=0)
+            center = (mins + maxs) / 2
+            scale = max(np.max(maxs - mins), 1e-6)
+        points = (points - center) / scale
+
+        if subsampling_parameter > 0:
+            points = grid_subsampling(points.astype(np.float32), sampleDl=subsampling_parameter)
+
+        return cloud_i, pad_cloudN(points, input_pts), center, scale, None
+
+    except Exception as e:
+        return cloud_i, None, None, None, '{:s}: {:s}'.format(type(e).__name__, str(e))
+
+
+# ----------------------------------------------------------------------------------------------------------------------
+#
+#           Class Definition
+#       \**********************/
+#
+
+
+class PartialCloudsDataset(Dataset):
+    """
+    Partial clouds of any source, streamed from their files to a completion model. The clouds are read and prepared
+    by a pool of processes while the model completes the previous batches.
+    """
+
+    # Initiation methods
+    # ------------------------------------------------------------------------------------------------------------------
+
+    def __init__(self, files, batch_num, input_pts, normalize=False, subsampling_parameter=0, num_workers=8,
+                 input_threads=8):
+        """
+        Initiation method.
+        :param files: paths of the PLY, PCD or H5 partial clouds
+        :param normalize: center the bounding box of each cloud and scale its longest side to 1. Completions are
+                          brought back to the frame of their cloud
+        :param num_workers: number of processes reading and preparing the clouds
+        """
+        Dataset.__init__(self, 'partial_clouds')
+
+        self.synset_to_category = {}
+        self.init_synsets()
+
+        # List of classes ignored during training (can be empty)
+        self.ignored_labels = np.array([])
+
+        # Number of models
+        self.network_model = 'completion'
+
+        ##########################
+        # Parameters for the files
+        ##########################
+
+        self.files = list(files)
+        self.num_clouds = len(self.files)
+        self.partial_points = {}
+
+        self.batch_num = batch_num
+        self.input_pts = input_pts
+        self.normalize = normalize
+        self.subsampling_parameter = subsampling_parameter
+
+        # Number of threads
+        self.num_threads = input_threads
+
+        # Center and scale of the clouds waiting for their completion, and clouds that could not be read
+        self.transforms = {}
+        self.failed = []
+
+        # Processes are started before any tensorflow session, they are reused by every pass over the clouds
+        self.pool = multiprocessing.Pool(num_workers)
+
+    def close(self):
+        self.pool.close()
+        self.pool.join()
+
+    def denormalize(self, cloud_i, points):
+        """
+        Points of the normalized frame back to the frame of cloud cloud_i
+        """
+        center, scale = self.transforms.pop(cloud_i)
+        return points * scale + center
+
+    # Utility methods
+    # ------------------------------------------------------------------------------------------------------------------
+
+    def calibrate_pipeline(self, config):
+        """
+        Clouds are padded to config.num_input_points, so batches only depend on config.batch_num. The neighborhood
+        limits are the ones the model was trained with. Logs that did not save them are calibrated on the clouds
+        """
+
+        if config.per_cloud_batch:
+            self.batch_limit = config.batch_num
+        else:
+            self.batch_limit = config.batch_num * config.num_input_points
+
+        if config.neighborhood_limits is not None:
+            self.neighborhood_limits = np.array(config.neighborhood_limits, dtype=np.int32)
+            print('Neighbors limits loaded from the config')
+        else:
+            hist_n = int(np.ceil(4 / 3 * np.pi * (config.density_parameter + 1) ** 3))
+            self.neighborhood_limits = np.full(config.num_layers, hist_n, dtype=np.int32)
+            self.calibrate_neighbors(config)
+
+    def get_batch_gen(self, split, config):
+        """
+        A function defining the batch generator. Clouds are streamed in the order of the files
+        :param split: string, only "test" is defined
+        :param config: configuration file
+        :return: gen_func, gen_types, gen_shapes
+        """
+
+        if split != 'test':
+            raise ValueError('Wrong split argument in data generator: ' + split)
+
+        def streamed_gen():
+
+            # Initiate concatenation lists
+            tpp_list = []  # partial points
+            tid_list = []  # ids
+            ti_list = []  # cloud index
+            batch_n = 0
+
+            jobs = [(cloud_i, path, self.normalize, self.subsampling_parameter, self.input_pts)
+                    for cloud_i, path in enumerate(self.files)]
+            self.failed = []
+
+            # Generator loop
+            for cloud_i, points, center, scale, error in self.pool.imap(ingest_partial, jobs, chunksize=4):
+
+                if error is not None:
+                    self.failed += [(self.files[cloud_i], error)]
+                    continue
+                self.transforms[cloud_i] = (center, scale)
+
+                # Padded clouds all have the same size
+                n = 1 if config.per_cloud_batch else points.shape[0]
+
+                # In case batch is full, yield it and reset it
+                if batch_n + n > self.batch_limit and batch_n > 0:
+                    yield (np.concatenate(tpp_list, axis=0),
+                           np.array(tid_list, dtype=object),
+                           np.array(ti_list, dtype=np.int32),
+                           np.array([tp.shape[0] for tp in tpp_list]))
+                    tpp_list = []
+                    tid_list = []
+                    ti_list = []
+                    batch_n = 0
+
+                # Add data to current batch
+                tpp_list += [points]
+                tid_list += [self.files[cloud_i]]
+                ti_list += [cloud_i]
+
+                # Update batch size
+                batch_n += n
+
+            if batch_n > 0:
+                yield (np.concatenate(tpp_list, axis=0),
+                       np.array(tid_list, dtype=object),
+                       np.array(ti_list, dtype=np.int32),
+                       np.array([tp.shape[0] for tp in tpp_list]))
+
+        # Generator types and shapes
+        gen_types = (tf.float32, tf.string, tf.int32, tf.int32)
+        gen_shapes = ([None, 3], [None], [None], [None])
+
+        return streamed_gen, gen_types, gen_shapes
+
+    def get_tf_mapping(self, config):
+
+        def tf_map(stacked_partial, ids, obj_inds, stacked_partial_lengths):
+            """
+            From the input point cloud, this function compute all the point clouds at each layer, the neighbors
+            indices, the pooling indices and other useful variables.
+            :param stacked_partial: Tensor with size [None, 3] where None is the total number of points
+            :param ids: Tensor with size [None] where None is the number of batch
+            :param obj_inds: Tensor with size [None] where None is the number of batch
+            :param stacked_partial_lengths: Tensor with size [None] where None is the number of batch
+            """
+
+            # Get batch index for each point: [3, 2, 5] --> [0, 0, 0, 1, 1, 2, 2, 2, 2, 2] (but with larger sizes...)
+            batch_inds = self.tf_get_batch_inds(stacked_partial_lengths)
+
+            stacked_features = tf.ones((tf.shape(stacked_partial)[0], 1), dtype=tf.float32)
+
+            # Then use positions or not
+            if config.in_features_dim == 1:
+                pass
+            elif config.in_features_dim == 4:
+                stacked_features = tf.concat((stacked_features, stacked_partial), axis=1)
+            else:
+                raise ValueError('Only accepted input dimensions are 1, and 4 (without and with XYZ)')
+
+            # Get the whole input list
+            input_list = self.tf_completion_inputs(config,
+                                                   stacked_partial,
+                                                   stacked_features,
+                                                   None,
+                                                   stacked_partial_lengths,
+                                                   batch_inds)
+
+            # Add dummy scale and rotation for testing
+            input_list += [tf.zeros((0, 1), dtype=tf.int32), tf.zeros((0, 1), dtype=tf.int32), obj_inds,
+                           stacked_partial_lengths, tf.zeros((0, 1), dtype=tf.int32), ids]
+
+            return input_list
+
+        return tf_map
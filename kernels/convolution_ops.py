@@ -35,15 +35,22 @@ def radius_gaussian(sq_r, sig, eps=1e-9):
 #
 
 def unary_convolution(features,
-                      K_values):
+                      K_values,
+                      compute_dtype=tf.float32):
     """
     Simple unary convolution in tensorflow. Equivalent to matrix multiplication (space projection) for each features
     :param features: float32[n_points, in_fdim] - input features
     :param K_values: float32[in_fdim, out_fdim] - weights of the kernel
+    :param compute_dtype: tf dtype of the matrix multiplication (float32, float16 or bfloat16)
     :return: output_features float32[n_points, out_fdim]
     """
 
-    return tf.matmul(features, K_values)
+    if compute_dtype == tf.float32:
+        return tf.matmul(features, K_values)
+
+    # Reduced precision product, the result goes back to float32 for batch normalization
+    output_features = tf.matmul(tf.cast(features, compute_dtype), tf.cast(K_values, compute_dtype))
+    return tf.cast(output_features, tf.float32)
 
 
 def KPConv(query_points,
@@ -54,7 +61,8 @@ def KPConv(query_points,
            fixed='center',
            KP_extent=1.0,
            KP_influence='linear',
-           aggregation_mode='sum'):
+           aggregation_mode='sum',
+           compute_dtype=tf.float32):
     """
     This function initiates the kernel point disposition before building KPConv graph ops
 
@@ -67,6 +75,7 @@ def KPConv(query_points,
     :param KP_extent: float32 - influence radius of each kernel point
     :param KP_influence: string in ('constant', 'linear', 'gaussian') - influence function of the kernel points
     :param aggregation_mode: string in ('closest', 'sum') - whether to sum influences, or only keep the closest
+    :param compute_dtype: tf dtype of the feature matrix multiplications (float32, float16 or bfloat16)
 
     :return: output_features float32[n_points, out_fdim]
     """
@@ -102,7 +111,8 @@ def KPConv(query_points,
                       K_values,
                       KP_extent,
                       KP_influence,
-                      aggregation_mode)
+                      aggregation_mode,
+                      compute_dtype)
 
 
 def KPConv_ops(query_points,
@@ -113,7 +123,8 @@ def KPConv_ops(query_points,
                K_values,
                KP_extent,
                KP_influence,
-               aggregation_mode):
+               aggregation_mode,
+               compute_dtype=tf.float32):
     """
     This function creates a graph of operations to define Kernel Point Convolution in tensorflow. See KPConv function
     above for a description of each parameter
@@ -127,6 +138,7 @@ def KPConv_ops(query_points,
     :param KP_extent:           float32
     :param KP_influence:        string
     :param aggregation_mode:    string
+    :param compute_dtype:       tf dtype
     :return:                    [n_points, out_fdim]
     """
 
@@ -181,6 +193,12 @@ def KPConv_ops(query_points,
     # Concat Fake feature in last row for shadow neighbors
     features = tf.concat([features, tf.zeros_like(features[:1, :])], axis=0)
 
+    # Features products are computed in reduced precision (influences are computed in float32 above)
+    if compute_dtype != tf.float32:
+        features = tf.cast(features, compute_dtype)
+        all_weights = tf.cast(all_weights, compute_dtype)
+        K_values = tf.cast(K_values, compute_dtype)
+
     # Get the features of each neighborhood [n_points, n_neighbors, in_fdim]
     neighborhood_features = tf.gather(features, neighbors_indices, axis=0)
 
@@ -194,7 +212,7 @@ def KPConv_ops(query_points,
     # Convolution sum to get [n_points, out_fdim]
     output_features = tf.reduce_sum(kernel_outputs, axis=0)
 
-    return output_features
+    return tf.cast(output_features, tf.float32)
 
 
 def KPConv_deformable(query_points,
@@ -206,7 +224,8 @@ def KPConv_deformable(query_points,
                       KP_extent=1.0,
                       KP_influence='linear',
                       aggregation_mode='sum',
-                      modulated=False):
+                      modulated=False,
+                      compute_dtype=tf.float32):
     """
     This function initiates the kernel point disposition before building deformable KPConv graph ops
 
@@ -220,6 +239,8 @@ def KPConv_deformable(query_points,
     :param KP_influence: string in ('constant', 'linear', 'gaussian') - influence function of the kernel points
     :param aggregation_mode: string in ('closest', 'sum') - behavior of the convolution
     :param modulated: bool - If deformable conv should be modulated
+    :param compute_dtype: tf dtype of the feature matrix multiplications (float32, float16 or bfloat16). Offsets are
+                          always computed in float32
 
     :return: output_features float32[n_points, out_fdim]
     """
@@ -313,7 +334,8 @@ def KPConv_deformable(query_points,
                              K_values,
                              KP_extent,
                              KP_influence,
-                             aggregation_mode)
+                             aggregation_mode,
+                             compute_dtype)
 
 
 def KPConv_deform_ops(query_points,
@@ -326,7 +348,8 @@ def KPConv_deform_ops(query_points,
                       K_values,
                       KP_extent,
                       KP_influence,
-                      mode):
+                      mode,
+                      compute_dtype=tf.float32):
     """
     This function creates a graph of operations to define Deformable Kernel Point Convolution in tensorflow. See
     KPConv_deformable function above for a description of each parameter
@@ -342,6 +365,7 @@ def KPConv_deform_ops(query_points,
     :param KP_extent:           float32
     :param KP_influence:        string
     :param mode:                string
+    :param compute_dtype:       tf dtype
 
     :return:                    [n_points, out_fdim]
     """
@@ -419,6 +443,14 @@ def KPConv_deform_ops(query_points,
 
     features = tf.concat([features, tf.zeros_like(features[:1, :])], axis=0)
 
+    # Features products are computed in reduced precision (deformed influences are computed in float32 above)
+    if compute_dtype != tf.float32:
+        features = tf.cast(features, compute_dtype)
+        all_weights = tf.cast(all_weights, compute_dtype)
+        K_values = tf.cast(K_values, compute_dtype)
+        if modulations is not None:
+            modulations = tf.cast(modulations, compute_dtype)
+
     # Get the features of each neighborhood [n_points, new_max_neighb, in_fdim]
     neighborhood_features = tf.gather(features, new_neighbors_indices, axis=0)
 
@@ -436,4 +468,4 @@ def KPConv_deform_ops(query_points,
     # Convolution sum [n_points, out_fdim]
     output_features = tf.reduce_sum(kernel_outputs, axis=0)
 
-    return output_features
+    return tf.cast(output_features, tf.float32)
@@ -14,11 +14,23 @@
 # Import numpy package and name it "np"
 import numpy as np
 import matplotlib.pyplot as plt
-from os import makedirs
-from os.path import join, exists
+import argparse
+from os import makedirs, getpid, link, replace, remove
+from os.path import join, exists, dirname, abspath
 
 from utils.ply import read_ply, write_ply
 
+# Kernel dispositions cache, next to this file whatever the working directory. The version is increased each time the
+# optimization changes, so that dispositions of different optimizers are never mixed
+kernel_cache_dir = join(dirname(abspath(__file__)), 'dispositions')
+kernel_cache_version = 2
+
+# Number of tries in the optimization process, to ensure we get the most stable disposition
+num_tries = 100
+
+# Seed of the initialization of the tries, so that a cache built anywhere contains the same dispositions
+kernel_seed = 42
+
 
 # ------------------------------------------------------------------------------------------
 #
@@ -28,9 +40,10 @@ from utils.ply import read_ply, write_ply
 #
 
 def kernel_point_optimization_debug(radius, num_points, num_kernels=1, dimension=3, fixed='center', ratio=1.0,
-                                    verbose=0):
+                                    verbose=0, random_state=None):
     """
-    Creation of kernel point via optimization of potentials.
+    Creation of kernel point via optimization of potentials. All kernels are optimized together, and each kernel stops
+    moving as soon as its own gradients are stable.
     :param radius: Radius of the kernels
     :param num_points: points composing kernels
     :param num_kernels: number of wanted kernels
@@ -38,7 +51,9 @@ def kernel_point_optimization_debug(radius, num_points, num_kernels=1, dimension
     :param fixed: fix position of certain kernel points ('none', 'center' or 'verticals')
     :param ratio: ratio of the radius where you want the kernels points to be placed
     :param verbose: display option
-    :return: points [num_kernels, num_points, dimension]
+    :param random_state: optional np.random.RandomState of the initialization
+    :return: points [num_kernels, num_points, dimension], max gradient norm of each kernel at each iteration [n_iter,
+             num_kernels] (kernels keep their last value once stopped)
     """
 
     #######################
@@ -59,14 +74,20 @@ def kernel_point_optimization_debug(radius, num_points, num_kernels=1, dimension
     # Gradient clipping value
     clip = 0.05 * radius0
 
+    # Maximal number of iterations
+    max_iter = 10000
+
+    # Random generator
+    rng = np.random if random_state is None else random_state
+
     #######################
     # Kernel initialization
     #######################
 
     # Random kernel points
-    kernel_points = np.random.rand(num_kernels * num_points - 1, dimension) * diameter0 - radius0
+    kernel_points = rng.rand(num_kernels * num_points - 1, dimension) * diameter0 - radius0
     while kernel_points.shape[0] < num_kernels * num_points:
-        new_points = np.random.rand(num_kernels * num_points - 1, dimension) * diameter0 - radius0
+        new_points = rng.rand(num_kernels * num_points - 1, dimension) * diameter0 - radius0
         kernel_points = np.vstack((kernel_points, new_points))
         d2 = np.sum(np.power(kernel_points, 2), axis=1)
         kernel_points = kernel_points[d2 < 0.5 * radius0 * radius0, :]
@@ -80,6 +101,9 @@ def kernel_point_optimization_debug(radius, num_points, num_kernels=1, dimension
         kernel_points[:, 1, -1] += 2 * radius0 / 3
         kernel_points[:, 2, -1] -= 2 * radius0 / 3
 
+    # First point which is free to move
+    first_moving = {'center': 1, 'verticals': 3}.get(fixed, 0)
+
     #####################
     # Kernel optimization
     #####################
@@ -88,22 +112,27 @@ def kernel_point_optimization_debug(radius, num_points, num_kernels=1, dimension
     if verbose > 1:
         fig = plt.figure()
 
-    saved_gradient_norms = np.zeros((10000, num_kernels))
+    saved_gradient_norms = np.zeros((max_iter, num_kernels))
     old_gradient_norms = np.zeros((num_kernels, num_points))
-    for iter in range(10000):
+
+    # Indices of the kernels still moving
+    active = np.arange(num_kernels)
+
+    for iter in range(max_iter):
 
         # Compute gradients
         # *****************
 
         # Derivative of the sum of potentials of all points
-        A = np.expand_dims(kernel_points, axis=2)
-        B = np.expand_dims(kernel_points, axis=1)
+        active_points = kernel_points[active]
+        A = np.expand_dims(active_points, axis=2)
+        B = np.expand_dims(active_points, axis=1)
         interd2 = np.sum(np.power(A - B, 2), axis=-1)
         inter_grads = (A - B) / (np.power(np.expand_dims(interd2, -1), 3 / 2) + 1e-6)
         inter_grads = np.sum(inter_grads, axis=1)
 
         # Derivative of the radius potential
-        circle_grads = 10 * kernel_points
+        circle_grads = 10 * active_points
 
         # All gradients
         gradients = inter_grads + circle_grads
@@ -116,17 +145,16 @@ def kernel_point_optimization_debug(radius, num_points, num_kernels=1, dimension
 
         # Compute norm of gradients
         gradients_norms = np.sqrt(np.sum(np.power(gradients, 2), axis=-1))
-        saved_gradient_norms[iter, :] = np.max(gradients_norms, axis=1)  # for each kernel,store max norm of all points
 
-        # Stop if all moving points are gradients fixed (low gradients diff)
+        # For each kernel, store max norm of all points (stopped kernels keep their last value)
+        if iter > 0:
+            saved_gradient_norms[iter, :] = saved_gradient_norms[iter - 1, :]
+        saved_gradient_norms[iter, active] = np.max(gradients_norms, axis=1)
 
-        if fixed == 'center' and np.max(np.abs(old_gradient_norms[:, 1:] - gradients_norms[:, 1:])) < thresh:
-            break
-        elif fixed == 'verticals' and np.max(np.abs(old_gradient_norms[:, 3:] - gradients_norms[:, 3:])) < thresh:
-            break
-        elif np.max(np.abs(old_gradient_norms - gradients_norms)) < thresh:
-            break
-        old_gradient_norms = gradients_norms
+        # A kernel stops when the gradients of all its moving points are fixed (low gradients diff)
+        diffs = np.abs(old_gradient_norms[active, first_moving:] - gradients_norms[:, first_moving:])
+        moving = np.max(diffs, axis=1) >= thresh
+        old_gradient_norms[active] = gradients_norms
 
         # Move points
         # ***********
@@ -140,11 +168,14 @@ def kernel_point_optimization_debug(radius, num_points, num_kernels=1, dimension
         if fixed == 'verticals':
             moving_dists[:, 0] = 0
 
-        # Move points
-        kernel_points -= np.expand_dims(moving_dists, -1) * gradients / np.expand_dims(gradients_norms + 1e-6, -1)
+        # Move the points of the kernels which did not stop
+        steps = np.expand_dims(moving_dists, -1) * gradients / np.expand_dims(gradients_norms + 1e-6, -1)
+        kernel_points[active[moving]] -= steps[moving]
 
         if verbose:
-            print('iter {:5d} / max grad = {:f}'.format(iter, np.max(gradients_norms[:, 3:])))
+            print('iter {:5d} / max grad = {:f} / {:d} kernels moving'.format(iter,
+                                                                              np.max(gradients_norms[:, 3:]),
+                                                                              np.sum(moving)))
         if verbose > 1:
             plt.clf()
             plt.plot(kernel_points[0, :, 0], kernel_points[0, :, 1], '.')
@@ -158,6 +189,11 @@ def kernel_point_optimization_debug(radius, num_points, num_kernels=1, dimension
             plt.show(block=False)
             print(moving_factor)
 
+        # Stop when all kernels are stable
+        active = active[moving]
+        if active.shape[0] == 0:
+            break
+
         # moving factor decay
         moving_factor *= continuous_moving_decay
 
@@ -166,44 +202,69 @@ def kernel_point_optimization_debug(radius, num_points, num_kernels=1, dimension
     kernel_points *= ratio / np.mean(r[:, 1:])
 
     # Rescale kernels with real radius
-    return kernel_points * radius, saved_gradient_norms
+    return kernel_points * radius, saved_gradient_norms[:iter + 1]
 
 
-def load_kernels(radius, num_kpoints, num_kernels, dimension, fixed):
-    # Number of tries in the optimization process, to ensure we get the most stable disposition
-    num_tries = 100
-
-    # Kernel directory
-    kernel_dir = 'kernels/dispositions'
-    if not exists(kernel_dir):
-        makedirs(kernel_dir)
-
-    # Kernel_file
-    if dimension == 3:
-        kernel_file = join(kernel_dir, 'k_{:03d}_{:s}.ply'.format(num_kpoints, fixed))
-    elif dimension == 2:
-        kernel_file = join(kernel_dir, 'k_{:03d}_{:s}_2D.ply'.format(num_kpoints, fixed))
-    else:
+def kernel_file(num_kpoints, fixed, dimension):
+    """
+    Cache file of the kernel disposition with these parameters
+    """
+    if dimension not in (2, 3):
         raise ValueError('Unsupported dimpension of kernel : ' + str(dimension))
+    return join(kernel_cache_dir, 'v{:d}'.format(kernel_cache_version),
+                'k_{:03d}_{:s}_{:d}D.ply'.format(num_kpoints, fixed, dimension))
 
-    # Check if already done
-    if not exists(kernel_file):
-        # Create kernels
-        kernel_points, grad_norms = kernel_point_optimization_debug(1.0,
-                                                                    num_kpoints,
-                                                                    num_kernels=num_tries,
-                                                                    dimension=dimension,
-                                                                    fixed=fixed,
-                                                                    verbose=0)
-        # Find best candidate kernel
-        best_k = np.argmin(grad_norms[-1, :])
-
-        # Save points
-        original_kernel = kernel_points[best_k, :, :]
-        write_ply(kernel_file, original_kernel, ['x', 'y', 'z'])
-    else:
-        data = read_ply(kernel_file)
-        original_kernel = np.vstack((data['x'], data['y'], data['z'])).T
+
+def optimal_kernel(num_kpoints, dimension, fixed):
+    """
+    Most stable of the kernel dispositions optimized from num_tries random initializations (always the same ones)
+    """
+    kernel_points, grad_norms = kernel_point_optimization_debug(1.0,
+                                                                num_kpoints,
+                                                                num_kernels=num_tries,
+                                                                dimension=dimension,
+                                                                fixed=fixed,
+                                                                verbose=0,
+                                                                random_state=np.random.RandomState(kernel_seed))
+
+    # Find best candidate kernel (lowest final gradient)
+    best_k = np.argmin(grad_norms[-1, :])
+    return kernel_points[best_k, :, :]
+
+
+def cached_kernel(num_kpoints, dimension, fixed, redo=False):
+    """
+    Kernel disposition from the cache, optimized and cached if it is not there yet. The file is written under a
+    temporary name and linked in place, so that jobs optimizing the same kernel at the same time all use the first
+    written disposition and never read a partial file.
+    """
+    filename = kernel_file(num_kpoints, fixed, dimension)
+    if redo or not exists(filename):
+        makedirs(dirname(filename), exist_ok=True)
+        original_kernel = optimal_kernel(num_kpoints, dimension, fixed)
+        names = ['x', 'y', 'z'][:dimension]
+        tmp_file = '{:s}.{:d}.tmp.ply'.format(filename[:-4], getpid())
+        write_ply(tmp_file, original_kernel, names)
+        try:
+            if redo:
+                replace(tmp_file, filename)
+            else:
+                link(tmp_file, filename)
+        except FileExistsError:
+            pass
+        except OSError:
+            # File systems without hard links
+            replace(tmp_file, filename)
+        if exists(tmp_file):
+            remove(tmp_file)
+
+    data = read_ply(filename)
+    return np.vstack([data[name] for name in data.dtype.names]).T
+
+
+def load_kernels(radius, num_kpoints, num_kernels, dimension, fixed):
+
+    original_kernel = cached_kernel(num_kpoints, dimension, fixed)
 
     # N.B. 2D kernels are not supported yet
     if dimension == 2:
@@ -262,3 +323,29 @@ def load_kernels(radius, num_kpoints, num_kernels, dimension, fixed):
         kernels = kernels + np.random.normal(scale=radius * 0.01, size=kernels.shape)
 
     return kernels
+
+
+# ----------------------------------------------------------------------------------------------------------------------
+#
+#           Main Call
+#       \***************/
+#
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(formatter_class=argparse.RawTextHelpFormatter,
+                                     description="Pre-generate the cache of kernel dispositions")
+    parser.add_argument('--num_kpoints', type=int, nargs='+', default=[15, 20, 25], help="numbers of kernel points")
+    parser.add_argument('--fixed', nargs='+', choices=['none', 'center', 'verticals'], default=['center'],
+                        help="fixed kernel points")
+    parser.add_argument('--dimension', type=int, nargs='+', choices=[2, 3], default=[3])
+    parser.add_argument('--redo', default=False, action='store_true',
+                        help="If set, cached dispositions are optimized again")
+    args = parser.parse_args()
+
+    for dimension in args.dimension:
+        for fixed in args.fixed:
+            for num_kpoints in args.num_kpoints:
+                done = exists(kernel_file(num_kpoints, fixed, dimension))
+                cached_kernel(num_kpoints, dimension, fixed, redo=args.redo)
+                print('{:s} {:s}'.format(kernel_file(num_kpoints, fixed, dimension),
+                                         'cached' if done and not args.redo else 'optimized'))
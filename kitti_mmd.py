@@ -0,0 +1,130 @@
+# ----------------------------------------------------------------------------------------------------------------------
+#
+#      Minimal matching distance (MMD) of stored KITTI completions against a ShapeNet reference database
+#
+# ----------------------------------------------------------------------------------------------------------------------
+#
+#           Imports and global variables
+#       \**********************************/
+#
+
+# Common libs
+import argparse
+import csv
+import os
+import time
+import numpy as np
+import tensorflow as tf
+
+# My libs
+from datasets.ShapeNetBenchmark2048 import ShapeNetBenchmark2048Dataset
+from kitti_registration import load_completions, load_points
+from utils.bboxes import BboxTable
+from utils.metrics import database_chamfer
+
+# Synset of the ShapeNet cars, the only category of KITTI completions
+CAR_SYNSET = '02958343'
+
+
+# ----------------------------------------------------------------------------------------------------------------------
+#
+#           Utility functions
+#       \***********************/
+#
+
+def stored_completions(saving_path):
+    """
+    Car ids and a loader of the completions written by test_kitti.py, from the consolidated array if there is one,
+    else from the .pcd files
+    :return: list of car ids, function from row index to (N, 3) points in the KITTI frame
+    """
+    completions, rows = load_completions(saving_path)
+    if completions is not None:
+        car_ids = sorted(rows, key=rows.get)
+        return car_ids, lambda i: np.array(completions[i], dtype=np.float64)
+
+    completion_dir = os.path.join(saving_path, 'visu', 'kitti', 'completions')
+    car_ids = sorted([f[:-4] for f in os.listdir(completion_dir) if f.endswith('.pcd')])
+    return car_ids, lambda i: load_points(os.path.join(completion_dir, '%s.pcd' % car_ids[i]))
+
+
+def kitti_mmd(saving_path, kitti_dataset_path, shapenet_dataset_path, split='valid', all_categories=False, gpu='0'):
+    """
+    Minimal matching distance of every stored completion, computed in the canonical frame of the model against the
+    complete clouds of the reference database. Results are written in visu/kitti/mmd.csv.
+    :param saving_path: log folder of the model used by test_kitti.py
+    :param kitti_dataset_path: KITTI folder (its bboxes bring completions back to the canonical frame)
+    :param shapenet_dataset_path: ShapeNetBenchmark2048 folder, where the reference database is saved
+    :param split: ShapeNet split used as reference
+    :param all_categories: use clouds of all categories as reference instead of cars only
+    :param gpu: visible gpu
+    :return: (num_cars,) array of distances
+    """
+
+    os.environ['CUDA_VISIBLE_DEVICES'] = gpu
+
+    # Reference database, built at the first call only
+    shapenet_dataset = ShapeNetBenchmark2048Dataset(1, 2048, shapenet_dataset_path)
+    database, database_ids = shapenet_dataset.load_reference_clouds(split, None if all_categories else [CAR_SYNSET])
+
+    car_ids, load_completion = stored_completions(saving_path)
+    bboxes = BboxTable(os.path.join(kitti_dataset_path, 'bboxes'))
+
+    # The database is given once to a variable, only one completion is fed at each step
+    graph = tf.Graph()
+    with graph.as_default():
+        database_init = tf.placeholder(tf.float32, database.shape)
+        database_var = tf.Variable(database_init, trainable=False, collections=[])
+        cloud = tf.placeholder(tf.float32, [None, 3])
+        distances = database_chamfer(cloud, database_var)
+        nearest = tf.argmin(distances)
+        mmd_op = tf.reduce_min(distances)
+
+    cProto = tf.ConfigProto()
+    cProto.gpu_options.allow_growth = True
+    mmds = np.zeros(len(car_ids), dtype=np.float32)
+    matches = []
+    with tf.Session(graph=graph, config=cProto) as sess:
+        sess.run(database_var.initializer, {database_init: database})
+
+        t0 = time.time()
+        last_display = t0
+        for i, car_id in enumerate(car_ids):
+            points = bboxes.normalize(car_id, load_completion(i))
+            idx, mmds[i] = sess.run([nearest, mmd_op], {cloud: points})
+            matches.append(database_ids[idx])
+
+            if time.time() - last_display > 1.0:
+                last_display = time.time()
+                print('MMD : {:.1f}% ({:.1f} cars/s)'.format(100 * (i + 1) / len(car_ids),
+                                                            (i + 1) / (last_display - t0)))
+
+    with open(os.path.join(saving_path, 'visu', 'kitti', 'mmd.csv'), 'w') as csv_file:
+        writer = csv.writer(csv_file)
+        writer.writerow(['id', 'mmd', 'nearest'])
+        writer.writerows(zip(car_ids, mmds, matches))
+
+    print('Test MMD: {:4.5f} ({:d} cars, {:d} reference clouds)'.format(np.mean(mmds), len(car_ids),
+                                                                         database.shape[0]))
+    return mmds
+
+
+# ----------------------------------------------------------------------------------------------------------------------
+#
+#           Main Call
+#       \***************/
+#
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--saving_path', help="model_log_file_path")
+    parser.add_argument('--kitti_dataset_path')
+    parser.add_argument('--shapenet_dataset_path')
+    parser.add_argument('--split', choices=['train', 'valid'], default='valid', help="ShapeNet split used as reference")
+    parser.add_argument('--all_categories', action='store_true',
+                        help="reference clouds of all ShapeNet categories instead of cars only")
+    parser.add_argument('--gpu', default='0')
+    args = parser.parse_args()
+
+    kitti_mmd(args.saving_path, args.kitti_dataset_path, args.shapenet_dataset_path,
+              split=args.split, all_categories=args.all_categories, gpu=args.gpu)
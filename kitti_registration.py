@@ -1,29 +1,22 @@
 import argparse
 import copy
 import csv
+import functools
 import matplotlib.pyplot as plt
+import multiprocessing
 import numpy as np
 import os
 from mpl_toolkits.mplot3d import Axes3D
 import open3d as o3d
 
+from utils.bboxes import BboxTable
+from utils.icp import batch_icp
 
-def bbox2rt(bbox):
-    center = (bbox.min(0) + bbox.max(0)) / 2
-    bbox -= center
-    yaw = np.arctan2(bbox[3, 1] - bbox[0, 1], bbox[3, 0] - bbox[0, 0])
-    rotation = np.array([[np.cos(yaw), -np.sin(yaw), 0],
-                         [np.sin(yaw), np.cos(yaw), 0],
-                         [0, 0, 1]])
-    return rotation, center
 
-
-def register(source, target, args):
+def register(source_points, target_points, args):
     residual = o3d.registration.TransformationEstimationPointToPoint()
     criteria = o3d.registration.ICPConvergenceCriteria(max_iteration=args.max_iter)
     # Align the centroids of the point clouds
-    source_points = np.array(source.points)
-    target_points = np.array(target.points)
     source_center = np.mean(source_points, axis=0)
     target_center = np.mean(target_points, axis=0)
     source = o3d.geometry.PointCloud()
@@ -38,6 +31,26 @@ def register(source, target, args):
     return R, t, np.array(source_trans.points), np.array(target.points)
 
 
+def register_batch(pairs, args):
+    """
+    Same registrations as register for a list of (source_points, target_points) pairs, all aligned at once by the
+    vectorized ICP
+    :return: list of (R, t, transformed source, centered target) like register
+    """
+    source_centers = [np.mean(source, axis=0) for source, _ in pairs]
+    target_centers = [np.mean(target, axis=0) for _, target in pairs]
+    sources = [source - c for (source, _), c in zip(pairs, source_centers)]
+    targets = [target - c for (_, target), c in zip(pairs, target_centers)]
+    R, t, _, _ = batch_icp(sources, targets, max_iter=args.max_iter, max_dist=args.max_dist)
+
+    results = []
+    for i in range(len(pairs)):
+        source_trans = np.dot(sources[i], R[i].T) + t[i]
+        t_i = t[i] + target_centers[i] - np.dot(source_centers[i], R[i].T)
+        results.append((R[i], t_i, source_trans, targets[i]))
+    return results
+
+
 def rotation_error(R1, R2):
     cos = (np.trace(np.dot(R1, R2.T)) - 1) / 2
     cos = np.maximum(np.minimum(cos, 1), -1)
@@ -58,67 +71,153 @@ def plot_pcd_pair(ax, pcd1, pcd2, title, cmaps, size, xlim=(-1.5, 1.5), ylim=(-1
     ax.set_zlim(zlim)
 
 
+@functools.lru_cache(maxsize=256)
+def load_points(path):
+    """
+    Points of a .pcd file, kept in memory by a bounded LRU cache (resized by init_worker in registration processes)
+    """
+    return np.array(o3d.io.read_point_cloud(path).points)
+
+
+def load_completions(saving_path):
+    """
+    Consolidated completions written by test_kitti.py --completions_array, memory mapped
+    :return: (num_cars, num_points, 3) array and dictionary from car id to row, or None, None if they are not found
+    """
+    array_file = os.path.join(saving_path, 'visu', 'kitti', 'completions.npy')
+    ids_file = os.path.join(saving_path, 'visu', 'kitti', 'completions_ids.txt')
+    if not (os.path.exists(array_file) and os.path.exists(ids_file)):
+        return None, None
+    with open(ids_file) as f:
+        rows = {car_id: i for i, car_id in enumerate(f.read().splitlines())}
+    return np.load(array_file, mmap_mode='r'), rows
+
+
+def load_completion(car_id, args):
+    """
+    Completed cloud of a car, from the consolidated array if there is one, else from its .pcd file
+    """
+    if completions is not None:
+        return np.array(completions[completion_rows[car_id]], dtype=np.float64)
+    return load_points(os.path.join(args.saving_path, 'visu', 'kitti', 'completions', '%s.pcd' % car_id))
+
+
+def init_worker(cache_size, bbox_table, saving_path):
+    """
+    Bound the cloud cache of a worker process, give it the bbox table and open the completions array
+    """
+    global load_points, bboxes, completions, completion_rows
+    load_points = functools.lru_cache(maxsize=cache_size)(load_points.__wrapped__)
+    bboxes = bbox_table
+    completions, completion_rows = load_completions(saving_path)
+
+
+def register_tracklet(job):
+    """
+    Register every frame of a tracklet to its first frame, with partial and completed clouds
+    :param job: (tracklet_id, car_ids, index of the first pair over all tracklets, args)
+    :return: list of csv rows, list of (instance_id, plot data) for the pairs that have to be plotted
+    """
+    tracklet_id, car_ids, first_n, args = job
+
+    # Every frame is paired with the first one, partial pairs first then completed pairs
+    frames = list(range(args.interval, len(car_ids), args.interval))
+    if not frames:
+        return [], []
+    first_partial = load_points(os.path.join(args.dataset_path, 'cars', '%s.pcd' % car_ids[0]))
+    first_complete = load_completion(car_ids[0], args)
+    pairs = [(first_partial, load_points(os.path.join(args.dataset_path, 'cars', '%s.pcd' % car_ids[i])))
+             for i in frames]
+    pairs += [(first_complete, load_completion(car_ids[i], args)) for i in frames]
+
+    # All pairs of the tracklet are registered together, open3d backend registers them one by one
+    if args.icp == 'numpy':
+        results = register_batch(pairs, args)
+    else:
+        results = [register(source, target, args) for source, target in pairs]
+    num_pairs = len(frames)
+
+    rows = []
+    plots = []
+    n = first_n
+    prev_frame = int(car_ids[0].split('_')[1])
+    prev_t, prev_R, _ = bboxes.transform(car_ids[0])
+    for k, i in enumerate(frames):
+        n += 1
+        frame = int(car_ids[i].split('_')[1])
+        instance_id = '%s_frame_%d_to_%d' % (tracklet_id, prev_frame, frame)
+
+        t, R, _ = bboxes.transform(car_ids[i])
+        R_gt = np.dot(R, prev_R.T)
+        t_gt = t - np.dot(prev_t, R_gt.T)
+
+        R_part, t_part, partial_trans, partial_target = results[k]
+        r_err_part = rotation_error(R_part, R_gt)
+        t_err_part = translation_error(t_part, t_gt)
+
+        R_comp, t_comp, complete_trans, complete_target = results[num_pairs + k]
+        r_err_comp = rotation_error(R_comp, R_gt)
+        t_err_comp = translation_error(t_comp, t_gt)
+
+        rows.append([instance_id, r_err_part, t_err_part, r_err_comp, t_err_comp])
+
+        # Only send back the clouds that are plotted
+        if n % args.plot_freq == 0:
+            plots.append((instance_id, (partial_trans, partial_target, r_err_part, t_err_part,
+                                        complete_trans, complete_target, r_err_comp, t_err_comp)))
+
+    return rows, plots
+
+
+def plot_registration(filename, data):
+    partial_trans, partial_target, r_err_part, t_err_part = data[:4]
+    complete_trans, complete_target, r_err_comp, t_err_comp = data[4:]
+    fig = plt.figure(figsize=(8, 4))
+    ax = fig.add_subplot(121, projection='3d')
+    plot_pcd_pair(ax, partial_trans, partial_target,
+                  'Rotation error %.4f\nTranslation error %.4f' % (r_err_part, t_err_part),
+                  ['Reds', 'Blues'], size=5)
+    ax = fig.add_subplot(122, projection='3d')
+    plot_pcd_pair(ax, complete_trans, complete_target,
+                  'Rotation error %.4f\nTranslation error %.4f' % (r_err_comp, t_err_comp),
+                  ['Reds', 'Blues'], size=0.5)
+    plt.subplots_adjust(left=0, right=1, bottom=0, top=0.95, wspace=0)
+    fig.savefig(filename)
+    plt.close(fig)
+
+
 def track(args):
-    os.makedirs(os.path.join(args.saving_path, 'visu', 'kitti', 'registration', 'plots'), exist_ok=True)
-    csv_file = open(os.path.join(args.saving_path, 'visu', 'kitti', 'registration', 'error.csv'), 'w')
-    writer = csv.writer(csv_file)
-    writer.writerow(['id', 'r_err_part', 't_err_part', 'r_err_comp', 't_err_comp'])
+    registration_dir = os.path.join(args.saving_path, 'visu', 'kitti', 'registration')
+    os.makedirs(os.path.join(registration_dir, 'plots'), exist_ok=True)
 
+    # Tracklets in a fixed order, with the index of their first pair so that plotted pairs do not depend on scheduling
+    jobs = []
     n = 0
-    total_r_err_part = 0
-    total_t_err_part = 0
-    total_r_err_comp = 0
-    total_t_err_comp = 0
-    for filename in os.listdir(os.path.join(args.dataset_path, 'tracklets')):
+    for filename in sorted(os.listdir(os.path.join(args.dataset_path, 'tracklets'))):
         tracklet_id = filename.split('.')[0]
         with open(os.path.join(args.dataset_path, 'tracklets', filename)) as file:
             car_ids = file.read().splitlines()
-
-        prev_frame = int(car_ids[0].split('_')[1])
-        prev_R, prev_t = bbox2rt(np.loadtxt(os.path.join(args.dataset_path, 'bboxes', '%s.txt' % car_ids[0])))
-        prev_partial = o3d.io.read_point_cloud(os.path.join(args.dataset_path, 'cars', '%s.pcd' % car_ids[0]))
-        prev_complete = o3d.io.read_point_cloud(
-            os.path.join(args.saving_path, 'visu', 'kitti', 'completions', '%s.pcd' % car_ids[0]))
-        for i in range(args.interval, len(car_ids), args.interval):
-            n += 1
-            frame = int(car_ids[i].split('_')[1])
-            instance_id = '%s_frame_%d_to_%d' % (tracklet_id, prev_frame, frame)
-
-            R, t = bbox2rt(np.loadtxt(os.path.join(args.dataset_path, 'bboxes', '%s.txt' % car_ids[i])))
-            R_gt = np.dot(R, prev_R.T)
-            t_gt = t - np.dot(prev_t, R_gt.T)
-
-            partial = o3d.io.read_point_cloud(os.path.join(args.dataset_path, 'cars', '%s.pcd' % car_ids[i]))
-            R_part, t_part, partial_trans, partial_target = register(prev_partial, partial, args)
-            r_err_part = rotation_error(R_part, R_gt)
-            t_err_part = translation_error(t_part, t_gt)
-            total_r_err_part += r_err_part
-            total_t_err_part += t_err_part
-
-            complete = o3d.io.read_point_cloud(
-                os.path.join(args.saving_path, 'visu', 'kitti', 'completions', '%s.pcd' % car_ids[i]))
-            R_comp, t_comp, complete_trans, complete_target = register(prev_complete, complete, args)
-            r_err_comp = rotation_error(R_comp, R_gt)
-            t_err_comp = translation_error(t_comp, t_gt)
-            total_r_err_comp += r_err_comp
-            total_t_err_comp += t_err_comp
-
-            writer.writerow([instance_id, r_err_part, t_err_part, r_err_comp, t_err_comp])
-
-            if n % args.plot_freq == 0:
-                fig = plt.figure(figsize=(8, 4))
-                ax = fig.add_subplot(121, projection='3d')
-                plot_pcd_pair(ax, partial_trans, partial_target,
-                              'Rotation error %.4f\nTranslation error %.4f' % (r_err_part, t_err_part),
-                              ['Reds', 'Blues'], size=5)
-                ax = fig.add_subplot(122, projection='3d')
-                plot_pcd_pair(ax, complete_trans, complete_target,
-                              'Rotation error %.4f\nTranslation error %.4f' % (r_err_comp, t_err_comp),
-                              ['Reds', 'Blues'], size=0.5)
-                plt.subplots_adjust(left=0, right=1, bottom=0, top=0.95, wspace=0)
-                fig.savefig(
-                    os.path.join(args.saving_path, 'visu', 'kitti', 'registration', 'plots', '%s.png' % instance_id))
-                plt.close(fig)
+        jobs.append((tracklet_id, car_ids, n, args))
+        n += len(range(args.interval, len(car_ids), args.interval))
+
+    # Tracklets are registered in parallel, results come back in job order and are plotted while workers go on
+    all_rows = []
+    bbox_table = BboxTable(os.path.join(args.dataset_path, 'bboxes'))
+    with multiprocessing.Pool(args.num_workers, initializer=init_worker,
+                              initargs=(args.cache_size, bbox_table, args.saving_path)) as pool:
+        for rows, plots in pool.imap(register_tracklet, jobs):
+            all_rows += rows
+            for instance_id, data in plots:
+                plot_registration(os.path.join(registration_dir, 'plots', '%s.png' % instance_id), data)
+
+    with open(os.path.join(registration_dir, 'error.csv'), 'w') as csv_file:
+        writer = csv.writer(csv_file)
+        writer.writerow(['id', 'r_err_part', 't_err_part', 'r_err_comp', 't_err_comp'])
+        writer.writerows(all_rows)
+
+    errors = np.array([row[1:] for row in all_rows], dtype=np.float64)
+    total_r_err_part, total_t_err_part, total_r_err_comp, total_t_err_comp = np.sum(errors, axis=0)
+    n = len(all_rows)
     print('Using original pcd: average rotation error %.4f  average translation error %.4f' %
           (total_r_err_part / n, total_t_err_part / n))
     print('Using completed pcd: average roration error %.4f  average translation error %.4f' %
@@ -133,6 +232,10 @@ if __name__ == '__main__':
     parser.add_argument('--max_iter', type=int, default=100, help='max iteration for ICP')
     parser.add_argument('--max_dist', type=float, default=0.05, help='matching threshold for ICP')
     parser.add_argument('--plot_freq', type=int, default=100)
+    parser.add_argument('--icp', choices=['numpy', 'open3d'], default='numpy',
+                        help='ICP backend, vectorized over the pairs of a tracklet or open3d pair by pair')
+    parser.add_argument('--num_workers', type=int, default=os.cpu_count(), help='number of registration processes')
+    parser.add_argument('--cache_size', type=int, default=256, help='number of clouds kept in memory by each process')
     args = parser.parse_args()
 
     track(args)
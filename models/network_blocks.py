@@ -30,6 +30,21 @@ def bias_variable(shape):
     return tf.Variable(initial, name='bias')
 
 
+def get_compute_dtype(config):
+    """
+    Returns the tf dtype of convolutions and matmuls. Variables, batch normalization and losses stay in float32
+    """
+
+    if config.mixed_precision == 'none':
+        return tf.float32
+    elif config.mixed_precision == 'float16':
+        return tf.float16
+    elif config.mixed_precision == 'bfloat16':
+        return tf.bfloat16
+    else:
+        raise ValueError('Unknown mixed precision mode (config.mixed_precision) : ' + config.mixed_precision)
+
+
 def ind_max_pool(x, inds):
     """
     This tensorflow operation compute a maxpooling according to the list of indices 'inds'.
@@ -82,7 +97,8 @@ def KPConv(query_points, support_points, neighbors_indices, features, K_values,
                            fixed=config.fixed_kernel_points,
                            KP_extent=extent,
                            KP_influence=config.KP_influence,
-                           aggregation_mode=config.convolution_mode, )
+                           aggregation_mode=config.convolution_mode,
+                           compute_dtype=get_compute_dtype(config))
 
 
 def KPConv_deformable(query_points, support_points, neighbors_indices, features, K_values, radius, config):
@@ -103,7 +119,8 @@ def KPConv_deformable(query_points, support_points, neighbors_indices, features,
                                       KP_extent=extent,
                                       KP_influence=config.KP_influence,
                                       aggregation_mode=config.convolution_mode,
-                                      modulated=config.modulated)
+                                      modulated=config.modulated,
+                                      compute_dtype=get_compute_dtype(config))
 
 
 def batch_norm(x, use_batch_norm=True, momentum=0.99, training=True):
@@ -141,7 +158,7 @@ def unary_block(layer_ind, inputs, features, radius, fdim, config, training):
     """
 
     w = weight_variable([int(features.shape[1]), fdim])
-    x = conv_ops.unary_convolution(features, w)
+    x = conv_ops.unary_convolution(features, w, get_compute_dtype(config))
     x = leaky_relu(batch_norm(x,
                               config.use_batch_norm,
                               config.batch_norm_momentum,
@@ -182,7 +199,7 @@ def resnetb_block(layer_ind, inputs, features, radius, fdim, config, training):
 
     with tf.variable_scope('conv1'):
         w = weight_variable([int(features.shape[1]), fdim // 2])
-        x = conv_ops.unary_convolution(features, w)
+        x = conv_ops.unary_convolution(features, w, get_compute_dtype(config))
         x = leaky_relu(batch_norm(x,
                                   config.use_batch_norm,
                                   config.batch_norm_momentum,
@@ -205,7 +222,7 @@ def resnetb_block(layer_ind, inputs, features, radius, fdim, config, training):
 
     with tf.variable_scope('conv3'):
         w = weight_variable([int(x.shape[1]), 2 * fdim])
-        x = conv_ops.unary_convolution(x, w)
+        x = conv_ops.unary_convolution(x, w, get_compute_dtype(config))
         x = batch_norm(x,
                        config.use_batch_norm,
                        config.batch_norm_momentum,
@@ -214,7 +231,7 @@ def resnetb_block(layer_ind, inputs, features, radius, fdim, config, training):
     with tf.variable_scope('shortcut'):
         if int(features.shape[1]) != 2 * fdim:
             w = weight_variable([int(features.shape[1]), 2 * fdim])
-            shortcut = conv_ops.unary_convolution(features, w)
+            shortcut = conv_ops.unary_convolution(features, w, get_compute_dtype(config))
             shortcut = batch_norm(shortcut,
                                   config.use_batch_norm,
                                   config.batch_norm_momentum,
@@ -232,7 +249,7 @@ def resnetb_strided_block(layer_ind, inputs, features, radius, fdim, config, tra
 
     with tf.variable_scope('conv1'):
         w = weight_variable([int(features.shape[1]), fdim // 2])
-        x = conv_ops.unary_convolution(features, w)
+        x = conv_ops.unary_convolution(features, w, get_compute_dtype(config))
         x = leaky_relu(batch_norm(x,
                                   config.use_batch_norm,
                                   config.batch_norm_momentum,
@@ -255,7 +272,7 @@ def resnetb_strided_block(layer_ind, inputs, features, radius, fdim, config, tra
 
     with tf.variable_scope('conv3'):
         w = weight_variable([int(x.shape[1]), 2 * fdim])
-        x = conv_ops.unary_convolution(x, w)
+        x = conv_ops.unary_convolution(x, w, get_compute_dtype(config))
         x = batch_norm(x,
                        config.use_batch_norm,
                        config.batch_norm_momentum,
@@ -269,7 +286,7 @@ def resnetb_strided_block(layer_ind, inputs, features, radius, fdim, config, tra
         # Regular upsample of the features if not the same dimension
         if int(shortcut.shape[1]) != 2 * fdim:
             w = weight_variable([int(shortcut.shape[1]), 2 * fdim])
-            shortcut = conv_ops.unary_convolution(shortcut, w)
+            shortcut = conv_ops.unary_convolution(shortcut, w, get_compute_dtype(config))
             shortcut = batch_norm(shortcut,
                                   config.use_batch_norm,
                                   config.batch_norm_momentum,
@@ -285,7 +302,7 @@ def resnetb_deformable_block(layer_ind, inputs, features, radius, fdim, config,
 
     with tf.variable_scope('conv1'):
         w = weight_variable([int(features.shape[1]), fdim // 2])
-        x = conv_ops.unary_convolution(features, w)
+        x = conv_ops.unary_convolution(features, w, get_compute_dtype(config))
         x = leaky_relu(batch_norm(x,
                                   config.use_batch_norm,
                                   config.batch_norm_momentum,
@@ -308,7 +325,7 @@ def resnetb_deformable_block(layer_ind, inputs, features, radius, fdim, config,
 
     with tf.variable_scope('conv3'):
         w = weight_variable([int(x.shape[1]), 2 * fdim])
-        x = conv_ops.unary_convolution(x, w)
+        x = conv_ops.unary_convolution(x, w, get_compute_dtype(config))
         x = batch_norm(x,
                        config.use_batch_norm,
                        config.batch_norm_momentum,
@@ -317,7 +334,7 @@ def resnetb_deformable_block(layer_ind, inputs, features, radius, fdim, config,
     with tf.variable_scope('shortcut'):
         if int(features.shape[1]) != 2 * fdim:
             w = weight_variable([int(features.shape[1]), 2 * fdim])
-            shortcut = conv_ops.unary_convolution(features, w)
+            shortcut = conv_ops.unary_convolution(features, w, get_compute_dtype(config))
             shortcut = batch_norm(shortcut,
                                   config.use_batch_norm,
                                   config.batch_norm_momentum,
@@ -335,7 +352,7 @@ def resnetb_deformable_strided_block(layer_ind, inputs, features, radius, fdim,
 
     with tf.variable_scope('conv1'):
         w = weight_variable([int(features.shape[1]), fdim // 2])
-        x = conv_ops.unary_convolution(features, w)
+        x = conv_ops.unary_convolution(features, w, get_compute_dtype(config))
         x = leaky_relu(batch_norm(x,
                                   config.use_batch_norm,
                                   config.batch_norm_momentum,
@@ -358,7 +375,7 @@ def resnetb_deformable_strided_block(layer_ind, inputs, features, radius, fdim,
 
     with tf.variable_scope('conv3'):
         w = weight_variable([int(x.shape[1]), 2 * fdim])
-        x = conv_ops.unary_convolution(x, w)
+        x = conv_ops.unary_convolution(x, w, get_compute_dtype(config))
         x = batch_norm(x,
                        config.use_batch_norm,
                        config.batch_norm_momentum,
@@ -372,7 +389,7 @@ def resnetb_deformable_strided_block(layer_ind, inputs, features, radius, fdim,
         # Regular upsample of the features if not the same dimension
         if int(shortcut.shape[1]) != 2 * fdim:
             w = weight_variable([int(shortcut.shape[1]), 2 * fdim])
-            shortcut = conv_ops.unary_convolution(shortcut, w)
+            shortcut = conv_ops.unary_convolution(shortcut, w, get_compute_dtype(config))
             shortcut = batch_norm(shortcut,
                                   config.use_batch_norm,
                                   config.batch_norm_momentum,
@@ -651,19 +668,19 @@ def coarse_head(features, config, dropout_prob):
     # Fully connected layer2
     with tf.variable_scope('fc1'):
         w = weight_variable([int(features.shape[1]), 1024])
-        features = leaky_relu(batch_norm(tf.matmul(features, w),
+        features = leaky_relu(batch_norm(conv_ops.unary_convolution(features, w, get_compute_dtype(config)),
                                          config.use_batch_norm,
                                          config.batch_norm_momentum,
                                          training))
     with tf.variable_scope('fc2'):
         w = weight_variable([1024, 1024])
-        features = leaky_relu(batch_norm(tf.matmul(features, w),
+        features = leaky_relu(batch_norm(conv_ops.unary_convolution(features, w, get_compute_dtype(config)),
                                          config.use_batch_norm,
                                          config.batch_norm_momentum,
                                          training))
     with tf.variable_scope('fc3'):
         w = weight_variable([1024, config.num_coarse * 3])
-        features = leaky_relu(batch_norm(tf.matmul(features, w),
+        features = leaky_relu(batch_norm(conv_ops.unary_convolution(features, w, get_compute_dtype(config)),
                                          config.use_batch_norm,
                                          config.batch_norm_momentum,
                                          training))
@@ -708,21 +725,21 @@ def assemble_decoder(inputs, config, dropout_prob, bottleneck_features, coarse,
         feat = tf.reshape(feat, [-1, grid_feat.shape[-1] + point_feat.shape[-1] + global_feat.shape[-1]])
 
         w = weight_variable([int(feat.shape[1]), 512])
-        x = conv_ops.unary_convolution(feat, w)
+        x = conv_ops.unary_convolution(feat, w, get_compute_dtype(config))
         x = leaky_relu(batch_norm(x,
                                   config.use_batch_norm,
                                   config.batch_norm_momentum,
                                   training))
 
         w = weight_variable([int(x.shape[1]), 512])
-        x = conv_ops.unary_convolution(x, w)
+        x = conv_ops.unary_convolution(x, w, get_compute_dtype(config))
         x = leaky_relu(batch_norm(x,
                                   config.use_batch_norm,
                                   config.batch_norm_momentum,
                                   training))
 
         w = weight_variable([int(x.shape[1]), 3])
-        x = conv_ops.unary_convolution(x, w)
+        x = conv_ops.unary_convolution(x, w, get_compute_dtype(config))
         x = batch_norm(x,
                        config.use_batch_norm,
                        config.batch_norm_momentum,
@@ -736,21 +753,21 @@ def assemble_decoder(inputs, config, dropout_prob, bottleneck_features, coarse,
             x = tf.reshape(x, [-1, x.shape[-1]])
 
             w = weight_variable([int(x.shape[1]), 512])
-            x = conv_ops.unary_convolution(x, w)
+            x = conv_ops.unary_convolution(x, w, get_compute_dtype(config))
             x = leaky_relu(batch_norm(x,
                                       config.use_batch_norm,
                                       config.batch_norm_momentum,
                                       training))
 
             w = weight_variable([int(x.shape[1]), 512])
-            x = conv_ops.unary_convolution(x, w)
+            x = conv_ops.unary_convolution(x, w, get_compute_dtype(config))
             x = leaky_relu(batch_norm(x,
                                       config.use_batch_norm,
                                       config.batch_norm_momentum,
                                       training))
 
             w = weight_variable([int(x.shape[1]), 3])
-            x = conv_ops.unary_convolution(x, w)
+            x = conv_ops.unary_convolution(x, w, get_compute_dtype(config))
             x = batch_norm(x,
                            config.use_batch_norm,
                            config.batch_norm_momentum,
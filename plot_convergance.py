@@ -6,8 +6,8 @@
 # Common libs
 import numpy as np
 import matplotlib.pyplot as plt
-from os.path import isfile, join, exists
-from os import listdir
+from os.path import isfile, join, exists, getsize
+from os import listdir, replace
 
 # My libs
 from utils.config import Config
@@ -41,39 +41,99 @@ def running_mean(signal, n, axis=0):
         return None
 
 
-def load_training_results(path):
-    filename = join(path, 'training.txt')
-    epochs = []
-    steps = []
-    L_out = []
-    L_reg = []
-    L_p = []
-    coarse_EM = []
-    fine_CD = []
-    mixed_loss = []
-    t = []
-    memory = []
-    with open(filename, 'r') as f:
-        for line in f:
+class TrainingLog:
+    """
+    Incremental reader of training.txt. Decoded columns are cached in training_cache.npz next to the log, and each
+    update only parses the lines appended since the previous one, so that a running training can be monitored cheaply.
+    """
+
+    columns = ['epoch', 'steps', 'out_loss', 'reg_loss', 'point_loss', 'coarse_EM', 'fine_CD', 'mixed_loss', 'time',
+               'memory']
+
+    # Bytes before the cached offset used to check that the log is still the one that was cached
+    signature_size = 256
+
+    def __init__(self, path, cache=True):
+        """
+        :param path: log folder of the training
+        :param cache: read and write the cache file of decoded columns
+        """
+        self.filename = join(path, 'training.txt')
+        self.cache_file = join(path, 'training_cache.npz') if cache else None
+        self.data = np.zeros((0, len(self.columns)))
+        self.offset = 0
+        if self.cache_file is not None and exists(self.cache_file):
+            self.load_cache()
+
+    def signature(self, offset):
+        with open(self.filename, 'rb') as f:
+            f.seek(max(0, offset - self.signature_size))
+            return np.frombuffer(f.read(min(offset, self.signature_size)), dtype=np.uint8)
+
+    def load_cache(self):
+        with np.load(self.cache_file) as cache:
+            offset = int(cache['offset'])
+            # The log may have been restarted since the cache was written
+            if getsize(self.filename) >= offset and np.array_equal(self.signature(offset), cache['signature']):
+                self.data = cache['data']
+                self.offset = offset
+
+    def save_cache(self):
+        tmp_file = self.cache_file + '.tmp.npz'
+        np.savez(tmp_file, data=self.data, offset=self.offset, signature=self.signature(self.offset))
+        replace(tmp_file, self.cache_file)
+
+    def parse(self, chunk):
+        """
+        Decode complete lines, in a single call when they all have the right number of values
+        """
+        num_lines = chunk.count(b'\n')
+        try:
+            values = np.fromstring(chunk.decode(), sep=' ')
+        except ValueError:
+            values = None
+        if values is not None and values.size == num_lines * len(self.columns):
+            return values.reshape(num_lines, len(self.columns))
+
+        # Header or broken lines, fall back to a line by line parsing skipping them
+        rows = []
+        for line in chunk.splitlines():
             line_info = line.split()
-            if len(line) > 0:
-                try:
-                    epochs += [int(line_info[0])]
-                    steps += [int(line_info[1])]
-                    L_out += [float(line_info[2])]
-                    L_reg += [float(line_info[3])]
-                    L_p += [float(line_info[4])]
-                    coarse_EM += [float(line_info[5])]
-                    fine_CD += [float(line_info[6])]
-                    mixed_loss += [float(line_info[7])]
-                    t += [float(line_info[8])]
-                    memory += [float(line_info[9])]
-                except ValueError as e:
-                    print("error", e, "on line", epochs[-1])
-            else:
-                break
+            try:
+                if len(line_info) == len(self.columns):
+                    rows.append([float(v) for v in line_info])
+            except ValueError:
+                pass
+        return np.array(rows, dtype=np.float64).reshape(-1, len(self.columns))
+
+    def update(self):
+        """
+        Read the lines appended since the last update
+        :return: number of new lines
+        """
+        with open(self.filename, 'rb') as f:
+            f.seek(self.offset)
+            chunk = f.read()
+
+        # Only complete lines, the training may be writing the last one
+        chunk = chunk[:chunk.rfind(b'\n') + 1]
+        if len(chunk) == 0:
+            return 0
+        new_data = self.parse(chunk)
+        self.data = np.vstack((self.data, new_data))
+        self.offset += len(chunk)
+        if self.cache_file is not None:
+            self.save_cache()
+        return new_data.shape[0]
+
+    def column(self, name):
+        return self.data[:, self.columns.index(name)]
 
-    return steps, L_out, L_reg, L_p, coarse_EM, fine_CD, mixed_loss, t, memory
+
+def load_training_results(path):
+    log = TrainingLog(path)
+    log.update()
+    return tuple([log.column(name) for name in TrainingLog.columns[1:]])
 
 
 def load_validation_results(path):
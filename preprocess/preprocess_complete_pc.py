@@ -5,27 +5,45 @@ import logging
 import tqdm
 import multiprocessing
 import argparse
+import time
 
 from utils import common
+from utils.manifest import BuildManifest
 
 # CONFIG THESE PARAMS --------------------
 src_dataset_dir = "/Volumes/warm_blue/datasets/ShapeNetV1"
 dataset = "shapenetV1"
 split_type = "valid"  # train/valid/test/test_novel
 executable = "sample/build/mesh_sampling"
+additional_args = ["-no_vis_result"]  # additional args here like no vis etc...
 
 
 # ----------------------------------------786f18c5f99f7006b1d1509c24a9f631
 
-def process_mesh(mesh_filepath, target_filepath, exe):
-    logging.info(mesh_filepath + " --> " + target_filepath)
-    additional_args = ["-no_vis_result"]  # additional args here like no vis etc...
+def process_mesh(mesh_filepath, target_filepath, exe, timeout=None):
+    """
+    Sample the complete point cloud of one mesh
+    :return: None on success, else the reason of the failure
+    """
+    logging.debug(mesh_filepath + " --> " + target_filepath)
     command = [exe, mesh_filepath, target_filepath] + additional_args
 
-    subproc = subprocess.Popen(command)
-    subproc.wait()
+    # Remove outputs of interrupted runs, so that only finished samplings are found on disk
+    if os.path.isfile(target_filepath):
+        os.remove(target_filepath)
 
-    logging.info(target_filepath + " complete point cloud generated using uniform sampling.")
+    try:
+        subproc = subprocess.run(command, stdout=subprocess.DEVNULL, stderr=subprocess.PIPE, timeout=timeout)
+    except subprocess.TimeoutExpired:
+        return 'timeout after %d s' % timeout
+
+    if subproc.returncode != 0:
+        return 'exit code %d: %s' % (subproc.returncode, subproc.stderr.decode(errors='replace').strip()[-200:])
+    if not os.path.isfile(target_filepath):
+        return 'no output file'
+
+    logging.debug(target_filepath + " complete point cloud generated using uniform sampling.")
+    return None
 
 
 if __name__ == '__main__':
@@ -36,33 +54,79 @@ if __name__ == '__main__':
                     "complete uniformly sampled point clouds",
     )
     common.add_common_args(arg_parser)
+    arg_parser.add_argument("--num_workers", type=int, default=multiprocessing.cpu_count(),
+                            help="number of sampling processes running at the same time")
+    arg_parser.add_argument("--timeout", type=int, default=600,
+                            help="seconds after which the sampling of a model is killed and reported as failed")
+    arg_parser.add_argument("--redo", default=False, action="store_true",
+                            help="If set, the manifest is ignored and all models are sampled again")
+    arg_parser.add_argument("--save_every", type=int, default=60,
+                            help="seconds between two saves of the manifest during the run")
     args = arg_parser.parse_args()
     common.configure_logging(args)
 
     root_dir = os.path.dirname(os.path.dirname(os.path.realpath(__file__)))
     model_list_file = os.path.join(root_dir, 'data', dataset, '%s.list' % split_type)
     target_data_dir = os.path.join(root_dir, 'data', dataset, split_type, 'complete')
-    num_threads = multiprocessing.cpu_count()
+    manifest_file = os.path.join(target_data_dir, 'manifest.json')
+    failed_file = os.path.join(target_data_dir, 'failed.txt')
+    os.makedirs(target_data_dir, exist_ok=True)
 
     with open(model_list_file) as file:
         model_list = file.read().splitlines()
         file.close()
 
-    for i, cat_model_id in tqdm.tqdm(enumerate(model_list)):
+    def source_file(cat_model_id):
+        return os.path.join(src_dataset_dir, cat_model_id, 'model.obj')
 
+    def target_file(cat_model_id):
         cat, model_id = cat_model_id.split('/')
+        return os.path.join(target_data_dir, cat, '%s.ply' % model_id)
+
+    # A model is done when its mesh, its output and the sampling parameters did not change since it was recorded
+    manifest = BuildManifest(manifest_file, {'executable': executable, 'args': additional_args})
+    if not manifest.exists and not args.redo:
+        # Outputs of runs made before manifests existed are trusted like before
+        for m in model_list:
+            if os.path.isfile(target_file(m)) and os.path.isfile(source_file(m)):
+                manifest.record(m, [source_file(m)], [target_file(m)])
+        manifest.save()
+
+    todo = [m for m in model_list if args.redo or not manifest.is_current(m, [source_file(m)], [target_file(m)])]
+    for cat in set([m.split('/')[0] for m in todo]):
         if not os.path.isdir(os.path.join(target_data_dir, cat)):
             os.makedirs(os.path.join(target_data_dir, cat))
 
-        target_mesh_file = os.path.join(target_data_dir, cat, '%s.ply' % model_id)
-        if not os.path.isfile(target_mesh_file):
-            mesh_src_file = os.path.join(src_dataset_dir, cat, model_id, 'model.obj')
-            with concurrent.futures.ThreadPoolExecutor(max_workers=int(num_threads)) as executor:
-                executor.submit(
-                    process_mesh,
-                    mesh_src_file,
-                    target_mesh_file,
-                    executable
-                )
-
-            executor.shutdown()
+    logging.info('%d models to sample (%d up to date) with %d workers' % (len(todo), len(model_list) - len(todo),
+                                                                         args.num_workers))
+
+    failures = []
+    last_save = time.time()
+    with concurrent.futures.ThreadPoolExecutor(max_workers=args.num_workers) as executor:
+        futures = {executor.submit(process_mesh,
+                                   source_file(m),
+                                   target_file(m),
+                                   executable,
+                                   args.timeout): m for m in todo}
+
+        for future in tqdm.tqdm(concurrent.futures.as_completed(futures), total=len(futures)):
+            cat_model_id = futures[future]
+            error = future.result()
+            if error is None:
+                manifest.record(cat_model_id, [source_file(cat_model_id)], [target_file(cat_model_id)])
+            else:
+                logging.warning(cat_model_id + ' failed: ' + error)
+                manifest.remove(cat_model_id)
+                failures.append((cat_model_id, error))
+
+            # Regular saves, so that an interrupted run resumes from here
+            if time.time() - last_save > args.save_every:
+                manifest.save()
+                last_save = time.time()
+
+    manifest.save()
+    with open(failed_file, 'w') as file:
+        file.write(''.join(['%s\t%s\n' % (m, e) for m, e in failures]))
+
+    logging.info('%d models sampled, %d failed (listed in %s)' % (len(todo) - len(failures), len(failures),
+                                                                  failed_file))
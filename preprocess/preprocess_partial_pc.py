@@ -4,8 +4,12 @@ import logging
 import os
 import multiprocessing
 import argparse
+import threading
+import time
 
 from utils import common
+from utils.manifest import BuildManifest
+from render.process_exr import exr_to_pcd
 
 # CONFIG THESE PARAMS --------------------
 src_dataset_dir = "/Volumes/warm_blue/datasets/ShapeNetV1"
@@ -17,33 +21,74 @@ blender_path = "/Volumes/warm_blue/blender-git/build_darwin_full/bin/Blender.app
 
 # ----------------------------------------
 
-def simulate_depth_scan(cat_model_id, target_mesh_dir):
-    logging.info(cat_model_id + " --> " + target_mesh_dir + " : " + str(num_scans) + " scans")
-
-    # simulate depth scan via blender virtual render
+class PipelineProgress:
+    """
+    Thread safe counters of the rendering and conversion stages, logged at most once per second
+    """
+
+    def __init__(self, num_models):
+        self.num_models = num_models
+        self.rendered = 0
+        self.converted = 0
+        self.failed = 0
+        self.t0 = time.time()
+        self.last_display = self.t0
+        self.lock = threading.Lock()
+
+    def update(self, rendered=0, converted=0, failed=0, force=False):
+        with self.lock:
+            self.rendered += rendered
+            self.converted += converted
+            self.failed += failed
+            t = time.time()
+            if force or t - self.last_display > 1.0:
+                self.last_display = t
+                logging.info(self.message(t))
+
+    def message(self, t):
+        dt = max(t - self.t0, 1e-6)
+        return 'rendered {:d}/{:d} ({:.2f} models/s) - converted {:d}/{:d} ({:.2f} models/s) - failed {:d}'.format(
+            self.rendered, self.num_models, self.rendered / dt,
+            self.converted, self.num_models, self.converted / dt,
+            self.failed)
+
+
+def render_batch(batch_index, cat_model_ids, on_rendered):
+    """
+    Render the depth scans of a batch of models with a single Blender process. on_rendered is called with each
+    cat_model_id as soon as its scans are written, so that conversion starts while Blender renders the next models.
+    """
+    logging.info('batch %d: rendering %d models' % (batch_index, len(cat_model_ids)))
+
+    batch_dir = os.path.join(render_out_dir, 'batches')
+    os.makedirs(batch_dir, exist_ok=True)
+    batch_file = os.path.join(batch_dir, 'batch_%d.list' % batch_index)
+    with open(batch_file, 'w') as file:
+        file.write('\n'.join(cat_model_ids) + '\n')
+
+    # simulate depth scans via blender virtual render
     command = [blender_path,
                '-b',
                '-P',
                os.path.join(os.path.dirname(os.path.realpath(__file__)), 'render', "render_depth.py"),
                src_dataset_dir,
-               cat_model_id,
+               batch_file,
                render_out_dir,
                str(num_scans)]
 
-    subproc_render = subprocess.Popen(command)
+    rendered = []
+    subproc_render = subprocess.Popen(command, stdout=subprocess.PIPE, universal_newlines=True)
+    for line in subproc_render.stdout:
+        if line.startswith('RENDERED '):
+            cat_model_id = line.split()[1]
+            rendered.append(cat_model_id)
+            on_rendered(cat_model_id)
     subproc_render.wait()
 
-    # generate_partial_point_cloud
-    command = ['python',
-               os.path.join(os.path.dirname(os.path.realpath(__file__)), 'render', "process_exr.py"),
-               cat_model_id,
-               target_data_dir,
-               str(num_scans)]
-
-    subproc_gen_pc = subprocess.Popen(command)
-    subproc_gen_pc.wait()
-
-    logging.info(target_mesh_dir + " partial point cloud generated.")
+    if subproc_render.returncode != 0:
+        logging.warning('batch %d: blender exited with code %d' % (batch_index, subproc_render.returncode))
+    rendered = set(rendered)
+    return [m for m in cat_model_ids if m not in rendered]
 
 
 if __name__ == '__main__':
@@ -54,6 +99,20 @@ if __name__ == '__main__':
                     "partial point clouds via virtual depth rendering",
     )
     common.add_common_args(arg_parser)
+    arg_parser.add_argument("--batch_size", type=int, default=32,
+                            help="number of models rendered by each Blender process")
+    arg_parser.add_argument("--num_blender", type=int, default=max(1, multiprocessing.cpu_count() // 2),
+                            help="number of Blender processes running at the same time")
+    arg_parser.add_argument("--num_converters", type=int, default=max(1, multiprocessing.cpu_count() // 2),
+                            help="number of processes converting EXR depth images into point clouds")
+    arg_parser.add_argument("--format", choices=['ply', 'h5', 'npy'], default='ply',
+                            help="file format of the partial point clouds")
+    arg_parser.add_argument("--depth_png", default=False, action="store_true",
+                            help="If set, 16 bit PNG depth images are also written")
+    arg_parser.add_argument("--redo", default=False, action="store_true",
+                            help="If set, the manifest is ignored and all models are processed again")
+    arg_parser.add_argument("--save_every", type=int, default=60,
+                            help="seconds between two saves of the manifest during the run")
     args = arg_parser.parse_args()
     common.configure_logging(args)
 
@@ -61,7 +120,6 @@ if __name__ == '__main__':
     model_list_file = os.path.join(root_dir, 'data', dataset, '%s.list' % split_type)
     target_data_dir = os.path.join(root_dir, 'data', dataset, split_type, 'partial')
     render_out_dir = os.path.join(os.path.dirname(os.path.realpath(__file__)), 'render', "render_out")
-    num_threads = multiprocessing.cpu_count()
 
     with open(model_list_file) as file:
         model_list = file.read().splitlines()
@@ -70,27 +128,66 @@ if __name__ == '__main__':
     # if os.path.isdir(render_out_dir):
     #     os.rmdir(render_out_dir)
 
-    with concurrent.futures.ThreadPoolExecutor(max_workers=int(num_threads)) as executor:
-        for i, cat_model_id in enumerate(model_list):
-
-            cat, model_id = cat_model_id.split('/')
-            if not os.path.isdir(os.path.join(target_data_dir, cat)):
-                os.makedirs(os.path.join(target_data_dir, cat))
-
-            target_mesh_dir = os.path.join(target_data_dir, cat, model_id)
-            if not os.path.isdir(target_mesh_dir):
-                os.makedirs(target_mesh_dir)
-
-            # Check if num_scans matches with existing num of files in target dir - if not, only then preprocess
-            # TODO: fix case where num scan < num of plys in mesh dir
-            if num_scans != len([f for f in os.listdir(target_mesh_dir)
-                                 if f.endswith('.ply') and os.path.isfile(os.path.join(target_mesh_dir, f))]):
-                mesh_src_file = os.path.join(src_dataset_dir, cat, model_id, 'model.obj')
-
-                executor.submit(
-                    simulate_depth_scan,
-                    cat_model_id,
-                    target_mesh_dir
-                )
-
-        executor.shutdown()
+    def source_files(cat_model_id):
+        return [os.path.join(src_dataset_dir, cat_model_id, 'model.obj')]
+
+    def target_files(cat_model_id):
+        return [os.path.join(target_data_dir, cat_model_id, '%d.%s' % (i, args.format)) for i in range(num_scans)]
+
+    # A model is done when its mesh, its scans and the parameters did not change since it was recorded
+    os.makedirs(target_data_dir, exist_ok=True)
+    manifest = BuildManifest(os.path.join(target_data_dir, 'manifest.json'),
+                             {'num_scans': num_scans, 'format': args.format})
+    if not manifest.exists and not args.redo:
+        # Outputs of runs made before manifests existed are trusted like before
+        for cat_model_id in model_list:
+            if all([os.path.isfile(f) for f in source_files(cat_model_id) + target_files(cat_model_id)]):
+                manifest.record(cat_model_id, source_files(cat_model_id), target_files(cat_model_id))
+        manifest.save()
+
+    todo = [m for m in model_list
+            if args.redo or not manifest.is_current(m, source_files(m), target_files(m))]
+
+    logging.info('%d models to preprocess (%d up to date)' % (len(todo), len(model_list) - len(todo)))
+    progress = PipelineProgress(len(todo))
+    last_save = time.time()
+
+    # Conversion workers are started once, they import open3d and OpenEXR a single time
+    with multiprocessing.Pool(args.num_converters) as converters:
+
+        def converted(cat_model_id):
+            global last_save
+            logging.debug(os.path.join(target_data_dir, cat_model_id) + " partial point cloud generated.")
+            manifest.record(cat_model_id, source_files(cat_model_id), target_files(cat_model_id))
+            progress.update(converted=1)
+
+            # Regular saves, so that an interrupted run resumes from here
+            if time.time() - last_save > args.save_every:
+                manifest.save()
+                last_save = time.time()
+
+        def conversion_failed(error):
+            logging.error('EXR conversion failed: %s' % error)
+            progress.update(failed=1)
+
+        def rendered(cat_model_id):
+            progress.update(rendered=1)
+            converters.apply_async(exr_to_pcd,
+                                   (cat_model_id, target_data_dir, num_scans, render_out_dir, args.format,
+                                    args.depth_png),
+                                   callback=converted, error_callback=conversion_failed)
+
+        batches = [todo[i:i + args.batch_size] for i in range(0, len(todo), args.batch_size)]
+        with concurrent.futures.ThreadPoolExecutor(max_workers=args.num_blender) as executor:
+            futures = [executor.submit(render_batch, b, batch, rendered) for b, batch in enumerate(batches)]
+            for future in concurrent.futures.as_completed(futures):
+                missing = future.result()
+                if missing:
+                    logging.error('not rendered: ' + ', '.join(missing))
+                    progress.update(failed=len(missing))
+
+        converters.close()
+        converters.join()
+
+    manifest.save()
+    progress.update(force=True)
@@ -3,7 +3,8 @@
 import Imath
 import OpenEXR
 import argparse
-import array
+import functools
+import h5py
 import numpy as np
 import os
 import open3d as o3d
@@ -11,13 +12,21 @@ import open3d as o3d
 
 def read_exr(exr_path, height, width):
     file = OpenEXR.InputFile(exr_path)
-    depth_arr = array.array('f', file.channel('R', Imath.PixelType(Imath.PixelType.FLOAT)))
-    depth = np.array(depth_arr).reshape((height, width))
+    depth_bytes = file.channel('R', Imath.PixelType(Imath.PixelType.FLOAT))
+    depth = np.frombuffer(depth_bytes, dtype=np.float32).reshape((height, width)).astype(np.float64)
     depth[depth < 0] = 0
     depth[np.isinf(depth)] = 0
     return depth
 
 
+def read_pose(pose_path):
+    """
+    4x4 camera pose written by render_depth.py (faster than np.loadtxt for these small files)
+    """
+    with open(pose_path, 'r') as f:
+        return np.array(f.read().split(), dtype=np.float64).reshape((4, 4))
+
+
 def depth2pcd(depth, intrinsics, pose):
     inv_K = np.linalg.inv(intrinsics)
     inv_K[2, 2] = -1
@@ -30,33 +39,101 @@ def depth2pcd(depth, intrinsics, pose):
     return points
 
 
-if __name__ == '__main__':
-    parser = argparse.ArgumentParser()
-    parser.add_argument('cat_model_id')
-    parser.add_argument('ply_output_dir')  # e.g. /kpcn/data/shapenetV1/train/partial
-    parser.add_argument('num_scans', type=int)
-    args = parser.parse_args()
+@functools.lru_cache(maxsize=8)
+def pixel_rays(intrinsics, height, width):
+    """
+    Camera coordinates of every pixel at unit depth, in the row major order of the flipped depth image
+    :param intrinsics: 3x3 intrinsics as a tuple of tuples (hashable for the cache)
+    :return: (height * width, 3) array
+    """
+    inv_K = np.linalg.inv(np.array(intrinsics))
+    inv_K[2, 2] = -1
+    y, x = np.mgrid[0:height, 0:width]
+    pixels = np.stack([x.ravel(), y.ravel(), np.ones(height * width)], 1)
+    return np.dot(pixels, inv_K.T)
+
+
+def depth2pcd_batch(depths, intrinsics, poses):
+    """
+    Same back-projection as depth2pcd for a stack of scans sharing the same intrinsics, in one vectorized pass
+    :param depths: (S, height, width) depth images
+    :param intrinsics: 3x3 intrinsics
+    :param poses: (S, 4, 4) camera poses
+    :return: list of S (N_s, 3) point clouds
+    """
+    num_scans, height, width = depths.shape
+    rays = pixel_rays(tuple(map(tuple, intrinsics)), height, width)
+    depths = depths[:, ::-1, :].reshape((num_scans, -1))
+    valid = depths > 0
+
+    # Only pixels with depth are projected, then split back by scan
+    scan_inds, pixel_inds = np.nonzero(valid)
+    camera_points = rays[pixel_inds] * depths[scan_inds, pixel_inds][:, None]
+    points = np.einsum('nij,nj->ni', poses[scan_inds, :3, :3], camera_points) + poses[scan_inds, :3, 3]
+    return np.split(points, np.cumsum(np.sum(valid, axis=1))[:-1])
+
+
+def save_h5(path, points):
+    """
+    Point cloud in the 'data' dataset of a h5 file, as read by utils.data.load_h5
+    """
+    with h5py.File(path, 'w') as f:
+        f.create_dataset('data', data=points)
 
-    render_output_dir = os.path.join(os.path.dirname(os.path.realpath(__file__)), 'render_out')
+
+def exr_to_pcd(cat_model_id, ply_output_dir, num_scans, render_output_dir=None, output_format='ply',
+               write_depth=False):
+    """
+    Convert the rendered scans of a model into point clouds, and optionally 16 bit PNG depth images
+    :param output_format: 'ply', 'h5' or 'npy' files of the point clouds
+    :param write_depth: also write the PNG depth images
+    """
+    if render_output_dir is None:
+        render_output_dir = os.path.join(os.path.dirname(os.path.realpath(__file__)), 'render_out')
 
     intrinsics = np.loadtxt(os.path.join(render_output_dir, 'intrinsics.txt'))
     width = int(intrinsics[0, 2] * 2)
     height = int(intrinsics[1, 2] * 2)
 
-    depth_dir = os.path.join(render_output_dir, 'depth', args.cat_model_id)
-    ply_dir = os.path.join(args.ply_output_dir, args.cat_model_id)
-    os.makedirs(depth_dir, exist_ok=True)
+    depth_dir = os.path.join(render_output_dir, 'depth', cat_model_id)
+    ply_dir = os.path.join(ply_output_dir, cat_model_id)
     os.makedirs(ply_dir, exist_ok=True)
-    for i in range(args.num_scans):
-        exr_path = os.path.join(render_output_dir, 'exr', args.cat_model_id, '%d.exr' % i)
-        pose_path = os.path.join(render_output_dir, 'pose', args.cat_model_id, '%d.txt' % i)
-
-        depth = read_exr(exr_path, height, width)
-        depth_img = o3d.geometry.Image(np.uint16(depth * 1000))
-        o3d.io.write_image(os.path.join(depth_dir, '%d.png' % i), depth_img)
-
-        pose = np.loadtxt(pose_path)
-        points = depth2pcd(depth, intrinsics, pose)
-        cloud = o3d.geometry.PointCloud()
-        cloud.points = o3d.utility.Vector3dVector(points)
-        o3d.io.write_point_cloud(os.path.join(ply_dir, '%d.ply' % i), cloud)
+
+    # All scans of the model are back-projected together
+    depths = np.stack([read_exr(os.path.join(render_output_dir, 'exr', cat_model_id, '%d.exr' % i), height, width)
+                       for i in range(num_scans)])
+    poses = np.stack([read_pose(os.path.join(render_output_dir, 'pose', cat_model_id, '%d.txt' % i))
+                      for i in range(num_scans)])
+    clouds = depth2pcd_batch(depths, intrinsics, poses)
+
+    if write_depth:
+        os.makedirs(depth_dir, exist_ok=True)
+        for i in range(num_scans):
+            depth_img = o3d.geometry.Image(np.uint16(depths[i] * 1000))
+            o3d.io.write_image(os.path.join(depth_dir, '%d.png' % i), depth_img)
+
+    for i, points in enumerate(clouds):
+        cloud_file = os.path.join(ply_dir, '%d.%s' % (i, output_format))
+        if output_format == 'h5':
+            save_h5(cloud_file, points)
+        elif output_format == 'npy':
+            np.save(cloud_file, points)
+        else:
+            cloud = o3d.geometry.PointCloud()
+            cloud.points = o3d.utility.Vector3dVector(points)
+            o3d.io.write_point_cloud(cloud_file, cloud)
+
+    return cat_model_id
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('cat_model_id')
+    parser.add_argument('ply_output_dir')  # e.g. /kpcn/data/shapenetV1/train/partial
+    parser.add_argument('num_scans', type=int)
+    parser.add_argument('--format', choices=['ply', 'h5', 'npy'], default='ply', help='file format of point clouds')
+    parser.add_argument('--depth_png', action='store_true', help='also write 16 bit PNG depth images')
+    args = parser.parse_args()
+
+    exr_to_pcd(args.cat_model_id, args.ply_output_dir, args.num_scans,
+               output_format=args.format, write_depth=args.depth_png)
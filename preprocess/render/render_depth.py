@@ -12,6 +12,8 @@ mathutils = importlib.import_module("mathutils")
 
 
 # Usage: blender -b -P render_depth.py [ShapeNet directory] [model list] [output directory] [num scans per model]
+# [model list] is either one cat_model_id or a .list file of cat_model_ids rendered by the same Blender process.
+# A line 'RENDERED <cat_model_id>' is printed on stdout as soon as the scans of a model are written.
 
 
 def random_pose():
@@ -63,36 +65,12 @@ def setup_blender(width, height, focal_length):
     return scene, camera, output
 
 
-if __name__ == '__main__':
-    model_dir = sys.argv[-4]
-    cat_model_id = sys.argv[-3]  # 03797390/1a1c0a8d4bad82169f0594e65f756cf5
-    output_dir = sys.argv[-2]
-    num_scans = int(sys.argv[-1])
-
-    width = 160
-    height = 120
-    focal = 100
-    scene, camera, output = setup_blender(width, height, focal)
-    intrinsics = np.array([[focal, 0, width / 2], [0, focal, height / 2], [0, 0, 1]])
-
-    blender_log_file = os.path.join(os.path.dirname(os.path.realpath(__file__)), 'blender.log')
-    open(blender_log_file, 'w+').close()
-    if not os.path.isdir(output_dir):
-        os.makedirs(output_dir)
-    # os.system('rm -rf %s' % output_dir)
-    np.savetxt(os.path.join(output_dir, 'intrinsics.txt'), intrinsics, '%f')
-
-    start = time.time()
+def render_model(model_dir, cat_model_id, output_dir, num_scans, scene, camera, output):
     exr_dir = os.path.join(output_dir, 'exr', cat_model_id)
     pose_dir = os.path.join(output_dir, 'pose', cat_model_id)
     os.makedirs(exr_dir, exist_ok=True)
     os.makedirs(pose_dir, exist_ok=True)
 
-    # Redirect output to log file
-    old_os_out = os.dup(1)
-    os.close(1)
-    os.open(blender_log_file, os.O_WRONLY)
-
     # Import mesh model
     model_path = os.path.join(model_dir, cat_model_id, 'model.obj')
     bpy.ops.import_scene.obj(filepath=model_path)
@@ -117,8 +95,44 @@ if __name__ == '__main__':
         m.user_clear()
         bpy.data.materials.remove(m)
 
+
+if __name__ == '__main__':
+    model_dir = sys.argv[-4]
+    model_list = sys.argv[-3]  # 03797390/1a1c0a8d4bad82169f0594e65f756cf5 or a .list file
+    output_dir = sys.argv[-2]
+    num_scans = int(sys.argv[-1])
+
+    if model_list.endswith('.list'):
+        with open(model_list) as file:
+            cat_model_ids = file.read().splitlines()
+    else:
+        cat_model_ids = [model_list]
+
+    width = 160
+    height = 120
+    focal = 100
+    scene, camera, output = setup_blender(width, height, focal)
+    intrinsics = np.array([[focal, 0, width / 2], [0, focal, height / 2], [0, 0, 1]])
+
+    blender_log_file = os.path.join(os.path.dirname(os.path.realpath(__file__)), 'blender.log')
+    open(blender_log_file, 'w+').close()
+    if not os.path.isdir(output_dir):
+        os.makedirs(output_dir)
+    # os.system('rm -rf %s' % output_dir)
+    np.savetxt(os.path.join(output_dir, 'intrinsics.txt'), intrinsics, '%f')
+
+    # Redirect output to log file
+    old_os_out = os.dup(1)
+    os.close(1)
+    os.open(blender_log_file, os.O_WRONLY | os.O_APPEND)
+
+    # Blender and the scene are set up once for all models of the list
+    for cat_model_id in cat_model_ids:
+        start = time.time()
+        render_model(model_dir, cat_model_id, output_dir, num_scans, scene, camera, output)
+        os.write(old_os_out, ('RENDERED %s %.4f\n' % (cat_model_id, time.time() - start)).encode())
+
     # Show time
     os.close(1)
     os.dup(old_os_out)
     os.close(old_os_out)
-    print('%s done, time=%.4f sec' % (cat_model_id, time.time() - start))
@@ -15,10 +15,10 @@ import numpy as np
 import argparse
 
 # My libs
-from datasets.ShapeNetBenchmark2048 import ShapeNetBenchmark2048Dataset
 from utils.config import Config
 from utils.tester import ModelTester
 from models.KPCN_model import KernelPointCompletionNetwork
+from kitti_mmd import kitti_mmd
 
 # Datasets
 from datasets.kitti import KittiDataset
@@ -71,12 +71,6 @@ def test_caller(path, step_ind, kitti_dataset_path, shapenet_dataset_path):
     # Create subsample clouds of the models
     dataset.load_subsampled_clouds(dl0)
 
-    # Initiate ShapeNet dataset for use as DB in MMD metric  # TODO: for more efficiency, a car-only db could be used
-    shapenet2048_dataset = ShapeNetBenchmark2048Dataset(config.batch_num, config.num_input_points,
-                                                        shapenet_dataset_path)
-    # Create subsample clouds of the models
-    shapenet2048_dataset.load_subsampled_clouds(dl0)
-
     # Initialize test input pipeline
     dataset.init_test_input_pipeline(config)
 
@@ -115,7 +109,16 @@ def test_caller(path, step_ind, kitti_dataset_path, shapenet_dataset_path):
 
     print('Start Test')
     print('**********\n')
-    tester.test_kitti_completion(model, dataset, shapenet2048_dataset)
+    tester.test_kitti_completion(model, dataset,
+                                 write_pcd=not args.no_pcd,
+                                 write_array=args.completions_array,
+                                 num_writers=args.num_writers)
+
+    # MMD is a separate pass over the stored completions, against a car-only database built once
+    if args.mmd:
+        print('\nStart MMD')
+        print('*********\n')
+        kitti_mmd(path, kitti_dataset_path, shapenet_dataset_path, gpu=GPU_ID)
 
 
 if __name__ == '__main__':
@@ -125,6 +128,12 @@ if __name__ == '__main__':
     parser.add_argument('--kitti_dataset_path')
     parser.add_argument('--shapenet_dataset_path')
     parser.add_argument('--double_fold', action='store_true')
+    parser.add_argument('--no_pcd', action='store_true', help="do not write one .pcd file per completed car")
+    parser.add_argument('--completions_array', action='store_true',
+                        help="write all completions in visu/kitti/completions.npy (read by kitti_registration.py)")
+    parser.add_argument('--num_writers', type=int, default=4, help="number of threads writing .pcd files")
+    parser.add_argument('--mmd', action='store_true',
+                        help="compute the MMD of the stored completions against ShapeNet cars after the test")
     args = parser.parse_args()
 
     chosen_log = args.saving_path
@@ -133,5 +142,7 @@ if __name__ == '__main__':
     # Check if log exists
     if not os.path.exists(chosen_log):
         raise ValueError('The given log does not exists: ' + chosen_log)
+    if args.mmd and args.no_pcd and not args.completions_array:
+        raise ValueError('MMD is computed on stored completions, use it with .pcd files or --completions_array')
 
     test_caller(chosen_log, chosen_snapshot, args.kitti_dataset_path, args.shapenet_dataset_path)
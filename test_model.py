@@ -30,7 +30,8 @@ from datasets.ShapeNetBenchmark2048 import ShapeNetBenchmark2048Dataset
 #       \***********************/
 #
 
-def test_caller(path, step_ind, on_val, dataset_path, noise, calc_tsne):
+def test_caller(path, step_ind, on_val, dataset_path, noise, calc_tsne, num_votes=1, vote_fusion='consensus',
+                check_votes=False):
     ##########################
     # Initiate the environment
     ##########################
@@ -75,12 +76,14 @@ def test_caller(path, step_ind, on_val, dataset_path, noise, calc_tsne):
             config.validation_size = 1
             config.batch_num = 1
 
-    # Augmentations
-    config.augment_scale_anisotropic = True
-    config.augment_symmetries = [False, False, False]
-    config.augment_rotation = 'none'
-    config.augment_scale_min = 1.0
-    config.augment_scale_max = 1.0
+    # Augmentations. Votes keep the rotations and scales the model was trained with, unless they are checked
+    config.num_votes = num_votes
+    if num_votes == 1 or check_votes:
+        config.augment_scale_anisotropic = True
+        config.augment_symmetries = [False, False, False]
+        config.augment_rotation = 'none'
+        config.augment_scale_min = 1.0
+        config.augment_scale_max = 1.0
     config.augment_noise = noise
     config.augment_occlusion = 'none'
 
@@ -105,6 +108,9 @@ def test_caller(path, step_ind, on_val, dataset_path, noise, calc_tsne):
     else:
         raise ValueError('Unsupported dataset : ' + config.dataset)
 
+    # All votes of a cloud are completed in the same batch
+    config.batch_num *= num_votes
+
     # Initialize input pipelines
     if on_val:
         dataset.init_input_pipeline(config)
@@ -151,7 +157,7 @@ def test_caller(path, step_ind, on_val, dataset_path, noise, calc_tsne):
     print('**********\n')
 
     if config.dataset.startswith('ShapeNetV1') or config.dataset.startswith("pc_shapenetCompletionBenchmark2048"):
-        tester.test_completion(model, dataset, on_val, calc_tsne)
+        tester.test_completion(model, dataset, on_val, calc_tsne, vote_fusion=vote_fusion)
     else:
         raise ValueError('Unsupported dataset')
 
@@ -174,6 +180,12 @@ if __name__ == '__main__':
     parser.add_argument('--double_fold', action='store_true')
     parser.add_argument('--noise', type=float, default=0.0)
     parser.add_argument('--calc_tsne', action='store_true')
+    parser.add_argument('--num_votes', type=int, default=1, help="augmented copies of each validation cloud")
+    parser.add_argument('--vote_fusion', choices=['consensus', 'oracle'], default='consensus',
+                        help="consensus: vote closest to the other votes (chamfer)\n"
+                             "oracle: vote with the lowest coarse EMD to the ground truth (upper bound)")
+    parser.add_argument('--check_votes', action='store_true',
+                        help="votes without augmentation, checked against the distances of a single vote")
     args = parser.parse_args()
 
     ##########################
@@ -232,4 +244,5 @@ if __name__ == '__main__':
         raise ValueError('The given log does not exists: ' + chosen_log)
 
     # Let's go
-    test_caller(chosen_log, chosen_snapshot, args.on_val, args.dataset_path, args.noise, args.calc_tsne)
+    test_caller(chosen_log, chosen_snapshot, args.on_val, args.dataset_path, args.noise, args.calc_tsne,
+                args.num_votes, args.vote_fusion, args.check_votes)
@@ -0,0 +1,69 @@
+//
+//
+//		0==========================0
+//		|    Local feature test    |
+//		0==========================0
+//
+//		version 1.0 : 
+//			> 
+//
+//---------------------------------------------------
+//
+//		Parallel loop header
+//
+//----------------------------------------------------
+//
+
+
+# pragma once
+
+#include <algorithm>
+#include <atomic>
+#include <functional>
+#include <thread>
+#include <vector>
+
+
+// Runs shard(first, last) on ranges covering [0, n), possibly in parallel, and returns when all of them are done.
+// Lets the caller give its own thread pool to parallel_for (e.g. the worker threads of a tensorflow op).
+typedef std::function<void(int, const std::function<void(int, int)>&)> ParallelRunner;
+
+
+// Call work(i) for every i in [0, n). With a runner, the loop runs on its pool and num_threads is ignored. Else
+// num_threads threads are started and items are taken one at a time from a shared counter, so that uneven items are
+// balanced between threads. With num_threads <= 1 the loop runs on the calling thread.
+inline void parallel_for(int n, int num_threads, const std::function<void(int)>& work,
+                         const ParallelRunner& runner = ParallelRunner())
+{
+	if (runner)
+	{
+		runner(n, [&](int first, int last)
+		{
+			for (int i = first; i < last; i++)
+				work(i);
+		});
+		return;
+	}
+
+	num_threads = std::max(1, std::min(num_threads, n));
+	if (num_threads == 1)
+	{
+		for (int i = 0; i < n; i++)
+			work(i);
+		return;
+	}
+
+	std::atomic<int> next(0);
+	auto worker = [&]()
+	{
+		for (int i = next++; i < n; i = next++)
+			work(i);
+	};
+
+	std::vector<std::thread> threads;
+	for (int t = 1; t < num_threads; t++)
+		threads.push_back(std::thread(worker));
+	worker();
+	for (auto& thread : threads)
+		thread.join();
+}
@@ -213,33 +213,53 @@ void batch_nanoflann_neighbors(vector<PointXYZ>& queries,
                                 vector<int>& q_batches,
                                 vector<int>& s_batches,
                                 vector<int>& neighbors_indices,
-                                float radius)
+                                float radius,
+                                int max_neighbors,
+                                int num_threads,
+                                const ParallelRunner& runner)
 {
 
 	// Initiate variables
 	// ******************
 
-	// indices
-	int i0 = 0;
-
 	// Square radius
 	float r2 = radius * radius;
 
-	// Counting vector
-	int max_count = 0;
-	float d2;
-	vector<vector<pair<size_t, float>>> all_inds_dists(queries.size());
+	// Number of batch elements
+	int Nb = (int)q_batches.size();
 
-	// batch index
-	int b = 0;
-	int sum_qb = 0;
-	int sum_sb = 0;
+	// First query and first support of each batch element
+	vector<int> q_starts(Nb + 1, 0);
+	vector<int> s_starts(Nb + 1, 0);
+	for (int b = 0; b < Nb; b++)
+	{
+		q_starts[b + 1] = q_starts[b] + q_batches[b];
+		s_starts[b + 1] = s_starts[b] + s_batches[b];
+	}
+
+	// Work is split in chunks of queries, a chunk never spans two batch elements
+	const int chunk_size = 256;
+	vector<int> chunk_batch;
+	vector<int> chunk_first;
+	for (int b = 0; b < Nb; b++)
+	{
+		for (int i = q_starts[b]; i < q_starts[b + 1]; i += chunk_size)
+		{
+			chunk_batch.push_back(b);
+			chunk_first.push_back(i);
+		}
+	}
+	int Nc = (int)chunk_batch.size();
+
+	// Neighbors of each query and maximal count of each chunk (each thread writes its own items)
+	vector<vector<pair<size_t, float>>> all_inds_dists(queries.size());
+	vector<size_t> chunk_max_count(Nc, 0);
 
 	// Nanoflann related variables
 	// ***************************
 
-	// CLoud variable
-	PointCloud current_cloud;
+	// Cloud of each batch element
+	vector<PointCloud> clouds(Nb);
 
 	// Tree parameters
 	nanoflann::KDTreeSingleIndexAdaptorParams tree_params(10 /* max leaf */);
@@ -249,13 +269,16 @@ void batch_nanoflann_neighbors(vector<PointXYZ>& queries,
                                                         PointCloud,
                                                         3 > my_kd_tree_t;
 
-    // Pointer to trees
-    my_kd_tree_t* index;
-
-    // Build KDTree for the first batch element
-    current_cloud.pts = vector<PointXYZ>(supports.begin() + sum_sb, supports.begin() + sum_sb + s_batches[b]);
-    index = new my_kd_tree_t(3, current_cloud, tree_params);
-    index->buildIndex();
+    // Build the KDTrees of all batch elements (elements without support have no tree and no neighbors)
+    vector<my_kd_tree_t*> trees(Nb, NULL);
+    parallel_for(Nb, num_threads, [&](int b)
+    {
+        if (s_batches[b] == 0)
+            return;
+        clouds[b].pts = vector<PointXYZ>(supports.begin() + s_starts[b], supports.begin() + s_starts[b + 1]);
+        trees[b] = new my_kd_tree_t(3, clouds[b], tree_params);
+        trees[b]->buildIndex();
+    }, runner);
 
 
 	// Search neigbors indices
@@ -265,69 +288,159 @@ void batch_nanoflann_neighbors(vector<PointXYZ>& queries,
     nanoflann::SearchParams search_params;
     search_params.sorted = true;
 
-	for (auto& p0 : queries)
-	{
+    parallel_for(Nc, num_threads, [&](int c)
+    {
+        int b = chunk_batch[c];
+        if (trees[b] == NULL)
+            return;
 
-	    // Check if we changed batch
-	    if (i0 == sum_qb + q_batches[b])
-	    {
-	        sum_qb += q_batches[b];
-	        sum_sb += s_batches[b];
-	        b++;
+        int i_end = min(chunk_first[c] + chunk_size, q_starts[b + 1]);
+        for (int i0 = chunk_first[c]; i0 < i_end; i0++)
+        {
+            // Find neighbors, only the max_neighbors closest ones are kept when there is a limit
+            PointXYZ& p0 = queries[i0];
+            float query_pt[3] = { p0.x, p0.y, p0.z};
+            size_t nMatches;
+            if (max_neighbors > 0)
+            {
+                ClosestInRadiusResultSet result_set(r2, max_neighbors, all_inds_dists[i0]);
+                trees[b]->findNeighbors(result_set, query_pt, search_params);
+                sort_heap(all_inds_dists[i0].begin(), all_inds_dists[i0].end(), nanoflann::IndexDist_Sorter());
+                nMatches = result_set.size();
+            }
+            else
+                nMatches = trees[b]->radiusSearch(query_pt, r2, all_inds_dists[i0], search_params);
+
+            // Update max count
+            if (nMatches > chunk_max_count[c])
+                chunk_max_count[c] = nMatches;
+        }
+    }, runner);
+
+    for (auto tree : trees)
+        delete tree;
 
-	        // Change the points
-	        current_cloud.pts.clear();
-            current_cloud.pts = vector<PointXYZ>(supports.begin() + sum_sb, supports.begin() + sum_sb + s_batches[b]);
+	// Counting vector
+	int max_count = 0;
+	for (auto count : chunk_max_count)
+	    max_count = max(max_count, (int)count);
 
-	        // Build KDTree of the current element of the batch
-            delete index;
-            index = new my_kd_tree_t(3, current_cloud, tree_params);
-            index->buildIndex();
-	    }
+	// Reserve the memory and fill the neighbors of each chunk, with the first support of its batch element as offset
+	neighbors_indices.resize(queries.size() * max_count);
+    parallel_for(Nc, num_threads, [&](int c)
+    {
+        int b = chunk_batch[c];
+        int i_end = min(chunk_first[c] + chunk_size, q_starts[b + 1]);
+        for (int i0 = chunk_first[c]; i0 < i_end; i0++)
+        {
+            auto& inds_dists = all_inds_dists[i0];
+            for (int j = 0; j < max_count; j++)
+            {
+                if (j < inds_dists.size())
+                    neighbors_indices[i0 * max_count + j] = inds_dists[j].first + s_starts[b];
+                else
+                    neighbors_indices[i0 * max_count + j] = supports.size();
+            }
+        }
+    }, runner);
 
-	    // Initial guess of neighbors size
-        all_inds_dists[i0].reserve(max_count);
+	return;
+}
 
-	    // Find neighbors
-	    float query_pt[3] = { p0.x, p0.y, p0.z};
-		size_t nMatches = index->radiusSearch(query_pt, r2, all_inds_dists[i0], search_params);
 
-        // Update max count
-        if (nMatches > max_count)
-            max_count = nMatches;
+void batch_nanoflann_knn(vector<PointXYZ>& queries,
+                          vector<PointXYZ>& supports,
+                          vector<int>& q_batches,
+                          vector<int>& s_batches,
+                          vector<int>& neighbors_indices,
+                          int k,
+                          int num_threads,
+                          const ParallelRunner& runner)
+{
 
-        // Increment query idx
-		i0++;
-	}
+	// Initiate variables
+	// ******************
 
-	// Reserve the memory
-	neighbors_indices.resize(queries.size() * max_count);
-	i0 = 0;
-	sum_sb = 0;
-	sum_qb = 0;
-	b = 0;
-	for (auto& inds_dists : all_inds_dists)
+	// Number of batch elements
+	int Nb = (int)q_batches.size();
+
+	// First query and first support of each batch element
+	vector<int> q_starts(Nb + 1, 0);
+	vector<int> s_starts(Nb + 1, 0);
+	for (int b = 0; b < Nb; b++)
 	{
-	    // Check if we changed batch
-	    if (i0 == sum_qb + q_batches[b])
-	    {
-	        sum_qb += q_batches[b];
-	        sum_sb += s_batches[b];
-	        b++;
-	    }
+		q_starts[b + 1] = q_starts[b] + q_batches[b];
+		s_starts[b + 1] = s_starts[b] + s_batches[b];
+	}
 
-		for (int j = 0; j < max_count; j++)
+	// Work is split in chunks of queries, a chunk never spans two batch elements
+	const int chunk_size = 256;
+	vector<int> chunk_batch;
+	vector<int> chunk_first;
+	for (int b = 0; b < Nb; b++)
+	{
+		for (int i = q_starts[b]; i < q_starts[b + 1]; i += chunk_size)
 		{
-			if (j < inds_dists.size())
-				neighbors_indices[i0 * max_count + j] = inds_dists[j].first + sum_sb;
-			else
-				neighbors_indices[i0 * max_count + j] = supports.size();
+			chunk_batch.push_back(b);
+			chunk_first.push_back(i);
 		}
-		i0++;
 	}
+	int Nc = (int)chunk_batch.size();
+
+	// Queries of elements with less than k supports are padded with the shadow index
+	neighbors_indices.assign(queries.size() * k, (int)supports.size());
 
-	delete index;
+	// Nanoflann related variables
+	// ***************************
+
+	// Cloud of each batch element
+	vector<PointCloud> clouds(Nb);
+
+	// Tree parameters
+	nanoflann::KDTreeSingleIndexAdaptorParams tree_params(10 /* max leaf */);
+
+	// KDTree type definition
+    typedef nanoflann::KDTreeSingleIndexAdaptor< nanoflann::L2_Simple_Adaptor<float, PointCloud > ,
+                                                        PointCloud,
+                                                        3 > my_kd_tree_t;
+
+    // Build the KDTrees of all batch elements (elements without support have no tree and no neighbors)
+    vector<my_kd_tree_t*> trees(Nb, NULL);
+    parallel_for(Nb, num_threads, [&](int b)
+    {
+        if (s_batches[b] == 0)
+            return;
+        clouds[b].pts = vector<PointXYZ>(supports.begin() + s_starts[b], supports.begin() + s_starts[b + 1]);
+        trees[b] = new my_kd_tree_t(3, clouds[b], tree_params);
+        trees[b]->buildIndex();
+    }, runner);
+
+
+	// Search neigbors indices
+	// ***********************
+
+    parallel_for(Nc, num_threads, [&](int c)
+    {
+        int b = chunk_batch[c];
+        if (trees[b] == NULL)
+            return;
+
+        vector<size_t> inds(k);
+        vector<float> dists(k);
+        int i_end = min(chunk_first[c] + chunk_size, q_starts[b + 1]);
+        for (int i0 = chunk_first[c]; i0 < i_end; i0++)
+        {
+            // Find the k closest supports, sorted by distance
+            PointXYZ& p0 = queries[i0];
+            float query_pt[3] = { p0.x, p0.y, p0.z};
+            size_t nMatches = trees[b]->knnSearch(query_pt, k, &inds[0], &dists[0]);
+            for (size_t j = 0; j < nMatches; j++)
+                neighbors_indices[i0 * k + j] = (int)inds[j] + s_starts[b];
+        }
+    }, runner);
+
+    for (auto tree : trees)
+        delete tree;
 
 	return;
 }
-
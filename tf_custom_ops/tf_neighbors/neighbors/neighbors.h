@@ -2,6 +2,7 @@
 
 #include "../../cpp_utils/cloud/cloud.h"
 #include "../../cpp_utils/nanoflann/nanoflann.hpp"
+#include "../../cpp_utils/parallel/parallel.h"
 
 #include <set>
 #include <cstdint>
@@ -21,9 +22,67 @@ void batch_ordered_neighbors(vector<PointXYZ>& queries,
                                 vector<int>& neighbors_indices,
                                 float radius);
 
+// Result set of nanoflann keeping only the max_count closest points within the radius (max heap on distances)
+class ClosestInRadiusResultSet
+{
+public:
+
+	float radius;
+	size_t capacity;
+	vector<pair<size_t, float>>& m_indices_dists;
+
+	ClosestInRadiusResultSet(float radius_, size_t capacity_, vector<pair<size_t, float>>& indices_dists)
+		: radius(radius_), capacity(capacity_), m_indices_dists(indices_dists)
+	{
+		m_indices_dists.clear();
+		m_indices_dists.reserve(capacity);
+	}
+
+	inline size_t size() const { return m_indices_dists.size(); }
+
+	inline bool full() const { return true; }
+
+	inline bool addPoint(float dist, size_t index)
+	{
+		if (dist >= radius)
+			return true;
+		if (m_indices_dists.size() < capacity)
+		{
+			m_indices_dists.push_back(make_pair(index, dist));
+			push_heap(m_indices_dists.begin(), m_indices_dists.end(), nanoflann::IndexDist_Sorter());
+		}
+		else if (dist < m_indices_dists.front().second)
+		{
+			pop_heap(m_indices_dists.begin(), m_indices_dists.end(), nanoflann::IndexDist_Sorter());
+			m_indices_dists.back() = make_pair(index, dist);
+			push_heap(m_indices_dists.begin(), m_indices_dists.end(), nanoflann::IndexDist_Sorter());
+		}
+		return true;
+	}
+
+	// Until the heap is full, any point in the radius is accepted, then only points closer than the worst one
+	inline float worstDist() const
+	{
+		return m_indices_dists.size() < capacity ? radius : m_indices_dists.front().second;
+	}
+};
+
 void batch_nanoflann_neighbors(vector<PointXYZ>& queries,
                                 vector<PointXYZ>& supports,
                                 vector<int>& q_batches,
                                 vector<int>& s_batches,
                                 vector<int>& neighbors_indices,
-                                float radius);
+                                float radius,
+                                int max_neighbors = 0,
+                                int num_threads = 1,
+                                const ParallelRunner& runner = ParallelRunner());
+
+
+void batch_nanoflann_knn(vector<PointXYZ>& queries,
+                          vector<PointXYZ>& supports,
+                          vector<int>& q_batches,
+                          vector<int>& s_batches,
+                          vector<int>& neighbors_indices,
+                          int k,
+                          int num_threads = 1,
+                          const ParallelRunner& runner = ParallelRunner());
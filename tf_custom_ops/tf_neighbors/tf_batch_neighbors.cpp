@@ -1,6 +1,7 @@
 #include "tensorflow/core/framework/op.h"
 #include "tensorflow/core/framework/shape_inference.h"
 #include "tensorflow/core/framework/op_kernel.h"
+#include "tensorflow/core/lib/core/threadpool.h"
 #include "neighbors/neighbors.h"
 
 using namespace tensorflow;
@@ -11,6 +12,8 @@ REGISTER_OP("BatchOrderedNeighbors")
     .Input("q_batches: int32")
     .Input("s_batches: int32")
     .Input("radius: float")
+    .Attr("max_neighbors: int = 0")
+    .Attr("num_threads: int = 0")
     .Output("neighbors: int32")
     .SetShapeFn([](::tensorflow::shape_inference::InferenceContext* c) {
 
@@ -35,7 +38,14 @@ REGISTER_OP("BatchOrderedNeighbors")
 
 class BatchOrderedNeighborsOp : public OpKernel {
     public:
-    explicit BatchOrderedNeighborsOp(OpKernelConstruction* context) : OpKernel(context) {}
+    explicit BatchOrderedNeighborsOp(OpKernelConstruction* context) : OpKernel(context)
+    {
+        // Only the max_neighbors closest neighbors are kept (0 to keep all neighbors in the radius)
+        OP_REQUIRES_OK(context, context->GetAttr("max_neighbors", &max_neighbors_));
+
+        // Number of threads searching neighbors (0 to use as many threads as the intra op thread pool)
+        OP_REQUIRES_OK(context, context->GetAttr("num_threads", &num_threads_));
+    }
 
     void Compute(OpKernelContext* context) override
     {
@@ -88,9 +98,24 @@ class BatchOrderedNeighborsOp : public OpKernel {
         // Create result containers
         vector<int> neighbors_indices;
 
+        // Threads used by this op. By default it runs on the intra op thread pool, which is shared with the other ops
+        // instead of starting threads on every call
+        int num_threads = num_threads_;
+        ParallelRunner runner;
+        if (num_threads <= 0)
+        {
+            thread::ThreadPool* workers = context->device()->tensorflow_cpu_worker_threads()->workers;
+            runner = [workers](int n, const std::function<void(int, int)>& shard)
+            {
+                // Items are whole batch elements or chunks of queries, expensive enough to be scheduled one by one
+                workers->ParallelFor(n, 100000, [&shard](int64 first, int64 last) { shard((int)first, (int)last); });
+            };
+        }
+
         // Compute results
         //batch_ordered_neighbors(queries, supports, q_batches, s_batches, neighbors_indices, radius);
-        batch_nanoflann_neighbors(queries, supports, q_batches, s_batches, neighbors_indices, radius);
+        batch_nanoflann_neighbors(queries, supports, q_batches, s_batches, neighbors_indices, radius, max_neighbors_,
+                                  num_threads, runner);
 
         // Maximal number of neighbors
         int max_neighbors = neighbors_indices.size() / Nq;
@@ -103,17 +128,14 @@ class BatchOrderedNeighborsOp : public OpKernel {
         // create output tensor
         Tensor* output = NULL;
         OP_REQUIRES_OK(context, context->allocate_output(0, output_shape, &output));
-        auto output_tensor = output->matrix<int>();
 
-        // Fill output tensor
-        for (int i = 0; i < output->shape().dim_size(0); i++)
-        {
-            for (int j = 0; j < output->shape().dim_size(1); j++)
-            {
-                output_tensor(i, j) = neighbors_indices[max_neighbors * i + j];
-            }
-        }
+        // Fill output tensor (row major like neighbors_indices)
+        std::copy(neighbors_indices.begin(), neighbors_indices.end(), output->flat<int>().data());
     }
+
+    private:
+    int max_neighbors_;
+    int num_threads_;
 };
 
 
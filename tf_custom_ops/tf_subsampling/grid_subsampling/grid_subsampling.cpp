@@ -98,52 +98,140 @@ void grid_subsampling(vector<PointXYZ>& original_points,
 
 
 
+void voxel_grid_subsampling(const PointXYZ* original_points,
+                            size_t N,
+                            vector<PointXYZ>& subsampled_points,
+                            int* voxel_indices,
+                            float sampleDl)
+{
+
+	// Initiate variables
+	// ******************
+
+	if (N == 0)
+		return;
+
+	// Limits of the cloud
+	PointXYZ minCorner = original_points[0];
+	PointXYZ maxCorner = original_points[0];
+	for (size_t i = 0; i < N; i++)
+	{
+		const PointXYZ& p = original_points[i];
+		minCorner.x = min(minCorner.x, p.x);
+		minCorner.y = min(minCorner.y, p.y);
+		minCorner.z = min(minCorner.z, p.z);
+		maxCorner.x = max(maxCorner.x, p.x);
+		maxCorner.y = max(maxCorner.y, p.y);
+		maxCorner.z = max(maxCorner.z, p.z);
+	}
+	PointXYZ originCorner = floor(minCorner * (1/sampleDl)) * sampleDl;
+
+	// Dimensions of the grid
+	size_t sampleNX = (size_t)floor((maxCorner.x - originCorner.x) / sampleDl) + 1;
+	size_t sampleNY = (size_t)floor((maxCorner.y - originCorner.y) / sampleDl) + 1;
+
+
+	// Voxel key of each point
+	// ***********************
+
+	size_t iX, iY, iZ;
+	vector<size_t> keys(N);
+	for (size_t i = 0; i < N; i++)
+	{
+		const PointXYZ& p = original_points[i];
+		iX = (size_t)floor((p.x - originCorner.x) / sampleDl);
+		iY = (size_t)floor((p.y - originCorner.y) / sampleDl);
+		iZ = (size_t)floor((p.z - originCorner.z) / sampleDl);
+		keys[i] = iX + sampleNX*iY + sampleNX*sampleNY*iZ;
+	}
+
+	// Sort the points by voxel. The sort is stable, the points of a voxel stay in their original order, so that
+	// barycenters are summed in the same order as with the hash map version
+	vector<int> order(N);
+	iota(order.begin(), order.end(), 0);
+	stable_sort(order.begin(), order.end(), [&keys](const int a, const int b) { return keys[a] < keys[b]; });
+
+
+	// Barycenters of the voxels
+	// *************************
+
+	size_t i0 = 0;
+	while (i0 < N)
+	{
+		size_t key = keys[order[i0]];
+		int v = (int)subsampled_points.size();
+		PointXYZ point;
+		size_t count = 0;
+		size_t i1 = i0;
+		for (; i1 < N && keys[order[i1]] == key; i1++)
+		{
+			point += original_points[order[i1]];
+			voxel_indices[order[i1]] = v;
+			count++;
+		}
+		subsampled_points.push_back(point * (1.0 / count));
+		i0 = i1;
+	}
+
+	return;
+}
+
+
 void batch_grid_subsampling(vector<PointXYZ>& original_points,
-                              vector<PointXYZ>& subsampled_points,
-                              vector<float>& original_features,
-                              vector<float>& subsampled_features,
-                              vector<int>& original_classes,
-                              vector<int>& subsampled_classes,
-                              vector<int>& original_batches,
-                              vector<int>& subsampled_batches,
-                              float sampleDl)
+                            vector<PointXYZ>& subsampled_points,
+                            vector<int>& original_batches,
+                            vector<int>& subsampled_batches,
+                            vector<int>& voxel_indices,
+                            float sampleDl,
+                            int num_threads,
+                          const ParallelRunner& runner)
 {
 	// Initiate variables
 	// ******************
 
-	int b = 0;
-	int sum_b = 0;
+	int Nb = (int)original_batches.size();
+
+	// Index of the first point of each batch element
+	vector<int> starts(Nb + 1, 0);
+	for (int b = 0; b < Nb; b++)
+		starts[b + 1] = starts[b] + original_batches[b];
+
+	// Voxel of each original point, first given in its batch element, then in the stacked subsampled points
+	voxel_indices.resize(original_points.size());
 
-	// Loop over batches
+
+	// Subsample batch elements in parallel
+	// ************************************
+
+	vector<vector<PointXYZ>> b_subsampled_points(Nb);
+	parallel_for(Nb, num_threads, [&](int b)
+	{
+		voxel_grid_subsampling(original_points.data() + starts[b],
+		                       original_batches[b],
+		                       b_subsampled_points[b],
+		                       voxel_indices.data() + starts[b],
+		                       sampleDl);
+	}, runner);
+
+
+	// Stack the results
 	// *****************
 
-	for (b = 0; b < original_batches.size(); b++)
+	vector<int> sub_starts(Nb + 1, 0);
+	subsampled_batches.resize(Nb);
+	for (int b = 0; b < Nb; b++)
 	{
-	    // Extract batch points
-	    vector<PointXYZ> b_original_points = vector<PointXYZ>(original_points.begin () + sum_b,
-	                                                          original_points.begin () + sum_b + original_batches[b]);
-
-        // Create result containers
-        vector<PointXYZ> b_subsampled_points;
-        vector<float> b_subsampled_features;
-        vector<int> b_subsampled_classes;
-
-        // Compute subsampling on current batch
-        grid_subsampling(b_original_points,
-                         b_subsampled_points,
-                         original_features,
-                         b_subsampled_features,
-                         original_classes,
-                         b_subsampled_classes,
-                         sampleDl);
-
-        // Stack batches points
-        subsampled_points.insert(subsampled_points.end(), b_subsampled_points.begin(), b_subsampled_points.end());
-
-        // Stack new batch lengths
-        subsampled_batches.push_back(b_subsampled_points.size());
-        sum_b += original_batches[b];
+		subsampled_batches[b] = (int)b_subsampled_points[b].size();
+		sub_starts[b + 1] = sub_starts[b] + subsampled_batches[b];
 	}
 
+	subsampled_points.resize(sub_starts[Nb]);
+	parallel_for(Nb, num_threads, [&](int b)
+	{
+		copy(b_subsampled_points[b].begin(), b_subsampled_points[b].end(), subsampled_points.begin() + sub_starts[b]);
+		for (int i = starts[b]; i < starts[b + 1]; i++)
+			voxel_indices[i] += sub_starts[b];
+	}, runner);
+
 	return;
-}
\ No newline at end of file
+}
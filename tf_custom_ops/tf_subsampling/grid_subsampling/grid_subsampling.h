@@ -1,9 +1,11 @@
 
 
 #include "../../cpp_utils/cloud/cloud.h"
+#include "../../cpp_utils/parallel/parallel.h"
 
 #include <set>
 #include <cstdint>
+#include <numeric>
 
 using namespace std;
 
@@ -79,13 +81,19 @@ void grid_subsampling(vector<PointXYZ>& original_points,
                       float sampleDl);
 
 
+void voxel_grid_subsampling(const PointXYZ* original_points,
+                            size_t N,
+                            vector<PointXYZ>& subsampled_points,
+                            int* voxel_indices,
+                            float sampleDl);
+
+
 void batch_grid_subsampling(vector<PointXYZ>& original_points,
-                              vector<PointXYZ>& subsampled_points,
-                              vector<float>& original_features,
-                              vector<float>& subsampled_features,
-                              vector<int>& original_classes,
-                              vector<int>& subsampled_classes,
-                              vector<int>& original_batches,
-                              vector<int>& subsampled_batches,
-                              float sampleDl);
+                            vector<PointXYZ>& subsampled_points,
+                            vector<int>& original_batches,
+                            vector<int>& subsampled_batches,
+                            vector<int>& voxel_indices,
+                            float sampleDl,
+                            int num_threads = 1,
+                            const ParallelRunner& runner = ParallelRunner());
 
@@ -1,6 +1,7 @@
 #include "tensorflow/core/framework/op.h"
 #include "tensorflow/core/framework/shape_inference.h"
 #include "tensorflow/core/framework/op_kernel.h"
+#include "tensorflow/core/lib/core/threadpool.h"
 #include "grid_subsampling/grid_subsampling.h"
 
 using namespace tensorflow;
@@ -9,13 +10,16 @@ REGISTER_OP("BatchGridSubsampling")
     .Input("points: float")
     .Input("batches: int32")
     .Input("dl: float")
+    .Attr("num_threads: int = 0")
     .Output("sub_points: float")
     .Output("sub_batches: int32")
+    .Output("voxels: int32")
     .SetShapeFn([](::tensorflow::shape_inference::InferenceContext* c) {
         ::tensorflow::shape_inference::ShapeHandle input0_shape;
         TF_RETURN_IF_ERROR(c->WithRank(c->input(0), 2, &input0_shape));
         c->set_output(0, input0_shape);
         c->set_output(1, c->input(1));
+        c->set_output(2, c->Vector(c->Dim(input0_shape, 0)));
         return Status::OK();
     });
 
@@ -25,7 +29,11 @@ REGISTER_OP("BatchGridSubsampling")
 
 class BatchGridSubsamplingOp : public OpKernel {
     public:
-    explicit BatchGridSubsamplingOp(OpKernelConstruction* context) : OpKernel(context) {}
+    explicit BatchGridSubsamplingOp(OpKernelConstruction* context) : OpKernel(context)
+    {
+        // Number of threads subsampling the batch elements (0 to use as many threads as the intra op thread pool)
+        OP_REQUIRES_OK(context, context->GetAttr("num_threads", &num_threads_));
+    }
 
     void Compute(OpKernelContext* context) override
     {
@@ -61,26 +69,34 @@ class BatchGridSubsamplingOp : public OpKernel {
         vector<int> batches = vector<int>((int*)batches_tensor.flat<int>().data(),
                                           (int*)batches_tensor.flat<int>().data() + Nb);
 
-        // Unsupported label and features
-        vector<float> original_features;
-        vector<int> original_classes;
-
         // Create result containers
         vector<PointXYZ> subsampled_points;
-        vector<float> subsampled_features;
-        vector<int> subsampled_classes;
         vector<int> subsampled_batches;
+        vector<int> voxel_indices;
+
+        // Threads used by this op. By default it runs on the intra op thread pool, which is shared with the other ops
+        // instead of starting threads on every call
+        int num_threads = num_threads_;
+        ParallelRunner runner;
+        if (num_threads <= 0)
+        {
+            thread::ThreadPool* workers = context->device()->tensorflow_cpu_worker_threads()->workers;
+            runner = [workers](int n, const std::function<void(int, int)>& shard)
+            {
+                // Items are whole batch elements, expensive enough to be scheduled one by one
+                workers->ParallelFor(n, 100000, [&shard](int64 first, int64 last) { shard((int)first, (int)last); });
+            };
+        }
 
         // Compute results
         batch_grid_subsampling(original_points,
-                                 subsampled_points,
-                                 original_features,
-                                 subsampled_features,
-                                 original_classes,
-                                 subsampled_classes,
-                                 batches,
-                                 subsampled_batches,
-                                 sampleDl);
+                               subsampled_points,
+                               batches,
+                               subsampled_batches,
+                               voxel_indices,
+                               sampleDl,
+                               num_threads,
+                               runner);
 
         // Sub_points output
         // *****************
@@ -119,7 +135,22 @@ class BatchGridSubsamplingOp : public OpKernel {
         for (int i = 0; i < subsampled_batches.size(); i++)
             sub_batches_tensor(i) = subsampled_batches[i];
 
+        // Voxels output
+        // *************
+
+        // create output shape
+        TensorShape voxels_shape;
+        voxels_shape.AddDim(N);
+
+        // create output tensor (index of the subsampled point of each original point)
+        Tensor* voxels_output = NULL;
+        OP_REQUIRES_OK(context, context->allocate_output(2, voxels_shape, &voxels_output));
+        std::copy(voxel_indices.begin(), voxel_indices.end(), voxels_output->flat<int>().data());
+
     }
+
+    private:
+    int num_threads_;
 };
 
 
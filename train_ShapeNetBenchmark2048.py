@@ -1,12 +1,15 @@
 # Common libs
 import time
 import os
+import sys
 import argparse
 import numpy as np
+import tensorflow as tf
 
 # Custom libs
 from utils.config import Config
 from utils.trainer import ModelTrainer
+from utils.distributed import DataParallelCluster, launch_local_cluster, throughput_report
 from models.KPCN_model import KernelPointCompletionNetwork
 
 # Dataset
@@ -134,6 +137,9 @@ class ShapeNetBenchmark2048Config(Config):
     # Number of validation examples per epoch
     validation_size = 50
 
+    # Validation covers the whole split, its mapped inputs are computed once and kept in memory
+    cache_validation = True
+
     # Number of epoch between each snapshot
     snapshot_gap = 1
 
@@ -169,14 +175,33 @@ if __name__ == '__main__':
     parser.add_argument('--double_fold', action='store_true')
     parser.add_argument('--snap', type=int, help="snapshot to restore (-1 for latest snapshot)")
     parser.add_argument('--dl0', type=float, default=0.02, help="subsampling grid parameter (zero or negative to skip)")
+    parser.add_argument('--accum_steps', type=int, default=1,
+                        help="number of batches whose gradients are accumulated before each update")
+    parser.add_argument('--mixed_precision', choices=['none', 'float16', 'bfloat16'], default='none',
+                        help="precision of convolutions and matmuls (weights and losses stay in float32)")
+    parser.add_argument('--num_workers', type=int, default=1,
+                        help="number of synchronous data parallel workers started on this machine")
+    parser.add_argument('--job_name', choices=['ps', 'worker'], help="job of this process in a training cluster")
+    parser.add_argument('--task_index', type=int, default=0, help="index of this process in its job")
+    parser.add_argument('--ps_hosts', help="comma separated list of host:port of the parameter servers")
+    parser.add_argument('--worker_hosts', help="comma separated list of host:port of the workers")
+    parser.add_argument('--scaling_reference',
+                        help="log of a single process run with the same config, to report the scaling efficiency")
     args = parser.parse_args()
 
+    # Start a local cluster, each process runs this script again with its job arguments
+    if args.num_workers > 1 and args.job_name is None:
+        sys.exit(launch_local_cluster(sys.argv, args.num_workers))
+
     ##########################
     # Initiate the environment
     ##########################
 
-    # Choose which gpu to use
-    GPU_ID = '0'
+    # Choose which gpu to use (cluster processes run on CPU)
+    if args.job_name is None:
+        GPU_ID = '0'
+    else:
+        GPU_ID = ''
 
     # Set GPU visible device
     os.environ['CUDA_VISIBLE_DEVICES'] = GPU_ID
@@ -184,11 +209,27 @@ if __name__ == '__main__':
     # Enable/Disable warnings (set level to '0'/'3')
     os.environ['TF_CPP_MIN_LOG_LEVEL'] = '0'
 
+    # Parameter servers only hold variables
+    cluster = None
+    if args.job_name is not None:
+        cluster = DataParallelCluster(args.ps_hosts.split(','),
+                                      args.worker_hosts.split(','),
+                                      args.job_name,
+                                      args.task_index)
+        if args.job_name == 'ps':
+            cluster.join()
+
     ###########################
     # Load the model parameters
     ###########################
 
     config = ShapeNetBenchmark2048Config(args.saving_path)
+    config.accum_steps = args.accum_steps
+    config.mixed_precision = args.mixed_precision
+
+    # Only the chief worker saves snapshots and logs
+    if cluster is not None and not cluster.is_chief:
+        config.saving = False
 
     ##############
     # Prepare Data
@@ -203,6 +244,11 @@ if __name__ == '__main__':
     dl0 = args.dl0
     dataset.load_subsampled_clouds(dl0)
 
+    # Each worker trains on its own shard of the training clouds
+    if cluster is not None:
+        dataset.num_shards = cluster.num_workers
+        dataset.shard_index = cluster.task_index
+
     # Initialize input pipelines
     dataset.init_input_pipeline(config)
 
@@ -218,25 +264,33 @@ if __name__ == '__main__':
     print('**************\n')
     t1 = time.time()
 
-    # Model class
-    model = KernelPointCompletionNetwork(dataset.flat_inputs, config, args.double_fold)
+    # Variables are placed on the parameter server in a cluster
+    if cluster is not None:
+        device_scope = tf.device(cluster.device_setter())
+    else:
+        device_scope = tf.device(None)
+
+    with device_scope:
 
-    # Trainer class
-    if args.saving_path is not None and args.snap is not None:
-        # Find all snapshot in the chosen training folder
-        snap_path = os.path.join(args.saving_path, 'snapshots')
-        snap_steps = [int(f[:-5].split('-')[-1]) for f in os.listdir(snap_path) if f[-5:] == '.meta']
+        # Model class
+        model = KernelPointCompletionNetwork(dataset.flat_inputs, config, args.double_fold)
 
-        # Find which snapshot to restore
-        if args.snap == -1:
-            chosen_step = np.sort(snap_steps)[args.snap]
-        else:
-            chosen_step = args.snap + 1
-        chosen_snap = os.path.join(args.saving_path, 'snapshots', 'snap-{:d}'.format(chosen_step))
+        # Trainer class
+        if args.saving_path is not None and args.snap is not None:
+            # Find all snapshot in the chosen training folder
+            snap_path = os.path.join(args.saving_path, 'snapshots')
+            snap_steps = [int(f[:-5].split('-')[-1]) for f in os.listdir(snap_path) if f[-5:] == '.meta']
 
-        trainer = ModelTrainer(model, chosen_snap)
-    else:
-        trainer = ModelTrainer(model)
+            # Find which snapshot to restore
+            if args.snap == -1:
+                chosen_step = np.sort(snap_steps)[args.snap]
+            else:
+                chosen_step = args.snap + 1
+            chosen_snap = os.path.join(args.saving_path, 'snapshots', 'snap-{:d}'.format(chosen_step))
+
+            trainer = ModelTrainer(model, chosen_snap, cluster=cluster)
+        else:
+            trainer = ModelTrainer(model, cluster=cluster)
     t2 = time.time()
 
     print('\n----------------')
@@ -256,3 +310,8 @@ if __name__ == '__main__':
         trainer.train(model, dataset, chosen_step, epoch)
     else:
         trainer.train(model, dataset)
+
+    # Only the chief has a log folder in a cluster
+    if config.saving:
+        throughput_report(model.saving_path, trainer.clouds_per_s, 1 if cluster is None else cluster.num_workers,
+                          args.scaling_reference)
@@ -0,0 +1,163 @@
+# ----------------------------------------------------------------------------------------------------------------------
+#
+#      Normalization of KITTI cars given their bounding boxes
+#
+# ----------------------------------------------------------------------------------------------------------------------
+#
+#           Imports and global variables
+#       \**********************************/
+#
+
+
+# Basic libs
+import numpy as np
+from os import listdir, replace, stat
+from os.path import exists, join, dirname, normpath
+
+# Swap of y and z axes between KITTI frames and the canonical frame of completion models
+AXES_SWAP = np.array([[1, 0, 0], [0, 0, 1], [0, 1, 0]], dtype=np.float64)
+
+
+# ----------------------------------------------------------------------------------------------------------------------
+#
+#           Utility functions
+#       \***********************/
+#
+
+def yaw_rotation(yaws):
+    """
+    Rotation matrices around the vertical axis
+    :param yaws: float or (N,) array of angles
+    :return: (3, 3) or (N, 3, 3) rotation matrices
+    """
+    c, s = np.cos(yaws), np.sin(yaws)
+    z, o = np.zeros_like(c), np.ones_like(c)
+    R = np.stack([c, -s, z, s, c, z, z, z, o], axis=-1)
+    return R.reshape(np.shape(yaws) + (3, 3))
+
+
+def bbox_transforms(bboxes):
+    """
+    Center, yaw and scale of a stack of KITTI bounding boxes
+    :param bboxes: (N, 8, 3) array of bbox corners
+    :return: centers (N, 3), yaws (N,), scales (N,)
+    """
+    centers = (bboxes.min(1) + bboxes.max(1)) / 2
+    front = bboxes[:, 3, :2] - bboxes[:, 0, :2]
+    yaws = np.arctan2(front[:, 1], front[:, 0])
+
+    # Length of the car, i.e. x extent of the bbox once aligned with the yaw
+    scales = front[:, 0] * np.cos(yaws) + front[:, 1] * np.sin(yaws)
+
+    return centers, yaws, scales
+
+
+def normalize_points(points, center, rotation, scale):
+    """
+    Points of a car in the canonical frame of completion models (centered, aligned, unit length, y up)
+    """
+    return np.dot(np.dot(points - center, rotation) / scale, AXES_SWAP)
+
+
+def denormalize_points(points, center, rotation, scale):
+    """
+    Inverse of normalize_points, points of the canonical frame back to the KITTI frame
+    """
+    return np.dot(np.dot(points, AXES_SWAP) * scale, rotation.T) + center
+
+
+def file_stats(paths):
+    """
+    Modification times and sizes of files
+    :return: (N,) float64 mtimes, (N,) int64 sizes
+    """
+    stats = [stat(path) for path in paths]
+    return (np.array([s.st_mtime for s in stats], dtype=np.float64),
+            np.array([s.st_size for s in stats], dtype=np.int64))
+
+
+def read_bbox(path):
+    """
+    Corners of a bbox text file (faster than np.loadtxt for these small files)
+    """
+    with open(path, 'r') as f:
+        return np.array(f.read().split(), dtype=np.float64).reshape((8, 3))
+
+
+# ----------------------------------------------------------------------------------------------------------------------
+#
+#           Class Definition
+#       \**********************/
+#
+
+class BboxTable:
+    """
+    Center, yaw and scale of every car of a KITTI bboxes folder. The table is computed once and cached next to the
+    folder with the modification time and size of each bbox file, it is recomputed when a file is added, removed or
+    changed.
+    """
+
+    def __init__(self, bbox_dir, cache_file=None):
+        """
+        Load the table from the cache file or compute it from the bbox files
+        :param bbox_dir: folder of the '<car_id>.txt' bbox files
+        :param cache_file: path of the cached table (default: bbox_transforms.npz next to bbox_dir)
+        """
+
+        if cache_file is None:
+            cache_file = join(dirname(normpath(bbox_dir)), 'bbox_transforms.npz')
+
+        files = sorted([f for f in listdir(bbox_dir) if f.endswith('.txt')])
+        ids = np.array([f[:-4] for f in files])
+        mtimes, sizes = file_stats([join(bbox_dir, f) for f in files])
+
+        if not self.load_cache(cache_file, ids, mtimes, sizes):
+            self.ids = ids
+            bboxes = np.stack([read_bbox(join(bbox_dir, f)) for f in files]) if files else np.zeros((0, 8, 3))
+            self.centers, self.yaws, self.scales = bbox_transforms(bboxes)
+
+            # Written next to the final file then renamed, so that a reader never sees a partial cache
+            with open(cache_file + '.tmp', 'wb') as f:
+                np.savez(f, ids=self.ids, centers=self.centers, yaws=self.yaws, scales=self.scales,
+                         mtimes=mtimes, sizes=sizes)
+            replace(cache_file + '.tmp', cache_file)
+
+        self.rotations = yaw_rotation(self.yaws)
+        self.index = {car_id: i for i, car_id in enumerate(self.ids)}
+
+    def load_cache(self, cache_file, ids, mtimes, sizes):
+        """
+        Load the cached table if it was computed from the same bbox files
+        :return: True if the cache was loaded
+        """
+        if not exists(cache_file):
+            return False
+        with np.load(cache_file) as data:
+            if 'mtimes' not in data or not (np.array_equal(data['ids'], ids) and
+                                            np.array_equal(data['mtimes'], mtimes) and
+                                            np.array_equal(data['sizes'], sizes)):
+                return False
+            self.ids = data['ids']
+            self.centers = data['centers']
+            self.yaws = data['yaws']
+            self.scales = data['scales']
+        return True
+
+    def transform(self, car_id):
+        """
+        :return: center (3,), rotation (3, 3) and scale of a car
+        """
+        i = self.index[car_id]
+        return self.centers[i], self.rotations[i], self.scales[i]
+
+    def normalize(self, car_id, points):
+        """
+        Points of a car in the canonical frame of completion models (centered, aligned, unit length, y up)
+        """
+        return normalize_points(points, *self.transform(car_id))
+
+    def denormalize(self, car_id, points):
+        """
+        Inverse of normalize, points of the canonical frame back to the KITTI frame
+        """
+        return denormalize_points(points, *self.transform(car_id))
@@ -1,4 +1,31 @@
-from os.path import join
+import json
+from os import replace
+from os.path import join, exists
+
+
+def to_json(value):
+    """
+    Json compatible copy of a parameter value. Numpy values become python values and dictionaries are stored as lists
+    of items, so that keys keep their type
+    """
+    if hasattr(value, 'tolist'):
+        return value.tolist()
+    if isinstance(value, dict):
+        return {'__items__': [[to_json(k), to_json(v)] for k, v in value.items()]}
+    if isinstance(value, (list, tuple)):
+        return [to_json(v) for v in value]
+    return value
+
+
+def from_json(value):
+    """
+    Parameter value from its json copy
+    """
+    if isinstance(value, dict) and '__items__' in value:
+        return {from_json(k): from_json(v) for k, v in value['__items__']}
+    if isinstance(value, list):
+        return [from_json(v) for v in value]
+    return value
 
 
 class Config:
@@ -31,6 +58,15 @@ class Config:
     # Num of CPU threads used for input pipeline
     input_threads = 8
 
+    # Num of threads started by each neighbors search and subsampling op (0 to run them on the shared intra op thread
+    # pool, so that the parallel calls of the input pipeline do not oversubscribe the cores)
+    neighbors_threads = 0
+
+    # Derive upsampling indices, and the pooling indices of max_pool blocks, from the voxels of the grid subsampling
+    # instead of radius searches. Upsampled features come from the voxel of each point and max_pool blocks take the max
+    # over the points of each voxel. Strided convolutions keep their radius neighborhood (also used by their shortcut)
+    voxel_pooling = False
+
     ##################
     # Model parameters
     ##################
@@ -97,6 +133,13 @@ class Config:
     # Use modulation in deformable convolutions
     modulated = False
 
+    # Precision of convolutions and matmuls in ('none', 'float16', 'bfloat16'). Variables, batch normalization and
+    # losses always stay in float32
+    mixed_precision = 'none'
+
+    # Constant factor multiplying the loss before computing float16 gradients (they are divided by it afterwards)
+    loss_scale = 128.0
+
     #####################
     # Training parameters
     #####################
@@ -147,6 +190,14 @@ class Config:
     # Number of batch
     batch_num = 10
 
+    # Number of batches whose gradients are summed before each optimizer update (1 to update at every batch). The
+    # accumulators are not saved in snapshots, which are only taken at the end of an epoch once they have been applied
+    accum_steps = 1
+
+    # Number of threads of the tensorflow session (0 to let tensorflow choose)
+    intra_op_threads = 0
+    inter_op_threads = 0
+
     # Maximal number of epochs
     max_epoch = 1000
 
@@ -156,9 +207,23 @@ class Config:
     # Number of validation examples per epoch
     validation_size = 100
 
+    # Keep the mapped validation inputs (points, neighbors, pools...) in memory after the first validation and replay
+    # them afterwards. The same validation clouds and augmentations are then used at every epoch
+    cache_validation = False
+
+    # Test time augmentation: number of copies of each validation cloud, augmented independently and completed in the
+    # same batch. Their completions are fused by the tester
+    num_votes = 1
+
     # Number of epoch between each snapshot
     snapshot_gap = 50
 
+    # Calibration of the input pipeline, computed at runtime and saved with the parameters. A later run on the same log
+    # reuses it when its calibration_key (parameters of the calibration) is unchanged
+    batch_limit = None
+    neighborhood_limits = None
+    calibration_key = None
+
     # Do we nee to save convergence
     saving = True
     saving_path = None
@@ -173,9 +238,32 @@ class Config:
         if saving_path is not None:
             self.saving_path = saving_path
 
+    def parameters(self):
+        """
+        Dictionary of all the parameters (class defaults and values set on this instance)
+        """
+        return {name: getattr(self, name) for name in dir(self)
+                if not name.startswith('_') and not callable(getattr(self, name))}
+
     def load(self, path):
+        """
+        Load the parameters of a log, from parameters.json or from parameters.txt for logs saved before it existed
+        """
+
+        filename = join(path, 'parameters.json')
+        if exists(filename):
+            with open(filename, 'r') as f:
+                for name, value in json.load(f).items():
+                    setattr(self, name, from_json(value))
+        else:
+            self.load_text(join(path, 'parameters.txt'))
+
+        self.saving = True
+        self.saving_path = path
+        self.__init__()
+
+    def load_text(self, filename):
 
-        filename = join(path, 'parameters.txt')
         with open(filename, 'r') as f:
             lines = f.readlines()
 
@@ -184,7 +272,14 @@ class Config:
             line_info = line.split()
             if len(line_info) > 1 and line_info[0] != '#':
 
-                if line_info[2] == 'None':
+                if len(line_info) == 2:
+                    # Empty list
+                    if line_info[0] == 'lr_decay_epochs':
+                        self.lr_decays = {}
+                    elif isinstance(getattr(self, line_info[0], None), list):
+                        setattr(self, line_info[0], [])
+
+                elif line_info[2] == 'None':
                     setattr(self, line_info[0], None)
 
                 elif line_info[0] == 'lr_decay_epochs':
@@ -208,6 +303,9 @@ class Config:
                     else:
                         self.num_categories = int(line_info[2])
 
+                elif not hasattr(self, line_info[0]):
+                    print('Unknown parameter ignored: ' + line_info[0])
+
                 else:
 
                     attr_type = type(getattr(self, line_info[0]))
@@ -216,12 +314,15 @@ class Config:
                     else:
                         setattr(self, line_info[0], attr_type(line_info[2]))
 
-        self.saving = True
-        self.saving_path = path
-        self.__init__()
-
     def save(self, path):
 
+        # Typed copy of every parameter, written through a temporary file so that it is never read half written
+        filename = join(path, 'parameters.json')
+        with open(filename + '.tmp', 'w') as f:
+            json.dump({name: to_json(value) for name, value in self.parameters().items()}, f, indent=2, sort_keys=True)
+        replace(filename + '.tmp', filename)
+
+        # Readable summary
         with open(join(path, 'parameters.txt'), "w") as text_file:
             text_file.write('# -----------------------------------#\n')
             text_file.write('# Parameters of the training session #\n')
@@ -242,7 +343,9 @@ class Config:
             text_file.write('in_points_dim = {:d}\n'.format(self.in_points_dim))
             text_file.write('in_features_dim = {:d}\n'.format(self.in_features_dim))
             text_file.write('in_radius = {:.3f}\n'.format(self.in_radius))
-            text_file.write('input_threads = {:d}\n\n'.format(self.input_threads))
+            text_file.write('input_threads = {:d}\n'.format(self.input_threads))
+            text_file.write('neighbors_threads = {:d}\n'.format(self.neighbors_threads))
+            text_file.write('voxel_pooling = {:d}\n\n'.format(int(self.voxel_pooling)))
 
             # Model parameters
             text_file.write('# Model parameters\n')
@@ -279,6 +382,8 @@ class Config:
             text_file.write('convolution_mode = {:s}\n'.format(self.convolution_mode))
             text_file.write('trainable_positions = {:d}\n\n'.format(int(self.trainable_positions)))
             text_file.write('modulated = {:d}\n\n'.format(int(self.modulated)))
+            text_file.write('mixed_precision = {:s}\n'.format(self.mixed_precision))
+            text_file.write('loss_scale = {:f}\n\n'.format(self.loss_scale))
 
             # Training parameters
             text_file.write('# Training parameters\n')
@@ -321,10 +426,15 @@ class Config:
             text_file.write('offsets_loss = {:s}\n'.format(self.offsets_loss))
             text_file.write('offsets_decay = {:f}\n'.format(self.offsets_decay))
             text_file.write('batch_num = {:d}\n'.format(self.batch_num))
+            text_file.write('accum_steps = {:d}\n'.format(self.accum_steps))
+            text_file.write('intra_op_threads = {:d}\n'.format(self.intra_op_threads))
+            text_file.write('inter_op_threads = {:d}\n'.format(self.inter_op_threads))
             text_file.write('max_epoch = {:d}\n'.format(self.max_epoch))
             if self.epoch_steps is None:
                 text_file.write('epoch_steps = None\n')
             else:
                 text_file.write('epoch_steps = {:d}\n'.format(self.epoch_steps))
             text_file.write('validation_size = {:d}\n'.format(self.validation_size))
+            text_file.write('cache_validation = {:d}\n'.format(int(self.cache_validation)))
+            text_file.write('num_votes = {:d}\n'.format(self.num_votes))
             text_file.write('snapshot_gap = {:d}\n'.format(self.snapshot_gap))
@@ -0,0 +1,219 @@
+# ----------------------------------------------------------------------------------------------------------------------
+#
+#      Synchronous data parallel training on several processes (parameter server + workers)
+#
+# ----------------------------------------------------------------------------------------------------------------------
+#
+#           Imports and global variables
+#       \**********************************/
+#
+
+
+# Basic libs
+import tensorflow as tf
+import subprocess
+import json
+import time
+import sys
+import os
+
+
+# ----------------------------------------------------------------------------------------------------------------------
+#
+#           Utility functions
+#       \***********************/
+#
+
+def local_hosts(num_workers, first_port=2222):
+    """
+    Addresses of a cluster running on this machine
+    :param num_workers: number of worker processes
+    :param first_port: port of the parameter server, workers use the following ones
+    :return: ps_hosts, worker_hosts
+    """
+    ps_hosts = ['localhost:{:d}'.format(first_port)]
+    worker_hosts = ['localhost:{:d}'.format(first_port + 1 + i) for i in range(num_workers)]
+    return ps_hosts, worker_hosts
+
+
+def throughput_report(saving_path, clouds_per_s, num_workers, reference_path=None):
+    """
+    Write the training throughput of a run in saving_path/throughput.json. Given the log of a single process run with
+    the same config, the scaling efficiency clouds/s(N) / (N * clouds/s(1)) is computed as well.
+    :param saving_path: log folder of the run
+    :param clouds_per_s: clouds trained per second by the whole run
+    :param num_workers: number of data parallel workers of the run
+    :param reference_path: log folder of a single process run (None to skip the efficiency)
+    :return: the report as a dictionary
+    """
+
+    report = {'num_workers': num_workers, 'clouds_per_s': clouds_per_s}
+    message = 'Throughput: {:.1f} clouds/s with {:d} worker(s)'.format(clouds_per_s, num_workers)
+
+    if reference_path is not None:
+        with open(os.path.join(reference_path, 'throughput.json'), 'r') as f:
+            reference = json.load(f)
+        if reference['num_workers'] != 1:
+            raise ValueError('The scaling reference must be a single process run: ' + reference_path)
+        report['reference_clouds_per_s'] = reference['clouds_per_s']
+        report['scaling_efficiency'] = clouds_per_s / (num_workers * reference['clouds_per_s'])
+        message += ', scaling efficiency {:.1f}% ({:.1f} clouds/s with 1 worker)'.format(
+            100 * report['scaling_efficiency'], reference['clouds_per_s'])
+
+    with open(os.path.join(saving_path, 'throughput.json'), 'w') as f:
+        json.dump(report, f, indent=2)
+    print(message)
+
+    return report
+
+
+def launch_local_cluster(argv, num_workers, first_port=2222):
+    """
+    Start one parameter server and num_workers workers on this machine, each one running the given script with its
+    job arguments appended. Returns when all workers are done. If a worker fails, the other ones would wait for its
+    gradients forever, so every process of the cluster is terminated.
+    :param argv: command line of the training script (sys.argv)
+    :param num_workers: number of worker processes
+    :param first_port: port of the parameter server, workers use the following ones
+    :return: exit code of the cluster (0 if all workers succeeded, else the code of the first failed worker)
+    """
+
+    ps_hosts, worker_hosts = local_hosts(num_workers, first_port)
+    cluster_args = ['--ps_hosts', ','.join(ps_hosts), '--worker_hosts', ','.join(worker_hosts)]
+
+    # Remove the launcher argument so that sub processes do not launch clusters themselves
+    script_args = []
+    skip = False
+    for arg in argv[1:]:
+        if skip:
+            skip = False
+        elif arg == '--num_workers':
+            skip = True
+        elif not arg.startswith('--num_workers='):
+            script_args.append(arg)
+
+    command = [sys.executable, argv[0]] + script_args + cluster_args
+    ps = subprocess.Popen(command + ['--job_name', 'ps', '--task_index', '0'])
+    workers = [subprocess.Popen(command + ['--job_name', 'worker', '--task_index', str(i)])
+               for i in range(num_workers)]
+
+    # Parameter server never returns by itself
+    exit_code = 0
+    running = list(workers)
+    while running and exit_code == 0:
+        time.sleep(1.0)
+        for worker in [w for w in running if w.poll() is not None]:
+            running.remove(worker)
+            if worker.returncode != 0:
+                print('Worker {:d} exited with code {:d}, stopping the cluster'.format(workers.index(worker),
+                                                                                      worker.returncode))
+                exit_code = worker.returncode
+                break
+
+    for process in running + [ps]:
+        process.terminate()
+    for process in running + [ps]:
+        process.wait()
+
+    return exit_code
+
+
+# ----------------------------------------------------------------------------------------------------------------------
+#
+#           Cluster Class
+#       \*******************/
+#
+
+class DataParallelCluster:
+    """
+    Description of the current process in a synchronous data parallel cluster. Variables are stored on the parameter
+    server and every worker computes gradients on its own shard of the training batches. Gradients are averaged by a
+    SyncReplicasOptimizer before each momentum update.
+    """
+
+    def __init__(self, ps_hosts, worker_hosts, job_name, task_index, num_threads=0):
+        """
+        Start the tensorflow server of this process
+        :param ps_hosts: list of 'host:port' of the parameter servers
+        :param worker_hosts: list of 'host:port' of the workers
+        :param job_name: 'ps' or 'worker'
+        :param task_index: index of this process in its job
+        :param num_threads: number of intra op threads (0 to share the cores of the machine between local processes)
+        """
+
+        self.spec = tf.train.ClusterSpec({'ps': ps_hosts, 'worker': worker_hosts})
+        self.job_name = job_name
+        self.task_index = task_index
+        self.num_workers = len(worker_hosts)
+
+        # First worker initializes variables, saves snapshots and runs validation
+        self.is_chief = job_name == 'worker' and task_index == 0
+
+        # Processes on the same machine share the cores instead of all using every core
+        if num_threads <= 0:
+            local_n = len([h for h in ps_hosts + worker_hosts if h.split(':')[0] in ('localhost', '127.0.0.1')])
+            num_threads = max(1, os.cpu_count() // max(1, local_n))
+
+        # Only see the parameter server and itself
+        self.config = tf.ConfigProto(device_count={'GPU': 0},
+                                     intra_op_parallelism_threads=num_threads,
+                                     inter_op_parallelism_threads=2,
+                                     device_filters=['/job:ps', '/job:{:s}/task:{:d}'.format(job_name, task_index)])
+
+        self.server = tf.train.Server(self.spec, job_name=job_name, task_index=task_index, config=self.config)
+
+    def join(self):
+        """
+        Serve variables forever (parameter server)
+        """
+        self.server.join()
+
+    def device_setter(self):
+        """
+        Device function placing variables on the parameter server and computations on this worker
+        """
+        return tf.train.replica_device_setter(worker_device='/job:worker/task:{:d}'.format(self.task_index),
+                                              cluster=self.spec)
+
+    def create_session(self, sync_optimizer, saver=None, restore_snap=None):
+        """
+        Create the session of this worker. The chief initializes (or restores) variables and starts the gradient
+        aggregation, other workers wait until variables are ready.
+        :param sync_optimizer: the SyncReplicasOptimizer used by the training op
+        :param saver: saver used to restore the model
+        :param restore_snap: snapshot to restore (None to start from beginning)
+        :return: tensorflow session
+        """
+
+        if self.is_chief:
+            local_init_op = sync_optimizer.chief_init_op
+        else:
+            local_init_op = sync_optimizer.local_step_init_op
+
+        manager = tf.train.SessionManager(local_init_op=local_init_op,
+                                          ready_op=tf.report_uninitialized_variables(),
+                                          ready_for_local_init_op=sync_optimizer.ready_for_local_init_op,
+                                          graph=tf.get_default_graph())
+
+        if self.is_chief:
+
+            # Restoration happens before variables are reported ready to other workers
+            def init_fn(sess):
+                if restore_snap is not None:
+                    saver.restore(sess, restore_snap)
+                    print("Model restored from " + restore_snap)
+
+            sess = manager.prepare_session(self.server.target,
+                                           init_op=tf.global_variables_initializer(),
+                                           init_fn=init_fn,
+                                           config=self.config)
+
+            # Start gradient aggregation
+            sess.run(sync_optimizer.get_init_tokens_op())
+            self.queue_threads = sync_optimizer.get_chief_queue_runner().create_threads(sess, start=True, daemon=True)
+
+        else:
+            print('Worker {:d} waiting for the chief to initialize variables'.format(self.task_index))
+            sess = manager.wait_for_session(self.server.target, config=self.config)
+
+        return sess
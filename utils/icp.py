@@ -0,0 +1,133 @@
+# ----------------------------------------------------------------------------------------------------------------------
+#
+#      Point-to-point ICP vectorized over many pairs of clouds
+#
+# ----------------------------------------------------------------------------------------------------------------------
+#
+#           Imports and global variables
+#       \**********************************/
+#
+
+
+# Basic libs
+import numpy as np
+from sklearn.neighbors import KDTree
+
+
+# ----------------------------------------------------------------------------------------------------------------------
+#
+#           Utility functions
+#       \***********************/
+#
+
+def pad_clouds(clouds):
+    """
+    Stack clouds of different sizes
+    :param clouds: list of P (N_i, 3) arrays
+    :return: (P, max N_i, 3) array padded with zeros, (P, max N_i) boolean mask of real points
+    """
+    lengths = np.array([c.shape[0] for c in clouds])
+    points = np.zeros((len(clouds), np.max(lengths), 3), dtype=np.float64)
+    mask = np.arange(np.max(lengths))[None, :] < lengths[:, None]
+    points[mask] = np.vstack(clouds)
+    return points, mask
+
+
+def best_rigid_transforms(sources, targets, weights):
+    """
+    Rotations and translations minimizing the weighted squared distances of corresponding points (SVD of the cross
+    covariance, without scaling like the point-to-point estimation of open3d). Pairs without correspondence get
+    the identity.
+    :param sources: (P, N, 3) array
+    :param targets: (P, N, 3) array, targets[p, i] is the correspondent of sources[p, i]
+    :param weights: (P, N) array, 1 for correspondences and 0 for unmatched or padding points
+    :return: rotations (P, 3, 3), translations (P, 3)
+    """
+
+    w_sum = np.sum(weights, axis=1)
+    safe_sum = np.maximum(w_sum, 1)[:, None]
+    source_centers = np.einsum('pn,pnd->pd', weights, sources) / safe_sum
+    target_centers = np.einsum('pn,pnd->pd', weights, targets) / safe_sum
+
+    # Cross covariance of the centered correspondences
+    H = np.einsum('pn,pni,pnj->pij', weights, sources - source_centers[:, None], targets - target_centers[:, None])
+    U, _, Vt = np.linalg.svd(H)
+
+    # Correct reflections so that R is a proper rotation
+    V = np.transpose(Vt, (0, 2, 1))
+    d = np.sign(np.linalg.det(np.matmul(V, np.transpose(U, (0, 2, 1)))))
+    d[d == 0] = 1
+    V[:, :, 2] *= d[:, None]
+    R = np.matmul(V, np.transpose(U, (0, 2, 1)))
+    t = target_centers - np.einsum('pij,pj->pi', R, source_centers)
+
+    empty = w_sum == 0
+    R[empty] = np.eye(3)
+    t[empty] = 0
+    return R, t
+
+
+# ----------------------------------------------------------------------------------------------------------------------
+#
+#           Batch registration
+#       \************************/
+#
+
+def batch_icp(sources, targets, max_iter=30, max_dist=0.05, relative_fitness=1e-6, relative_rmse=1e-6):
+    """
+    Point-to-point ICP of many pairs at once, with the same convergence criteria as open3d registration_icp started
+    from the identity. Nearest neighbors come from one KD-tree per target, transform updates are vectorized over
+    all pairs that have not converged yet.
+    :param sources: list of P (N_i, 3) arrays
+    :param targets: list of P (M_i, 3) arrays
+    :param max_iter: maximum number of iterations
+    :param max_dist: maximum distance of corresponding points
+    :param relative_fitness: convergence threshold on the change of fitness
+    :param relative_rmse: convergence threshold on the change of inlier rmse
+    :return: rotations (P, 3, 3), translations (P, 3), fitness (P,), inlier rmse (P,)
+    """
+
+    num_pairs = len(sources)
+    points, mask = pad_clouds(sources)
+    lengths = np.sum(mask, axis=1)
+    trees = [KDTree(target) for target in targets]
+
+    R = np.tile(np.eye(3), (num_pairs, 1, 1))
+    t = np.zeros((num_pairs, 3))
+    current = points.copy()
+    matched = np.zeros_like(points)
+    weights = np.zeros(mask.shape)
+    fitness = np.zeros(num_pairs)
+    rmse = np.zeros(num_pairs)
+
+    def update_correspondences(pairs):
+        for p in pairs:
+            n = lengths[p]
+            dist, idx = trees[p].query(current[p, :n], k=1)
+            inliers = dist[:, 0] <= max_dist
+            matched[p, :n] = targets[p][idx[:, 0]]
+            weights[p, :n] = inliers
+            num_inliers = np.sum(inliers)
+            fitness[p] = num_inliers / n
+            rmse[p] = np.sqrt(np.sum(dist[inliers, 0] ** 2) / num_inliers) if num_inliers > 0 else 0
+
+    active = np.arange(num_pairs)
+    update_correspondences(active)
+    for _ in range(max_iter):
+        dR, dt = best_rigid_transforms(current[active], matched[active], weights[active])
+
+        # Compose the update with the current transforms and move the sources
+        R[active] = np.matmul(dR, R[active])
+        t[active] = np.einsum('pij,pj->pi', dR, t[active]) + dt
+        current[active] = np.einsum('pij,pnj->pni', R[active], points[active]) + t[active, None, :]
+
+        prev_fitness = fitness[active]
+        prev_rmse = rmse[active]
+        update_correspondences(active)
+        converged = (np.abs(fitness[active] - prev_fitness) < relative_fitness) & \
+                    (np.abs(rmse[active] - prev_rmse) < relative_rmse)
+        active = active[np.logical_not(converged)]
+        if active.shape[0] == 0:
+            break
+
+    return R, t, fitness, rmse
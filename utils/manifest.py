@@ -0,0 +1,140 @@
+# ----------------------------------------------------------------------------------------------------------------------
+#
+#      Manifest of an incremental build, to only reprocess the models that changed
+#
+# ----------------------------------------------------------------------------------------------------------------------
+#
+#           Imports and global variables
+#       \**********************************/
+#
+
+
+# Basic libs
+import hashlib
+import json
+import threading
+from os import replace, getpid
+from os.path import exists, getmtime, getsize
+
+
+# ----------------------------------------------------------------------------------------------------------------------
+#
+#           Utility functions
+#       \***********************/
+#
+
+def file_hash(path, chunk_size=1 << 20):
+    """
+    md5 of the content of a file
+    """
+    md5 = hashlib.md5()
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(chunk_size), b''):
+            md5.update(chunk)
+    return md5.hexdigest()
+
+
+def file_signature(path):
+    """
+    Modification time, size and content hash of a file
+    """
+    return {'mtime': getmtime(path), 'size': getsize(path), 'md5': file_hash(path)}
+
+
+def same_file(path, signature):
+    """
+    True if the file still has the recorded content. The hash is only computed again when mtime or size changed.
+    If only mtime changed (e.g. file copied) but the content is the same, the recorded mtime is updated.
+    """
+    if not exists(path):
+        return False
+    mtime, size = getmtime(path), getsize(path)
+    if mtime == signature['mtime'] and size == signature['size']:
+        return True
+    if size != signature['size'] or file_hash(path) != signature['md5']:
+        return False
+    signature['mtime'] = mtime
+    return True
+
+
+# ----------------------------------------------------------------------------------------------------------------------
+#
+#           Class Definition
+#       \**********************/
+#
+
+class BuildManifest:
+    """
+    Json record of every processed model: signatures of its source and output files and the parameters used. A model
+    is up to date when its parameters are the same and none of its files changed.
+    """
+
+    def __init__(self, path, params):
+        """
+        Load the manifest if it exists
+        :param path: json file of the manifest
+        :param params: dictionary of the parameters of the build (json serializable), e.g. {'num_scans': 2}
+        """
+        self.path = path
+        self.params = json.loads(json.dumps(params))
+        self.lock = threading.Lock()
+
+        # True when is_current refreshed the modification time of unchanged files, the manifest has to be saved so
+        # that their content is not hashed again at the next load
+        self.refreshed = False
+
+        self.exists = exists(path)
+        if self.exists:
+            with open(path, 'r') as f:
+                self.entries = json.load(f)
+        else:
+            self.entries = {}
+
+    def is_current(self, key, sources, outputs=()):
+        """
+        True if the model was processed with the same parameters from the same sources and its outputs are unchanged
+        :param key: model id
+        :param sources: list of source file paths
+        :param outputs: list of output file paths
+        """
+        with self.lock:
+            entry = self.entries.get(key)
+        if entry is None or entry['params'] != self.params:
+            return False
+        if sorted(entry['sources']) != sorted(sources) or sorted(entry['outputs']) != sorted(outputs):
+            return False
+        signatures = list(entry['sources'].items()) + list(entry['outputs'].items())
+        mtimes = [s['mtime'] for p, s in signatures]
+        if not all([same_file(p, s) for p, s in signatures]):
+            return False
+        if any([s['mtime'] != mtime for (p, s), mtime in zip(signatures, mtimes)]):
+            with self.lock:
+                self.refreshed = True
+        return True
+
+    def record(self, key, sources, outputs=()):
+        """
+        Record a processed model with the current signatures of its files
+        """
+        entry = {'params': self.params,
+                 'sources': {p: file_signature(p) for p in sources},
+                 'outputs': {p: file_signature(p) for p in outputs}}
+        with self.lock:
+            self.entries[key] = entry
+
+    def remove(self, key):
+        with self.lock:
+            self.entries.pop(key, None)
+
+    def save(self):
+        """
+        Write the manifest (through a temporary file of this process so that an interrupted save, or processes saving
+        the same manifest, never corrupt it)
+        """
+        tmp_path = '{:s}.{:d}.tmp'.format(self.path, getpid())
+        with self.lock:
+            with open(tmp_path, 'w') as f:
+                json.dump(self.entries, f)
+            replace(tmp_path, self.path)
+            self.refreshed = False
+        self.exists = True
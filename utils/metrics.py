@@ -8,23 +8,52 @@ from pc_distance import tf_nndistance, tf_approxmatch
 #       \***************/
 #
 
-def chamfer(pcd1, pcd2):
+def chamfer(pcd1, pcd2, per_cloud=False):
     # return 2
     dist1, _, dist2, _ = tf_nndistance.nn_distance(pcd1, pcd2)
-    dist1 = tf.reduce_mean(tf.sqrt(dist1))
-    dist2 = tf.reduce_mean(tf.sqrt(dist2))
+    axis = 1 if per_cloud else None
+    dist1 = tf.reduce_mean(tf.sqrt(dist1), axis=axis)
+    dist2 = tf.reduce_mean(tf.sqrt(dist2), axis=axis)
     return (dist1 + dist2) / 2
 
 
-def earth_mover(pcd1, pcd2):
+def earth_mover(pcd1, pcd2, per_cloud=False):
     # return 2
     assert pcd1.shape[1] == pcd2.shape[1]
     num_points = tf.cast(pcd1.shape[1], tf.float32)
     match = tf_approxmatch.approx_match(pcd1, pcd2)
     cost = tf_approxmatch.match_cost(pcd1, pcd2, match)
+    if per_cloud:
+        return cost / num_points
     return tf.reduce_mean(cost / num_points)
 
 
+def vote_consensus(votes):
+    """
+    Mean chamfer distance between each vote and the other votes of the same cloud
+    :param votes: (C, V, P, 3) tensor, V completions of each of the C clouds
+    :return: (C, V) tensor
+    """
+    shape = tf.shape(votes)
+    num_votes = shape[1]
+    first, second = tf.meshgrid(tf.range(num_votes), tf.range(num_votes), indexing='ij')
+    first = tf.reshape(tf.gather(votes, tf.reshape(first, [-1]), axis=1), [-1, shape[2], 3])
+    second = tf.reshape(tf.gather(votes, tf.reshape(second, [-1]), axis=1), [-1, shape[2], 3])
+    dists = tf.reshape(chamfer(first, second, per_cloud=True), [-1, num_votes, num_votes])
+    return tf.reduce_sum(dists, axis=2) / tf.cast(tf.maximum(num_votes - 1, 1), tf.float32)
+
+
+def database_chamfer(pcd, database):
+    """
+    Chamfer distance between one cloud and every cloud of a database, in a single nn_distance call
+    :param pcd: (N, 3) tensor
+    :param database: (M, P, 3) tensor
+    :return: (M,) tensor of distances
+    """
+    tiled = tf.tile(tf.expand_dims(pcd, 0), [tf.shape(database)[0], 1, 1])
+    return chamfer(tiled, database, per_cloud=True)
+
+
 def minimal_matching_distance(pcd_fine, dataset):
     # cd_gt_from_fine_list = []
 
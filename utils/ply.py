@@ -1,5 +1,6 @@
 import numpy as np
 import sys
+from concurrent.futures import ThreadPoolExecutor
 from os.path import exists
 
 # Define PLY types
@@ -88,7 +89,26 @@ def parse_mesh_header(plyfile, ext):
     return num_points, num_faces, vertex_properties
 
 
-def read_ply(filename, triangular_mesh=False):
+def read_ascii_body(plyfile, properties, num_points, num_faces=None):
+    """
+    Parse the body of an ascii ply file in a single numpy call. Faces must be triangles.
+    :return: vertex structured array, and (F, 3) faces if num_faces is given
+    """
+    values = np.fromstring(plyfile.read().decode(), sep=' ')
+    num_values = num_points * len(properties)
+    table = values[:num_values].reshape(num_points, len(properties))
+
+    vertex_data = np.empty(num_points, dtype=properties)
+    for i, (name, _) in enumerate(properties):
+        vertex_data[name] = table[:, i]
+
+    if num_faces is None:
+        return vertex_data
+    faces = values[num_values:num_values + 4 * num_faces].reshape(num_faces, 4)[:, 1:].astype(np.int32)
+    return vertex_data, faces
+
+
+def read_ply(filename, triangular_mesh=False, mmap=False):
     """
     Read ".ply" files
 
@@ -97,6 +117,13 @@ def read_ply(filename, triangular_mesh=False):
     filename : string
         the name of the file to read.
 
+    triangular_mesh : bool
+        read the triangular faces too.
+
+    mmap : bool
+        memory-map the vertices of binary point cloud files instead of reading them. The result is a read-only
+        structured view of the file: nothing is loaded before it is accessed.
+
     Returns
     -------
     result : array
@@ -112,8 +139,6 @@ def read_ply(filename, triangular_mesh=False):
 
         # get binary_little/big or ascii
         fmt = plyfile.readline().split()[1].decode()
-        if fmt == "ascii":
-            raise ValueError('The file is not binary')
 
         # get extension for building the numpy dtypes
         ext = valid_formats[fmt]
@@ -122,6 +147,9 @@ def read_ply(filename, triangular_mesh=False):
             # Parse header
             num_points, num_faces, properties = parse_mesh_header(plyfile, ext)
 
+            if fmt == 'ascii':
+                return list(read_ascii_body(plyfile, properties, num_points, num_faces))
+
             # Get point data
             vertex_data = np.fromfile(plyfile, dtype=properties, count=num_points)
 
@@ -142,11 +170,27 @@ def read_ply(filename, triangular_mesh=False):
             num_points, properties = parse_header(plyfile, ext)
 
             # Get data
-            data = np.fromfile(plyfile, dtype=properties, count=num_points)
+            if fmt == 'ascii':
+                data = read_ascii_body(plyfile, properties, num_points)
+            elif mmap and num_points > 0:
+                data = np.memmap(filename, dtype=properties, mode='r', offset=plyfile.tell(), shape=(num_points,))
+            else:
+                data = np.fromfile(plyfile, dtype=properties, count=num_points)
 
     return data
 
 
+def read_ply_batch(filenames, num_threads=8, triangular_mesh=False, mmap=False):
+    """
+    Read many ".ply" files concurrently (file reads release the GIL)
+    :param filenames: list of files to read
+    :param num_threads: number of files read at the same time
+    :return: list of the data of each file, in the order of filenames
+    """
+    with ThreadPoolExecutor(max_workers=num_threads) as executor:
+        return list(executor.map(lambda f: read_ply(f, triangular_mesh=triangular_mesh, mmap=mmap), filenames))
+
+
 def header_properties(field_list, field_names):
     # List of lines to write
     lines = []
@@ -164,7 +208,7 @@ def header_properties(field_list, field_names):
     return lines
 
 
-def write_ply(filename, field_list, field_names, triangular_faces=None):
+def write_ply(filename, field_list, field_names=None, triangular_faces=None):
     """
     Write ".ply" files
 
@@ -177,11 +221,11 @@ def write_ply(filename, field_list, field_names, triangular_faces=None):
     field_list : list, tuple, numpy array
         the fields to be saved in the ply file. Either a numpy array, a list of numpy arrays or a
         tuple of numpy arrays. Each 1D numpy array and each column of 2D numpy arrays are considered
-        as one field.
+        as one field. A structured array is written directly, each of its names being a field.
 
     field_names : list
         the name of each fields as a list of strings. Has to be the same length as the number of
-        fields.
+        fields. Optional for a structured array.
 
     Examples
     --------
@@ -194,84 +238,99 @@ def write_ply(filename, field_list, field_names, triangular_faces=None):
     >>> colors = np.random.randint(255, size=(10,3), dtype=np.uint8)
     >>> field_names = ['x', 'y', 'z', 'red', 'green', 'blue', values]
     >>> write_ply('example3.ply', [points, colors, values], field_names)
+
+    >>> cloud = np.zeros(10, dtype=[('x', 'f4'), ('y', 'f4'), ('z', 'f4')])
+    >>> write_ply('example4.ply', cloud)
     """
 
-    # Format list input to the right form
-    field_list = list(field_list) if (type(field_list) == list or type(field_list) == tuple) else list((field_list,))
-    for i, field in enumerate(field_list):
-        if field.ndim < 2:
-            field_list[i] = field.reshape(-1, 1)
-        if field.ndim > 2:
-            print('fields have more than 2 dimensions')
+    # A structured array is written as it is, its names are the fields
+    if isinstance(field_list, np.ndarray) and field_list.dtype.names is not None:
+        data = field_list
+        if field_names is not None and list(field_names) != list(data.dtype.names):
+            print('field names differ from the names of the structured array')
             return False
 
-            # check all fields have the same number of data
-    n_points = [field.shape[0] for field in field_list]
-    if not np.all(np.equal(n_points, n_points[0])):
-        print('wrong field dimensions')
-        return False
+    else:
+
+        # Format list input to the right form
+        field_list = list(field_list) if (type(field_list) == list or type(field_list) == tuple) else list((field_list,))
+        for i, field in enumerate(field_list):
+            if field.ndim < 2:
+                field_list[i] = field.reshape(-1, 1)
+            if field.ndim > 2:
+                print('fields have more than 2 dimensions')
+                return False
+
+        # check all fields have the same number of data
+        n_points = [field.shape[0] for field in field_list]
+        if not np.all(np.equal(n_points, n_points[0])):
+            print('wrong field dimensions')
+            return False
 
         # Check if field_names and field_list have same nb of column
-    n_fields = np.sum([field.shape[1] for field in field_list])
-    if (n_fields != len(field_names)):
-        print('wrong number of field names')
-        return False
+        n_fields = np.sum([field.shape[1] for field in field_list])
+        if (n_fields != len(field_names)):
+            print('wrong number of field names')
+            return False
+
+        # Assemble the structured array. The columns of a field are consecutive in each record, so that each field
+        # is copied at once through a strided view
+        type_list = []
+        i = 0
+        for fields in field_list:
+            type_list += [(field_names[i + j], fields.dtype.str) for j in range(fields.shape[1])]
+            i += fields.shape[1]
+        data = np.empty(n_points[0], dtype=type_list)
+        i = 0
+        for fields in field_list:
+            view = np.ndarray((n_points[0], fields.shape[1]),
+                              dtype=fields.dtype,
+                              buffer=data,
+                              offset=data.dtype.fields[field_names[i]][1],
+                              strides=(data.dtype.itemsize, fields.dtype.itemsize))
+            view[:] = fields
+            i += fields.shape[1]
+
+    # Packed records in native byte order, as announced in the header
+    packed = np.dtype([(name, data.dtype.fields[name][0].newbyteorder('=')) for name in data.dtype.names])
+    if data.dtype != packed:
+        data = data.astype(packed)
 
     # Add extension if not there
     if not filename.endswith('.ply'):
         filename += '.ply'
 
-    # open in text mode to write the header
-    with open(filename, 'w') as plyfile:
-
-        # First magical word
-        header = ['ply']
-
-        # Encoding format
-        header.append('format binary_' + sys.byteorder + '_endian 1.0')
+    # First magical word
+    header = ['ply']
 
-        # Points properties description
-        header.extend(header_properties(field_list, field_names))
+    # Encoding format
+    header.append('format binary_' + sys.byteorder + '_endian 1.0')
 
-        # Add faces if needded
-        if triangular_faces is not None:
-            header.append('element face {:d}'.format(triangular_faces.shape[0]))
-            header.append('property list uchar int vertex_indices')
-
-        # End of header
-        header.append('end_header')
+    # Points properties description
+    header.append('element vertex %d' % data.shape[0])
+    header.extend(['property %s %s' % (data.dtype.fields[name][0].name, name) for name in data.dtype.names])
 
-        # Write all lines
-        for line in header:
-            plyfile.write("%s\n" % line)
+    # Add faces if needded
+    if triangular_faces is not None:
+        header.append('element face {:d}'.format(triangular_faces.shape[0]))
+        header.append('property list uchar int vertex_indices')
 
-    # open in binary/append to use tofile
-    with open(filename, 'ab') as plyfile:
-
-        # Create a structured array
-        i = 0
-        type_list = []
-        for fields in field_list:
-            for field in fields.T:
-                type_list += [(field_names[i], field.dtype.str)]
-                i += 1
-        data = np.empty(field_list[0].shape[0], dtype=type_list)
-        i = 0
-        for fields in field_list:
-            for field in fields.T:
-                data[field_names[i]] = field
-                i += 1
+    # End of header
+    header.append('end_header')
 
+    # Header and body are written in one pass through a single binary file
+    with open(filename, 'wb') as plyfile:
+        plyfile.write(('\n'.join(header) + '\n').encode())
         data.tofile(plyfile)
 
         if triangular_faces is not None:
             triangular_faces = triangular_faces.astype(np.int32)
             type_list = [('k', 'uint8')] + [(str(ind), 'int32') for ind in range(3)]
-            data = np.empty(triangular_faces.shape[0], dtype=type_list)
-            data['k'] = np.full((triangular_faces.shape[0],), 3, dtype=np.uint8)
-            data['0'] = triangular_faces[:, 0]
-            data['1'] = triangular_faces[:, 1]
-            data['2'] = triangular_faces[:, 2]
-            data.tofile(plyfile)
+            faces = np.empty(triangular_faces.shape[0], dtype=type_list)
+            faces['k'] = 3
+            faces['0'] = triangular_faces[:, 0]
+            faces['1'] = triangular_faces[:, 1]
+            faces['2'] = triangular_faces[:, 2]
+            faces.tofile(plyfile)
 
     return True
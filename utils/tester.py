@@ -14,6 +14,7 @@ import tensorflow as tf
 import numpy as np
 from os import makedirs
 from os.path import exists, join, dirname
+from concurrent.futures import ThreadPoolExecutor
 import time
 
 # PLY reader
@@ -21,9 +22,11 @@ from utils.ply import read_ply, write_ply
 import open3d as o3d
 
 # Metrics
-from utils.metrics import chamfer, earth_mover, minimal_matching_distance
+from utils.metrics import chamfer, earth_mover, minimal_matching_distance, vote_consensus
 
 from matplotlib import pyplot as plt
+from matplotlib.figure import Figure
+from matplotlib.backends.backend_agg import FigureCanvasAgg
 from mpl_toolkits.mplot3d import Axes3D
 
 from sklearn.decomposition import PCA
@@ -78,7 +81,13 @@ class ModelTester:
     # Test main methods
     # ------------------------------------------------------------------------------------------------------------------
 
-    def test_completion(self, model, dataset, on_val, calc_tsne, num_votes=100):
+    def test_completion(self, model, dataset, on_val, calc_tsne, vote_fusion='consensus'):
+
+        # Test time augmentation, the input pipeline stacks the votes of each cloud in the same batches
+        if model.config.num_votes > 1:
+            if not on_val:
+                raise ValueError('Votes are only supported on the validation split')
+            return self.test_completion_votes(model, dataset, vote_fusion)
 
         mean_dt = np.zeros(2)
         last_display = time.time()
@@ -314,9 +323,193 @@ class ModelTester:
 
         return
 
-    def test_kitti_completion(self, model, dataset, shapenet2048_dataset):
+    def test_completion_votes(self, model, dataset, fusion='consensus'):
+        """
+        Validation with test time augmentation. Each cloud comes config.num_votes times in a row from the input
+        pipeline, every copy of the partial cloud with its own rotation and scale. The network completes in the frame
+        of the ground truth (only partial clouds are augmented), so the votes of each cloud are fused as they are.
+        :param fusion: 'consensus' keeps the vote with the smallest mean chamfer distance to the other votes of its
+                       cloud. 'oracle' keeps the vote with the smallest coarse EMD to the ground truth, which is only an
+                       upper bound of what voting can bring
+
+        Without any augmentation all votes of a cloud are identical. The distances of each vote are then
+        checked against the batch distances of test_completion, and against the other votes of their cloud.
+        """
+
+        config = model.config
+        num_votes = config.num_votes
+        if fusion not in ['consensus', 'oracle']:
+            raise ValueError('Unknown vote fusion : ' + fusion)
+        check = config.augment_rotation == 'none' and config.augment_scale_min == config.augment_scale_max == 1.0 and \
+            not any(config.augment_symmetries) and config.augment_noise == 0
+
+        # Distances of each completion of the batch, with the metrics of test_completion
+        gt_ds = tf.reshape(model.inputs['complete_points'], [-1, config.num_gt_points, 3])
+        fine_cd_op = chamfer(model.fine, gt_ds, per_cloud=True)
+        coarse_em_op = earth_mover(model.coarse, gt_ds[:, :config.num_coarse, :], per_cloud=True)
+
+        # Distances between the votes, computed for all the clouds completed by a batch at once
+        votes_fine = tf.placeholder(tf.float32, (None, num_votes, None, 3))
+        consensus_op = vote_consensus(votes_fine)
+
+        ops = (model.coarse, model.fine, model.complete_points, model.inputs['points'][0],
+               model.inputs['partial_sizes'], model.inputs['augment_scales'], model.inputs['augment_rotations'],
+               model.inputs['object_inds'], model.inputs['ids'], fine_cd_op, coarse_em_op)
+        if check:
+            ops += (self.fine_chamfer, self.coarse_earth_mover)
+
+        if model.config.saving:
+            if not exists(join(model.saving_path, 'visu', 'test_on_val_votes')):
+                makedirs(join(model.saving_path, 'visu', 'test_on_val_votes'))
+        visualize_titles = ['input', 'coarse output', 'fine output', 'ground truth']
+
+        # Run model on all test examples
+        # ******************************
+
+        # Votes received for each object index
+        votes = {}
+
+        # Distances of each cloud: all votes and fused
+        single_cd_list = []
+        fused_cd_list = []
+        best_cd_list = []
+        single_em_list = []
+        fused_em_list = []
+
+        num_fused = 0
+        network_time = 0
+        fusion_time = 0
+        mean_dt = np.zeros(2)
+        last_display = time.time()
+
+        self.sess.run(dataset.val_init_op)
+        cardinal = dataset.num_valid
+        while True:
+            try:
+                # Run one step of the model.
+                t = [time.time()]
+                coarse, fine, complete, partial, partial_sizes, scales, rots, inds, idss, fine_cd, coarse_em, \
+                    *batch_dists = self.sess.run(ops, {model.dropout_prob: 1.0})
+                t += [time.time()]
+
+                # Same distances as test_completion, which averages them over the batch
+                if check and not (np.isclose(np.mean(fine_cd), batch_dists[0], rtol=1e-4) and
+                                  np.isclose(np.mean(coarse_em), batch_dists[1], rtol=1e-4)):
+                    raise ValueError('Vote distances differ from the distances of test_completion')
+
+                complete = np.reshape(complete, (-1, config.num_gt_points, 3))
+                partial = np.split(partial, np.cumsum(partial_sizes)[:-1])
+
+                done = []
+                for j, obj_ind in enumerate(inds):
+
+                    # Only the partial cloud was augmented as (p.R) * s, back to the frame of the ground truth
+                    votes.setdefault(obj_ind, []).append((coarse[j],
+                                                          fine[j],
+                                                          np.matmul(partial[j] / scales[j], rots[j].T),
+                                                          complete[j],
+                                                          idss[j],
+                                                          fine_cd[j],
+                                                          coarse_em[j]))
+                    if len(votes[obj_ind]) == num_votes:
+                        done += [votes.pop(obj_ind)]
+
+                # Fuse the votes of the completed clouds
+                if done:
+                    fine_cds = np.array([[v[5] for v in cloud_votes] for cloud_votes in done])
+                    coarse_ems = np.array([[v[6] for v in cloud_votes] for cloud_votes in done])
+                    if fusion == 'consensus':
+                        consensus = self.sess.run(consensus_op, {
+                            votes_fine: np.stack([[v[1] for v in cloud_votes] for cloud_votes in done])})
+                        chosen = np.argmin(consensus, axis=1)
+                    else:
+                        chosen = np.argmin(coarse_ems, axis=1)
+                    rows = np.arange(len(done))
+                    num_fused += len(done)
+
+                    # Identical votes must give identical distances
+                    if check and not (np.allclose(fine_cds, fine_cds[:, :1], rtol=1e-4) and
+                                      np.allclose(coarse_ems, coarse_ems[:, :1], rtol=1e-4)):
+                        raise ValueError('Votes of the same cloud differ without augmentation')
+
+                    single_cd_list += [fine_cds]
+                    fused_cd_list += [fine_cds[rows, chosen]]
+                    best_cd_list += [np.min(fine_cds, axis=1)]
+                    single_em_list += [coarse_ems]
+                    fused_em_list += [coarse_ems[rows, chosen]]
+
+                t += [time.time()]
+
+                # Plot first cloud of the batch
+                if done and model.config.saving:
+                    fused = done[0][chosen[0]]
+                    plot_path = join(model.saving_path, 'visu', 'test_on_val_votes',
+                                     '%s.png' % fused[4].decode().split(".")[0])
+                    if not exists(dirname(plot_path)):
+                        makedirs(dirname(plot_path))
+                    suptitle = 'Coarse EMD = {:4.5f}    Fine CD = {:4.5f}    ({:d} votes)'.format(
+                        coarse_ems[0, chosen[0]], fine_cds[0, chosen[0]], num_votes)
+                    final_pcs = [fused[2][:config.num_input_points, :], fused[0], fused[1], fused[3]]
+                    self.plot_pc_compare_views(plot_path, final_pcs, visualize_titles, suptitle=suptitle)
+
+                # Average timing
+                network_time += t[1] - t[0]
+                fusion_time += t[2] - t[1]
+                mean_dt = 0.95 * mean_dt + 0.05 * (np.array(t[1:]) - np.array(t[:-1]))
+
+                # Display
+                if (t[-1] - last_display) > 1.0:
+                    last_display = t[-1]
+                    message = 'Test : {:.1f}% (timings : {:4.2f} {:4.2f})'
+                    print(message.format(100 * num_fused / cardinal,
+                                         1000 * (mean_dt[0]),
+                                         1000 * (mean_dt[1])))
+
+            except tf.errors.OutOfRangeError:
+                break
+
+        if votes:
+            print('Warning: {:d} clouds did not receive all their votes'.format(len(votes)))
+
+        single_cd = np.vstack(single_cd_list)
+        single_em = np.vstack(single_em_list)
+        fused_cd = np.hstack(fused_cd_list)
+        fused_em = np.hstack(fused_em_list)
+        best_cd = np.hstack(best_cd_list)
+        num_clouds = fused_cd.shape[0]
+
+        print('Test distances with {:d} votes ({:s} fusion) on {:d} clouds'.format(num_votes, fusion, num_clouds))
+        print('Mean (Fine) Chamfer: {:4.5f} single vote, {:4.5f} fused, {:4.5f} best vote'.format(np.mean(single_cd),
+                                                                                               np.mean(fused_cd),
+                                                                                               np.mean(best_cd)))
+        print('Mean (Coarse) Earth Mover: {:4.5f} single vote, {:4.5f} fused'.format(np.mean(single_em),
+                                                                                   np.mean(fused_em)))
+        print('Time per cloud: {:.1f} ms ({:.1f} ms per vote, {:.1f} ms of fusion)'.format(
+            1000 * (network_time + fusion_time) / num_clouds,
+            1000 * network_time / (num_clouds * num_votes),
+            1000 * fusion_time / num_clouds))
+        if check:
+            print('Without augmentation, votes match the distances of test_completion')
+
+        return
+
+    def test_kitti_completion(self, model, dataset, shapenet2048_dataset=None, write_pcd=True, write_array=False,
+                              num_writers=4):
+        """
+        Complete all KITTI cars. Completions are written back in the KITTI frame of each car while inference runs.
+        :param shapenet2048_dataset: loaded ShapeNet dataset to compute the MMD metric in the graph (None to only
+                                     complete cars, MMD can then be computed on stored completions with kitti_mmd.py)
+        :param write_pcd: write one .pcd file per car in visu/kitti/completions
+        :param write_array: write all completions in visu/kitti/completions.npy [num_cars, num_fine, 3] with
+                            the car id of each row in visu/kitti/completions_ids.txt
+        :param num_writers: number of background threads writing .pcd files
+        """
+
         # Set MMD metric op by passing ShapeNet dataset
-        self.minimal_matching_dist = minimal_matching_distance(model.fine, shapenet2048_dataset)
+        ops = [model.coarse, model.fine, model.inputs['points'], model.inputs['object_inds'], model.inputs['ids']]
+        if shapenet2048_dataset is not None:
+            self.minimal_matching_dist = minimal_matching_distance(model.fine, shapenet2048_dataset)
+            ops += [self.minimal_matching_dist]
 
         # Initialise iterator with data
         self.sess.run(dataset.test_init_op)
@@ -325,34 +518,78 @@ class ModelTester:
         mean_dt = np.zeros(2)
         last_display = time.time()
 
+        # Prepare outputs
+        # ***************
+
+        kitti_path = join(model.saving_path, 'visu', 'kitti') if model.config.saving else None
+        visualize_titles = ['input', 'coarse output', 'fine output']
+        if model.config.saving:
+            if not exists(join(kitti_path, 'plots')):
+                makedirs(join(kitti_path, 'plots'))
+            if not exists(join(kitti_path, 'completions')):
+                makedirs(join(kitti_path, 'completions'))
+
+            # Completions of all cars in one array, row i is the car of object index i. It is created with the first
+            # batch, when the number of points of the completions is known
+            completions = None
+            if write_array:
+                with open(join(kitti_path, 'completions_ids.txt'), 'w') as f:
+                    f.write('\n'.join([car_id.split('.')[0] for car_id in dataset.ids['test']]) + '\n')
+
+            # Files are written by background threads (only one for matplotlib plots)
+            pcd_writers = ThreadPoolExecutor(max_workers=num_writers)
+            plot_writer = ThreadPoolExecutor(max_workers=1)
+            pending = []
+
         # Run model on all test examples
         # ******************************
 
-        # Initiate result containers
-        coarse_list = []
-        fine_list = []
-        partial_points_list = []
-        obj_inds = []
-        ids_list = []
-        mmd_list = []
-
+        n_done = 0
+        mmds = []
         while True:
             try:
                 # Run one step of the model.
                 t = [time.time()]
-                ops = (
-                    model.coarse, model.fine, model.inputs['points'], model.inputs['object_inds'], model.inputs['ids'],
-                    self.minimal_matching_dist)
-                coarse, fine, partial, inds, idss, mmd = self.sess.run(ops, {model.dropout_prob: 1.0})
+                coarse, fine, partial, inds, idss, *mmd = self.sess.run(ops, {model.dropout_prob: 1.0})
                 t += [time.time()]
 
-                # Get results and append to list
-                coarse_list += [coarse]
-                fine_list += [fine]
-                partial_points_list += [partial]
-                obj_inds += [inds]
-                ids_list += [idss]
-                mmd_list += [mmd]
+                # mmd is a pair ([idx1, idx2, ..., idx16], [cd1, cd2, ..., cd16])
+                if mmd:
+                    mmds += list(mmd[0][1])
+                n_done += len(inds)
+
+                if model.config.saving:
+
+                    # Plot first car of the batch
+                    car_id = idss[0].decode().split('.')[0]
+                    suptitle = 'Minimal Matching Distance (MMD) = {:4.5f}'.format(mmd[0][1][0]) if mmd else ''
+                    final_pcs = [partial[0][:model.config.num_input_points, :], coarse[0, :, :], fine[0, :, :]]
+                    pending += [plot_writer.submit(self.plot_pc_compare_views,
+                                                   join(kitti_path, 'plots', '%s.png' % car_id),
+                                                   final_pcs,
+                                                   visualize_titles,
+                                                   suptitle=suptitle)]
+
+                    # Save completions back in the KITTI frame of the car
+                    for j, car_id in enumerate(idss):
+                        car_id = car_id.decode().split('.')[0]
+                        completion_w = dataset.bboxes.denormalize(car_id, fine[j, :, :])
+                        if write_array:
+                            if completions is None:
+                                completions = np.lib.format.open_memmap(join(kitti_path, 'completions.npy'),
+                                                                        mode='w+',
+                                                                        dtype=np.float32,
+                                                                        shape=(cardinal, fine.shape[1], 3))
+                            completions[inds[j]] = completion_w
+                        if write_pcd:
+                            pending += [pcd_writers.submit(self.save_pcd,
+                                                           join(kitti_path, 'completions', '%s.pcd' % car_id),
+                                                           completion_w)]
+
+                    # Surface writer errors early and forget finished writes
+                    for future in [f for f in pending if f.done()]:
+                        future.result()
+                    pending = [f for f in pending if not f.done()]
 
                 # Average timing
                 t += [time.time()]
@@ -362,81 +599,91 @@ class ModelTester:
                 if (t[-1] - last_display) > 1.0:
                     last_display = t[-1]
                     message = 'Test : {:.1f}% (timings : {:4.2f} {:4.2f})'
-                    print(message.format(100 * len(obj_inds) / cardinal,
+                    print(message.format(100 * n_done / cardinal,
                                          1000 * (mean_dt[0]),
                                          1000 * (mean_dt[1])))
 
             except tf.errors.OutOfRangeError:
                 break
 
-        # Gather mmd and respective matched model from mmd_list, also calc mean mmd
-        #  mmd_list has shape: [([idx1, idx2, idx3, ..., idx16], [cd1, cd2, cd3, ..., cd16]), (...),...]
-        matched_models_list = []
-        mmds = []
-        for idxb, pair in enumerate(mmd_list):
-            # for idd in pair[0]:
-            #     matched_models_list.append(shapenet2048_dataset.complete_points['valid'][idd])  # store matchd model
-            for mmd in pair[1]:
-                mmds.append(mmd)  # store mmd
-
-        # matched_models_list = np.array(matched_models_list)
-        # matched_models_list = np.reshape(matched_models_list,
-        #                                  (-1, dataset.batch_num, matched_models_list.shape[1],
-        #                                   matched_models_list.shape[2]))
-        mmds = np.array(mmds)  # shape: (2401,)
-        mmd_mean = np.mean(mmds)
-        print('Test MMD: {:4.5f}'.format(mmd_mean))
-        mmds = np.reshape(mmds[:-1], (-1, dataset.batch_num))
+        if mmds:
+            mmds = np.array(mmds)  # shape: (num_cars,)
+            mmd_mean = np.mean(mmds)
+            print('Test MMD: {:4.5f}'.format(mmd_mean))
 
+        # Wait for the last files
         if model.config.saving:
-            if not exists(join(model.saving_path, 'visu', 'kitti', 'plots')):
-                makedirs(join(model.saving_path, 'visu', 'kitti', 'plots'))
+            for future in pending:
+                future.result()
+            pcd_writers.shutdown()
+            plot_writer.shutdown()
+            if completions is not None:
+                completions.flush()
+                del completions
 
-            if not exists(join(model.saving_path, 'visu', 'kitti', 'completions')):
-                makedirs(join(model.saving_path, 'visu', 'kitti', 'completions'))
+        return
 
-            # Plot & save completed pcd code
-            all_pcs = [partial_points_list, coarse_list, fine_list]
-            all_dist = [mmds]
-            visualize_titles = ['input', 'coarse output', 'fine output']
-            for i, id_batch_np in enumerate(ids_list):
-                for j, batch_el_idx in enumerate(id_batch_np):
+    def complete_clouds(self, model, dataset, output_path, dtype=np.float32):
+        """
+        Complete the clouds of a PartialCloudsDataset. Completions are written in output_path/completions.npy
+        [num_clouds, num_fine, 3] in the frame of their input cloud, row i being the cloud of file i (listed in
+        output_path/completions_ids.txt). Rows of the clouds that could not be read stay at zero, these clouds are
+        listed in output_path/failed.txt
+        :param dtype: type of the stored completions (np.float16 halves the size of the file)
+        """
 
-                    car_id = id_batch_np[j].decode().split(".")[0]
-                    pcs = [x[i] for x in all_pcs]
-                    dists = [d[i] for d in all_dist]
-                    suptitle = 'Minimal Matching Distance (MMD) = {:4.5f}'.format(dists[0][0])
+        if not exists(output_path):
+            makedirs(output_path)
+        with open(join(output_path, 'completions_ids.txt'), 'w') as f:
+            f.write(''.join([path + '\n' for path in dataset.files]))
+
+        # Initialise iterator with data
+        self.sess.run(dataset.test_init_op)
+        cardinal = dataset.num_clouds
+
+        # Created with the first batch, when the number of points of the completions is known
+        completions = None
+
+        n_done = 0
+        t0 = time.time()
+        last_display = t0
+        while True:
+            try:
+                # Run one step of the model.
+                fine, inds = self.sess.run((model.fine, model.inputs['object_inds']), {model.dropout_prob: 1.0})
+
+                if completions is None:
+                    completions = np.lib.format.open_memmap(join(output_path, 'completions.npy'),
+                                                            mode='w+',
+                                                            dtype=dtype,
+                                                            shape=(cardinal, fine.shape[1], 3))
 
-                    # Plot
-                    if j == 0:
-                        plot_path = join(model.saving_path, 'visu', 'kitti', 'plots', '%s.png' % car_id)
-                        if not exists(dirname(plot_path)):
-                            makedirs(dirname(plot_path))
-                        partial_temp = pcs[0][0][:model.config.num_input_points, :]
-                        coarse_temp = pcs[1][0, :, :]
-                        fine_temp = pcs[2][0, :, :]
-                        final_pcs = [partial_temp, coarse_temp, fine_temp]
-                        self.plot_pc_compare_views(plot_path, final_pcs, visualize_titles, suptitle=suptitle)
-
-                    # Save pcd
-                    # Calculate center, rotation and scale
-                    bbox = np.loadtxt(join(dataset.bbox_dir, '%s.txt' % car_id))
-                    center = (bbox.min(0) + bbox.max(0)) / 2
-                    bbox -= center
-                    yaw = np.arctan2(bbox[3, 1] - bbox[0, 1], bbox[3, 0] - bbox[0, 0])
-                    rotation = np.array([[np.cos(yaw), -np.sin(yaw), 0],
-                                         [np.sin(yaw), np.cos(yaw), 0],
-                                         [0, 0, 1]])
-                    bbox = np.dot(bbox, rotation)
-                    scale = bbox[3, 0] - bbox[0, 0]
-                    bbox /= scale
-
-                    completion_w = np.dot(pcs[2][j, :, :], [[1, 0, 0], [0, 0, 1], [0, 1, 0]])
-                    completion_w = np.dot(completion_w * scale, rotation.T) + center
-                    pcd_path = join(model.saving_path, 'visu', 'kitti', 'completions', '%s.pcd' % car_id)
-                    if not exists(dirname(pcd_path)):
-                        makedirs(dirname(pcd_path))
-                    self.save_pcd(pcd_path, completion_w)
+                for j, cloud_i in enumerate(inds):
+                    completions[cloud_i] = dataset.denormalize(cloud_i, fine[j])
+                n_done += len(inds)
+
+                # Display
+                t = time.time()
+                if (t - last_display) > 1.0:
+                    last_display = t
+                    message = 'Completion : {:.1f}% ({:.1f} clouds/s)'
+                    print(message.format(100 * (n_done + len(dataset.failed)) / cardinal, n_done / (t - t0)))
+
+            except tf.errors.OutOfRangeError:
+                break
+
+        if completions is not None:
+            completions.flush()
+            del completions
+
+        with open(join(output_path, 'failed.txt'), 'w') as f:
+            f.write(''.join(['%s\t%s\n' % (path, error) for path, error in dataset.failed]))
+
+        dt = time.time() - t0
+        print('{:d} clouds completed in {:.1f} s ({:.1f} clouds/s), {:d} failed'.format(n_done,
+                                                                                     dt,
+                                                                                     n_done / max(dt, 1e-6),
+                                                                                     len(dataset.failed)))
 
         return
 
@@ -445,7 +692,10 @@ class ModelTester:
                               xlim=(-0.3, 0.3), ylim=(-0.3, 0.3), zlim=(-0.3, 0.3)):
         if sizes is None:
             sizes = [0.5 for i in range(len(pcs))]
-        fig = plt.figure(figsize=(len(pcs) * 3, 9))
+
+        # Figure outside of pyplot, so that plots can be drawn by a background thread
+        fig = Figure(figsize=(len(pcs) * 3, 9))
+        FigureCanvasAgg(fig)
         for i in range(3):
             elev = 30
             azim = -45 + 90 * i
@@ -459,10 +709,9 @@ class ModelTester:
                 ax.set_xlim(xlim)
                 ax.set_ylim(ylim)
                 ax.set_zlim(zlim)
-        plt.subplots_adjust(left=0.05, right=0.95, bottom=0.05, top=0.9, wspace=0.1, hspace=0.1)
-        plt.suptitle(suptitle)
+        fig.subplots_adjust(left=0.05, right=0.95, bottom=0.05, top=0.9, wspace=0.1, hspace=0.1)
+        fig.suptitle(suptitle)
         fig.savefig(filename)
-        plt.close(fig)
 
     @staticmethod
     def save_pcd(filename, points):
@@ -43,7 +43,10 @@ class ModelTrainer:
     # Initiation methods
     # ------------------------------------------------------------------------------------------------------------------
 
-    def __init__(self, model, restore_snap=None):
+    def __init__(self, model, restore_snap=None, cluster=None):
+
+        # Data parallel cluster (None for a single process training)
+        self.cluster = cluster
 
         # Add training ops
         self.add_train_ops(model)
@@ -68,6 +71,11 @@ class ModelTrainer:
         print('total parameters : ', summ)
         print('*************************************')
 
+        # Data parallel workers share variables stored on the parameter server
+        if self.cluster is not None:
+            self.sess = self.cluster.create_session(self.sync_optimizer, self.saver, restore_snap)
+            return
+
         # Create a session for running Ops on the Graph.
         # TODO: add auto check device
         on_CPU = False
@@ -77,6 +85,8 @@ class ModelTrainer:
         else:
             cProto = tf.ConfigProto()
             cProto.gpu_options.allow_growth = True
+        cProto.intra_op_parallelism_threads = model.config.intra_op_threads
+        cProto.inter_op_parallelism_threads = model.config.inter_op_threads
         self.sess = tf.Session(config=cProto)
 
         # Init variables
@@ -115,8 +125,38 @@ class ModelTrainer:
             # Create the gradient descent optimizer with the given learning rate.
             optimizer = tf.train.MomentumOptimizer(self.learning_rate, model.config.momentum)
 
+            # Data parallel training averages the gradients of all workers before each update
+            global_step = None
+            if self.cluster is not None:
+                if model.config.accum_steps > 1:
+                    raise ValueError('Gradient accumulation is not supported with data parallel training')
+                optimizer = tf.train.SyncReplicasOptimizer(optimizer,
+                                                           replicas_to_aggregate=self.cluster.num_workers,
+                                                           total_num_replicas=self.cluster.num_workers)
+                self.sync_optimizer = optimizer
+                global_step = tf.train.get_or_create_global_step()
+
+            # Float16 gradients are computed on a scaled loss so that small values do not underflow
+            if model.config.mixed_precision == 'float16':
+                loss_scale = model.config.loss_scale
+            else:
+                loss_scale = 1.0
+
             # Training step op
-            gvs = optimizer.compute_gradients(model.loss)
+            gvs = optimizer.compute_gradients(model.loss * loss_scale)
+            if loss_scale != 1.0:
+                gvs = [(grad / loss_scale if grad is not None else None, var) for grad, var in gvs]
+
+            # Batch normalization statistics are updated with every forward pass on training data
+            extra_update_ops = tf.get_collection(tf.GraphKeys.UPDATE_OPS)
+
+            if model.config.accum_steps > 1:
+
+                # Sum gradients of each batch into accumulators, the update is done on their mean
+                gvs = self.add_accumulation_ops(gvs, extra_update_ops, model.config.accum_steps)
+
+                # The update only reads the accumulators, it must not trigger a new forward pass
+                extra_update_ops = []
 
             if model.config.grad_clip_norm > 0:
 
@@ -138,14 +178,21 @@ class ModelTrainer:
                 # vars = [var for grad, var in gvs]
                 # capped_gvs = [(grad, var) for grad, var in zip(capped_grads, vars)]
 
-                extra_update_ops = tf.get_collection(tf.GraphKeys.UPDATE_OPS)
                 with tf.control_dependencies(extra_update_ops):
-                    self.train_op = optimizer.apply_gradients(capped_gvs)
+                    self.train_op = optimizer.apply_gradients(capped_gvs, global_step=global_step)
 
             else:
-                extra_update_ops = tf.get_collection(tf.GraphKeys.UPDATE_OPS)
                 with tf.control_dependencies(extra_update_ops):
-                    self.train_op = optimizer.apply_gradients(gvs)
+                    self.train_op = optimizer.apply_gradients(gvs, global_step=global_step)
+
+            # Workers stop together. The chief raises the stop flag and gives one more sync token to each worker, so
+            # that none of them waits forever for an update. Global step and flag are read after each training step
+            if self.cluster is not None:
+                self.stop_flag = tf.Variable(False, trainable=False, name='stop_training')
+                self.stop_op = self.stop_flag.assign(True)
+                self.release_op = optimizer.get_init_tokens_op(self.cluster.num_workers)
+                with tf.control_dependencies([self.train_op]):
+                    self.sync_state_op = (tf.identity(global_step), self.stop_flag.read_value())
 
         ############
         # Result ops
@@ -164,6 +211,56 @@ class ModelTrainer:
 
         return
 
+    def add_accumulation_ops(self, gvs, extra_update_ops, accum_steps):
+        """
+        Add non-trainable gradient accumulators. The accumulation op sums the gradients of one batch, while the
+        returned gradients are the mean over all accumulated batches, so that per-variable scaling and clipping applied
+        on them afterwards behave exactly as with a single big batch. Accumulators are not in the saver: snapshots are
+        only taken at the end of an epoch, after the last gradients have been applied, when they are empty.
+        :param gvs: list of (gradient, variable) pairs given by the optimizer
+        :param extra_update_ops: ops that have to run with each accumulated batch (batch norm statistics)
+        :param accum_steps: number of batches accumulated before each update
+        :return: list of (mean accumulated gradient, variable) pairs
+        """
+
+        gvs = [(grad, var) for grad, var in gvs if grad is not None]
+
+        # One accumulator per trainable variable, plus the number of batches accumulated since last update
+        self.accum_vars = [tf.Variable(tf.zeros(var.shape, dtype=var.dtype.base_dtype),
+                                       trainable=False,
+                                       name=var.op.name.replace('/', '_') + '_accum')
+                           for grad, var in gvs]
+        self.accum_count = tf.Variable(0.0, trainable=False, name='accum_count')
+
+        # Accumulation op
+        with tf.control_dependencies(extra_update_ops):
+            accum_ops = [accum.assign_add(grad) for accum, (grad, var) in zip(self.accum_vars, gvs)]
+            accum_ops += [self.accum_count.assign_add(1.0)]
+            self.accum_op = tf.group(*accum_ops)
+
+        # Reset op
+        zero_ops = [accum.assign(tf.zeros_like(accum)) for accum in self.accum_vars]
+        zero_ops += [self.accum_count.assign(0.0)]
+        self.zero_accum_op = tf.group(*zero_ops)
+
+        # Display the memory cost of the accumulators
+        accum_size = np.sum([np.prod(accum.shape.as_list()) for accum in self.accum_vars])
+        print('Gradient accumulation over {:d} batches ({:.1f} MB of accumulators)'.format(
+            accum_steps, accum_size * 4 * 1e-6))
+
+        # Mean gradients (the count is only smaller than accum_steps when flushing at the end of an epoch)
+        accum_n = tf.maximum(self.accum_count, 1.0)
+        return [(accum / accum_n, var) for accum, (grad, var) in zip(self.accum_vars, gvs)]
+
+    def apply_accumulated_gradients(self):
+        """
+        Update the network with the mean of accumulated gradients and reset the accumulators
+        """
+
+        self.sess.run(self.train_op)
+        self.sess.run(self.zero_accum_op)
+        self.accum_n = 0
+
     # Training main method
     # ------------------------------------------------------------------------------------------------------------------
 
@@ -205,6 +302,26 @@ class ModelTrainer:
         self.training_labels = np.zeros(0)
         epoch_n = 1
         mean_epoch_n = 0
+        self.accum_n = 0
+        accumulate = model.config.accum_steps > 1
+
+        # Only one worker updates shared hyper-parameters and validates when training in parallel
+        is_chief = self.cluster is None or self.cluster.is_chief
+        num_workers = 1 if self.cluster is None else self.cluster.num_workers
+
+        # Throughput of the whole run (all workers), measured on training steps after the first ones (graph warmup)
+        warmup_steps = 10
+        throughput_n = 0
+        throughput_dt = 0.0
+        self.clouds_per_s = 0.0
+
+        # Data parallel epochs have the same number of steps on every worker (shards are truncated to the same number
+        # of clouds). Workers end together, when the shared global step reaches the end of the training
+        if self.cluster is not None:
+            steps_per_epoch = max(1, dataset.num_train // num_workers // model.config.batch_num)
+            total_steps = (model.config.max_epoch - self.training_epoch) * steps_per_epoch
+            shard_n = 0
+        sync_done = False
 
         # Initialise iterator with train data
         self.sess.run(dataset.train_init_op)
@@ -220,15 +337,22 @@ class ModelTrainer:
             alpha_idx = 2
         elif self.training_epoch >= model.config.alpha_epoch[3]:
             alpha_idx = 3
-        op = model.alpha.assign(model.config.alphas[alpha_idx])
-        self.sess.run(op)
+        if is_chief:
+            op = model.alpha.assign(model.config.alphas[alpha_idx])
+            self.sess.run(op)
 
         # Start loop
-        while self.training_epoch < model.config.max_epoch:
+        while not sync_done if self.cluster is not None else self.training_epoch < model.config.max_epoch:
             try:
                 # Run one step of the model.
                 t = [time.time()]
-                ops = [self.train_op,
+                if accumulate:
+                    step_op = self.accum_op
+                elif self.cluster is not None:
+                    step_op = self.sync_state_op
+                else:
+                    step_op = self.train_op
+                ops = [step_op,
                        model.output_loss,
                        model.regularization_loss,
                        model.offsets_loss,
@@ -244,6 +368,7 @@ class ModelTrainer:
                     all_values = self.sess.run(ops + [self.check_op] + list(dataset.flat_inputs),
                                                {model.dropout_prob: 0.5})
                     L_out, L_reg, L_p, coarse, complete, coarse_em, fine_cd, mixed_loss, alppha = all_values[1:7]
+                    step_state = all_values[0]
                     if np.isnan(L_reg) or np.isnan(L_out):
                         input_values = all_values[8:]
                         self.debug_nan(model, input_values, coarse)
@@ -251,9 +376,15 @@ class ModelTrainer:
 
                 else:
                     # Run normal
-                    _, L_out, L_reg, L_p, coarse, complete, coarse_em, fine_cd, mixed_loss, alppha = \
+                    step_state, L_out, L_reg, L_p, coarse, complete, coarse_em, fine_cd, mixed_loss, alppha = \
                         self.sess.run(ops, {model.dropout_prob: 0.5})
 
+                # Update network once enough batches have been accumulated
+                if accumulate:
+                    self.accum_n += 1
+                    if self.accum_n == model.config.accum_steps:
+                        self.apply_accumulated_gradients()
+
                 t += [time.time()]
 
                 # Stack prediction for training confusion
@@ -264,12 +395,26 @@ class ModelTrainer:
 
                 # Average timing
                 mean_dt = 0.95 * mean_dt + 0.05 * (np.array(t[1:]) - np.array(t[:-1]))
+                if warmup_steps > 0:
+                    warmup_steps -= 1
+                else:
+                    throughput_n += 1
+                    throughput_dt += t[1] - t[0]
+                    self.clouds_per_s = num_workers * model.config.batch_num * throughput_n / throughput_dt
 
                 # Console display (only one per second)
                 if (t[-1] - last_display) > 1.0:
                     last_display = t[-1]
                     message = 'Epoch {:04d} / Step {:08d} L_out={:5.3f} L_reg={:5.3f} L_p={:5.3f} Coarse_EM={:4.3f} ' \
                               'Fine_CD={:4.3f} Mixed_Loss={:4.3f} alpha={:5.3f} ---{:8.2f} ms/batch (Averaged)'
+                    if accumulate:
+                        message += ' ---{:8.2f} ms/update ({:d} x {:d} clouds)'.format(
+                            1000 * mean_dt[0] * model.config.accum_steps,
+                            model.config.accum_steps,
+                            model.config.batch_num)
+                    message += ' ---{:7.1f} clouds/s'.format(num_workers * model.config.batch_num / mean_dt[0])
+                    if num_workers > 1:
+                        message += ' ({:d} workers)'.format(num_workers)
                     print(message.format(self.training_epoch,
                                          self.training_step,
                                          L_out,
@@ -307,8 +452,28 @@ class ModelTrainer:
                     if model.config.epoch_steps and epoch_n > model.config.epoch_steps:
                         raise tf.errors.OutOfRangeError(None, None, '')
 
+                # Data parallel epochs end after a fixed number of steps, or with the training
+                if self.cluster is not None:
+                    shard_n += 1
+                    global_step, stopped = step_state
+                    if stopped:
+                        break
+                    sync_done = global_step >= total_steps
+                    if sync_done or shard_n >= steps_per_epoch:
+                        raise tf.errors.OutOfRangeError(None, None, '')
+
             except tf.errors.OutOfRangeError:
 
+                # A shard that runs out of batches before the end of the epoch starts again
+                if self.cluster is not None and not sync_done and shard_n < steps_per_epoch:
+                    self.sess.run(dataset.train_init_op)
+                    continue
+                shard_n = 0
+
+                # Do not lose gradients of the last batches of the epoch
+                if accumulate and self.accum_n > 0:
+                    self.apply_accumulated_gradients()
+
                 # End of train dataset, update average of epoch steps
                 mean_epoch_n += (epoch_n - mean_epoch_n) / (self.training_epoch + 1)
                 epoch_n = 0
@@ -320,7 +485,7 @@ class ModelTrainer:
                 # Snapshot
                 if model.config.saving and (self.training_epoch + 1) % model.config.snapshot_gap == 0:
 
-                    # Tensorflow snapshot
+                    # Tensorflow snapshot (gradients were flushed above, no accumulated gradient is lost with it)
                     snapshot_directory = join(model.saving_path, 'snapshots')
                     if not exists(snapshot_directory):
                         makedirs(snapshot_directory)
@@ -330,7 +495,7 @@ class ModelTrainer:
                     self.save_kernel_points(model, self.training_epoch)
 
                 # Update learning rate
-                if self.training_epoch in model.config.lr_decays:
+                if is_chief and self.training_epoch in model.config.lr_decays:
                     op = self.learning_rate.assign(tf.multiply(self.learning_rate,
                                                                model.config.lr_decays[self.training_epoch]))
                     self.sess.run(op)
@@ -339,16 +504,17 @@ class ModelTrainer:
                 self.training_epoch += 1
 
                 # Update hyper-parameter alpha
-                if self.training_epoch in model.config.alpha_epoch:
+                if is_chief and self.training_epoch in model.config.alpha_epoch:
                     alpha_idx = model.config.alpha_epoch.index(self.training_epoch)
                     op = model.alpha.assign(model.config.alphas[alpha_idx])
                     self.sess.run(op)
 
                 # Validation
-                if model.config.network_model == 'completion':
-                    self.completion_validation_error(model, dataset)
-                else:
-                    raise ValueError('No validation method implemented for this network type')
+                if is_chief:
+                    if model.config.network_model == 'completion':
+                        self.completion_validation_error(model, dataset)
+                    else:
+                        raise ValueError('No validation method implemented for this network type')
 
                 # Reset iterator on training data
                 self.sess.run(dataset.train_init_op)
@@ -369,8 +535,13 @@ class ModelTrainer:
             self.training_step += 1
             epoch_n += 1
 
-        # Remove File for kill signal
-        if exists(join(model.saving_path, 'running_PID.txt')):
+        # Release the other workers, they may be waiting for a step the chief will not run
+        if self.cluster is not None and is_chief:
+            self.sess.run(self.stop_op)
+            self.sess.run(self.release_op)
+
+        # Remove File for kill signal (workers that do not save have no log folder)
+        if model.config.saving and exists(join(model.saving_path, 'running_PID.txt')):
             remove(join(model.saving_path, 'running_PID.txt'))
         self.sess.close()
 